@@ -7,10 +7,12 @@ Time series clustering algorithm.
 import xml.etree.ElementTree as et
 import pandas as pd
 import csv
+import itertools
 import numpy as np
 import logging
 import os
 import pickle
+import shutil
 
 from decimal import Decimal, ROUND_HALF_UP
 from collections import defaultdict
@@ -18,15 +20,20 @@ from .scaler import Scaler
 from .hddstream import HDDStream
 from .cluster_tracker import TrackByHistoricalAssociation
 from .cluster_tracker import TrackByLineage
+from .lineage_store import LineageStore
+from .ingest_cache import IngestCache
 from .helper_objects import Cluster
+from .helper_objects import PcoreSnapshot
+from .kernels import closest_points
 
 # Make this global so other function can see them as well for saving and loading
 HDDSTREAM_OBJ = 'hddstream'
 TRACKER_HISTORICAL_ASSOC = 'tracking_by_historical_association'
 TRACKER_LINEAGE = 'tracking_by_lineage'
+LINEAGE_STORE = 'lineage.sqlite'
 
 
-def run(config_xml, input_xml, log_dir, output_dir, gating_file=None, program_state_dir=None):
+def run(config_xml, input_xml, log_dir, output_dir, gating_file=None, program_state_dir=None, cache_dir=None):
     """
     Run chronoclust
     :param config_xml: xml file containing config for chronoclust
@@ -37,17 +44,23 @@ def run(config_xml, input_xml, log_dir, output_dir, gating_file=None, program_st
         corresponding label for each chronoclust's cluster.
     :param program_state_dir: Optional, in case chronoclust's old execution was halted/killed, u can 'reboot' it using
         one of its old image.
+    :param cache_dir: Optional, directory where the data files are cached once parsed, so later runs (e.g. restores
+        or parameter sweeps) don't parse them again. The cache holds an uncompressed copy of every data file. If not
+        given, nothing is cached and the data files are parsed as they are read.
     """
 
     # setup logger object
     logger = setup_logger('{}/logs'.format(log_dir))
     logger.info("Chronoclust start")
 
-    scaler = setup_scaler(logger, input_xml)
-
     # Get hddstream config
     config = et.parse(config_xml).getroot().find("config")
 
+    ingest_cache = IngestCache(cache_dir)
+    # Optional. Number of processes parsing the data files.
+    ingest_workers = config.find("ingest_workers")
+    scaler = setup_scaler(logger, input_xml, ingest_cache, 1 if ingest_workers is None else int(ingest_workers.text))
+
     # If there is a program state given, we'll search for hddstream's steam and continue from it.
     # Otherwise we'll reinitialise hddstream based on the config
     if program_state_dir is not None:
@@ -62,10 +75,19 @@ def run(config_xml, input_xml, log_dir, output_dir, gating_file=None, program_st
         tracker_by_association = TrackByHistoricalAssociation()
         tracker_by_lineage = TrackByLineage()
 
+    # Optional. Set from the config even when the state is restored, as it may have been saved without it.
+    track_by_id = config.find("track_by_id")
+    tracker_by_association.match_by_id = track_by_id is not None and int(track_by_id.text) > 0
+
+    # Lineage and historical associations of the clusters, kept next to the program state.
+    lineage_store, previous_timepoint = setup_lineage_store(output_dir, program_state_dir, hddstream,
+                                                            tracker_by_lineage)
+
     # parse the input xml to get the location of input dataset
     dataset_files_xml_entries = et.parse(input_xml).findall("file")
 
-    dataset_attributes = get_dataset_attributes(dataset_files_xml_entries[0].find('filename').text)
+    dataset_attributes = ingest_cache.get_attributes(dataset_files_xml_entries[0].find('filename').text,
+                                                     dataset_files_xml_entries[0].get('format'))
 
     result_filename = f'{output_dir}/result.csv'
     write_file_header(result_filename,
@@ -74,14 +96,7 @@ def run(config_xml, input_xml, log_dir, output_dir, gating_file=None, program_st
                       ['tracking_by_lineage', 'tracking_by_association', 'predicted_label'])
 
     # Setup gating data_autoencoder
-    gating_df = None if gating_file is None else pd.read_csv(gating_file)
-    gating = defaultdict(dict)
-    if gating_df is not None:
-        for idx, gate in gating_df.iterrows():
-            centroid = tuple(gate[dataset_attributes].values)
-            pop_name = gate['PopName']
-            time_point = int(gate['Day'])
-            gating[time_point][centroid] = pop_name
+    gating = {} if gating_file is None else read_gating(gating_file, dataset_attributes)
 
     for xml_entry in dataset_files_xml_entries:
 
@@ -98,12 +113,13 @@ def run(config_xml, input_xml, log_dir, output_dir, gating_file=None, program_st
         # Read dataset and scale it
         logger.info(f"Processing dataset for timepoint {timepoint}")
         dataset_filename = xml_entry.find("filename").text
-        dataset = pd.read_csv(dataset_filename, compression='gzip', header=0, sep=',').values
+        dataset = ingest_cache.read(dataset_filename, xml_entry.get("format"))
         scaled_dataset = scaler.scale_data(dataset)
 
         # Start clustering
         hddstream.online_microcluster_maintenance(scaled_dataset, timepoint)
         hddstream_pcore_id_to_object_dict = {x.id[0]: x for x in hddstream.pcore_MC}
+        pcore_snapshot = PcoreSnapshot.from_microcluster_store(hddstream.pcore_MC)
 
         for cluster in hddstream.final_clusters:
 
@@ -114,7 +130,7 @@ def run(config_xml, input_xml, log_dir, output_dir, gating_file=None, program_st
             rounded_weight = Decimal(str(cluster.cumulative_weight)).quantize(Decimal('1.1'), rounding=ROUND_HALF_UP)
 
             cluster = Cluster(list(cluster.id), denormalised_cluster_centroid, rounded_weight, cluster.preferred_dimension_vector)
-            cluster.add_pcore_objects(hddstream_pcore_id_to_object_dict)
+            cluster.set_pcore_snapshot(pcore_snapshot)
 
             tracker_by_lineage.add_new_child_cluster(cluster)
 
@@ -128,72 +144,83 @@ def run(config_xml, input_xml, log_dir, output_dir, gating_file=None, program_st
         # Start writing out result so we don't lose any result if program crashes.
         # Starting with overall result file
         result = []
-        gating_now = gating.get(timepoint)
-        for cluster in tracker_by_association.current_clusters:
-            historical_assoc_as_str = cluster.get_historical_associates_as_str()
+        # It means we have gating information
+        if timepoint in gating:
+            # The closest gate to each cluster is based on projected distance.
+            closest_gates_projected = find_closest_gates(gating[timepoint], tracker_by_association.current_clusters)
+        for cluster_index, cluster in enumerate(tracker_by_association.current_clusters):
+            historical_assoc_as_str = cluster.get_historical_associates_as_str(tracker_by_lineage.get_label)
             pcore_ids_as_str = '|'.join(str(s) for s in cluster.pcore_ids)
 
             array_rep = [timepoint, cluster.cumulative_weight, pcore_ids_as_str] + cluster.centroid + \
-                        [cluster.id, historical_assoc_as_str]
+                        [tracker_by_lineage.get_label(cluster.id), historical_assoc_as_str]
 
-            # It means we have gating information
-            if bool(gating_now):
-                # closest_gate_projected is the closest gate calculation based on projected distance.
-                # pick one and add it to the array_rep.
-                closest_gate_projected = find_closest_gating(gating_now, cluster)
-                array_rep.append(closest_gate_projected)
+            if timepoint in gating:
+                array_rep.append(closest_gates_projected[cluster_index])
 
             result.append(array_rep)
         append_to_file(result_filename, result)
 
+        lineage_store.add_timepoint(
+            timepoint,
+            previous_timepoint,
+            clusters=[(cluster.id, tracker_by_lineage.get_label(cluster.id))
+                      for cluster in tracker_by_lineage.child_clusters],
+            lineage_edges=tracker_by_lineage.get_child_edges(),
+            association_edges=[(tracker_by_lineage.get_node(associate), cluster.id)
+                               for cluster in tracker_by_association.current_clusters
+                               for associate in cluster.historical_associates if associate is not None])
+
         # Then the file containing points and their cluster assignment
         cluster_points_filename = f'{output_dir}/cluster_points_D{timepoint}.csv'
         write_file_header(cluster_points_filename, ['timepoint', 'cluster_id'] + dataset_attributes)
 
-        result = []
+        # Microclusters only record the rows of their points in the dataset. Gather the label and rows of each group
+        # of points, so all of them can be reverse scaled in one go.
+        labels = []
+        point_indices = []
 
         # This will extract all the points that are clustered
-        clustered_pcore_id = []
+        clustered_pcore_id = set()
         for cluster in tracker_by_lineage.child_clusters:
-            cluster_id = cluster.id
-            for pcore in cluster.pcore_objects:
+            cluster_id = tracker_by_lineage.get_label(cluster.id)
+            for pcore_id in cluster.pcore_ids:
+                pcore = hddstream_pcore_id_to_object_dict[pcore_id]
                 # This will happen if there are no points belonging to current day get clustered into
                 # one of the pcore that's part of current day cluster.
-                # If we don't have the try condition below, the scaler will throw an error.
-                try:
-                    points = scaler.reverse_scaling(pcore.points).tolist()
-                except ValueError:
+                if len(pcore.point_indices) == 0:
                     logger.info("WARNING: Pcore {} does not receive new data_autoencoder points for timepoint {}."
                                 .format(pcore.id, timepoint))
                     continue
 
-                for point in points:
-                    result.append([timepoint, cluster_id] + [round(p, 5) for p in point])
-
-                clustered_pcore_id.append(pcore.id)
+                labels.append((cluster_id, len(pcore.point_indices)))
+                point_indices.append(pcore.point_indices)
+                clustered_pcore_id.add(pcore_id)
 
         # This will extract all the points that are in outlier. We'll label them as noise.
         for o_mc in hddstream.outlier_MC:
-            try:
-                o_pts = scaler.reverse_scaling(o_mc.points).tolist()
-            except ValueError:
-                continue
-            for o_pt in o_pts:
-                result.append(([timepoint, "Noise"] + [round(p, 5) for p in o_pt]))
+            labels.append(("Noise", len(o_mc.point_indices)))
+            point_indices.append(o_mc.point_indices)
 
         # This will extract all the points that are in the pcore-MC but NOT in a cluster reported at the end.
         for p_mc in hddstream.pcore_MC:
-            if p_mc.id not in clustered_pcore_id:
-                try:
-                    p_pts = scaler.reverse_scaling(p_mc.points).tolist()
-                except ValueError:
-                    continue
-                for p_pt in p_pts:
-                    result.append(([timepoint, "Noise"] + [round(p, 5) for p in p_pt]))
+            if p_mc.id[0] not in clustered_pcore_id:
+                labels.append(("Noise", len(p_mc.point_indices)))
+                point_indices.append(p_mc.point_indices)
+
+        result = []
+        point_indices = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                                       [np.frombuffer(indices, dtype=np.int64) for indices in point_indices])
+        if len(point_indices) > 0:
+            points = iter(scaler.reverse_scaling(scaled_dataset[point_indices]).tolist())
+            for label, num_points in labels:
+                for point in itertools.islice(points, num_points):
+                    result.append([timepoint, label] + [round(p, 5) for p in point])
 
         append_to_file(cluster_points_filename, result)
 
         # Prepare for the next time point
+        previous_timepoint = timepoint
         tracker_by_lineage.transfer_child_to_parent()
         tracker_by_association.transfer_current_to_previous()
 
@@ -207,6 +234,8 @@ def run(config_xml, input_xml, log_dir, output_dir, gating_file=None, program_st
         # This append the config of hddstream to the result file.
         f.write(et.tostring(config, encoding='utf8', method="xml"))
 
+    lineage_store.close()
+
     # Log finish point
     logger.info('Chronoclust finish')
 
@@ -236,6 +265,44 @@ def save_program_state(hddstream, output_dir, tracker_by_association, tracker_by
         pickle.dump(tracker_by_lineage, f)
 
 
+def setup_lineage_store(output_dir, program_state_dir, hddstream, tracker_by_lineage):
+    """
+    Open the lineage store in the folder the program state is saved in. A new run starts it afresh. A restored run
+    carries on from the store saved with the program state it is restored from, without the time points after it.
+    :param output_dir: directory where the store is kept (under subfolder program_images)
+    :param program_state_dir: directory of the program state restored, None if not restoring
+    :param hddstream: hddstream object, restored or new
+    :param tracker_by_lineage: tracker_by_lineage object, restored or new
+    :return: the store and the last time point processed (None if there is none)
+    """
+    program_state_dir_for_saving = "{}/program_images".format(output_dir)
+    if not os.path.exists(program_state_dir_for_saving):
+        os.makedirs(program_state_dir_for_saving)
+    lineage_store_filename = '{}/{}'.format(program_state_dir_for_saving, LINEAGE_STORE)
+
+    if program_state_dir is None:
+        lineage_store = LineageStore(lineage_store_filename)
+        lineage_store.clear()
+        return lineage_store, None
+
+    restored_lineage_store_filename = '{}/{}'.format(program_state_dir, LINEAGE_STORE)
+    if os.path.exists(restored_lineage_store_filename) and \
+            os.path.abspath(restored_lineage_store_filename) != os.path.abspath(lineage_store_filename):
+        shutil.copyfile(restored_lineage_store_filename, lineage_store_filename)
+    lineage_store = LineageStore(lineage_store_filename)
+    previous_timepoint = hddstream.last_data_timestamp
+    lineage_store.remove_timepoints_after(previous_timepoint)
+    # The program state may have been saved without a store. The clusters of the last time point are then added, so the
+    # edges of the next one lead somewhere.
+    if not lineage_store.has_timepoint(previous_timepoint):
+        lineage_store.add_timepoint(previous_timepoint, None,
+                                    clusters=[(tracker_by_lineage.get_node(cluster.id),
+                                               tracker_by_lineage.get_label(cluster.id))
+                                              for cluster in tracker_by_lineage.parent_clusters],
+                                    lineage_edges=[], association_edges=[])
+    return lineage_store, previous_timepoint
+
+
 def restore_program_state(program_state_dir):
     """
     Restore program's state (hddstream and tracker) using pickle.
@@ -279,47 +346,70 @@ def append_to_file(filename, content):
         csv.writer(f).writerows(content)
 
 
-def get_dataset_attributes(dataset_file):
-    return pd.read_csv(dataset_file, compression='gzip', sep=',', header=None).iloc[0].values.tolist()
-
-
-def setup_scaler(logger, dataset_filenames_xml):
+def setup_scaler(logger, dataset_filenames_xml, ingest_cache, num_workers=1):
     """
-    Setup a scaler to normalise data
+    Setup a scaler to normalise data. It is fitted to the minimum and maximum of each attribute in each data file, kept
+    in the ingest cache's catalog, so the data files are only read if they are not in the cache yet.
     :param logger: logger object to log progress
     :param dataset_filenames_xml: xml file containing mapping of data filename.
+    :param ingest_cache: IngestCache the data files are read through.
+    :param num_workers: number of processes parsing the data files not in the cache yet.
     :return: the scaler object
     """
 
-    def get_input_dataset(logger, dataset_filenames_xml):
-        logger.info(f'Parsing input file for scaler')
-        input_dataset = []
-
-        input_files = et.parse(dataset_filenames_xml).findall("file")
-        for input_file in input_files:
-            filename = input_file.find("filename").text
-            dataset = pd.read_csv(filename, compression='gzip', header=0, sep=',').values
-            input_dataset.extend(dataset)
-
-        return input_dataset
-
     logger.info('Setting up scaler')
-    dataset = get_input_dataset(logger, dataset_filenames_xml)
+    input_files = et.parse(dataset_filenames_xml).findall("file")
+    filenames = [input_file.find("filename").text for input_file in input_files]
+    file_formats = [input_file.get("format") for input_file in input_files]
+    logger.info(f'Parsing input files for scaler')
+    schemas = [schema for schema in ingest_cache.ingest_all(filenames, num_workers, file_formats)
+               if schema['num_rows'] > 0]
     scaler = Scaler()
     logger.info('Fitting scaler')
-    scaler.fit_scaler(dataset)
+    scaler.fit_scaler_to_statistics([schema['min'] for schema in schemas], [schema['max'] for schema in schemas])
     return scaler
 
 
-def find_closest_gating(gating_dict, cluster):
-    closest_distance_projected = None
-    closest_gate_projected = None
+def read_gating(gating_file, dataset_attributes):
+    """
+    Read the gating of the data files. A gate appearing more than once in a time point keeps the population name it is
+    last given.
 
-    for centroid, label in gating_dict.items():
+    Args:
+        gating_file (str): Csv file containing the centroid (one column per dataset attribute), population name
+            (PopName) and time point (Day) of each gate.
+        dataset_attributes (list): Name of the dataset attributes.
 
-        dist_projected = cluster.get_projected_dist_to_point(np.array(centroid))
-        if closest_distance_projected is None or dist_projected < closest_distance_projected:
-            closest_distance_projected = dist_projected
-            closest_gate_projected = label
+    Returns:
+        dict: For each time point with gates, a tuple of the gates' centroids (numpy.array, a row per gate) and
+            population names (list).
+    """
+    gating_df = pd.read_csv(gating_file)
+    gating = defaultdict(dict)
+    for time_point, centroid, pop_name in zip(gating_df['Day'].values.astype(int),
+                                              map(tuple, gating_df[dataset_attributes].values.tolist()),
+                                              gating_df['PopName'].values):
+        gating[time_point][centroid] = pop_name
+    return {time_point: (np.array(list(gates.keys()), dtype=float), list(gates.values()))
+            for time_point, gates in gating.items()}
 
-    return closest_gate_projected
+
+def find_closest_gates(gates, clusters):
+    """
+    Find the closest gate to each cluster, using projected distance to the cluster i.e. weighted by the cluster's
+    preferred dimensions. The first gate is taken in case of a tie.
+
+    Args:
+        gates (tuple): Centroids and population names of the gates of a time point, as given by read_gating.
+        clusters (list): The clusters of the time point.
+
+    Returns:
+        list: Population name of the closest gate to each cluster.
+    """
+    gate_centroids, gate_labels = gates
+    if len(clusters) == 0:
+        return []
+    cluster_centroids = np.array([np.array(cluster.centroid, dtype=float) for cluster in clusters])
+    preferred_dimensions = np.array([np.array(cluster.preferred_dimensions, dtype=float) for cluster in clusters])
+    closest, _ = closest_points(gate_centroids, cluster_centroids, preferred_dimensions, divide=True)
+    return [gate_labels[index] for index in closest]
@@ -1,27 +1,255 @@
 import string
+import numpy as np
 
 from collections import defaultdict
-from collections import deque
+from .kernels import closest_points
+from .lineage_store import INHERIT
+from .lineage_store import SPLIT
+
+
+class LineageLabels(object):
+    # Kinds of node.
+    LETTER = 0
+    SPLIT = 1
+    MERGE = 2
+
+    def __init__(self):
+        """
+        Lineage labels of the clusters, kept as a DAG of integer nodes rather than strings. A node is either a new
+        letter (A, B, ..., Z, AA, BB, ...), the n-th split of another node (A|n) or the merge of other nodes ((A,B)).
+        Nodes are shared: asking for a node that already exists gives its id again, so a node stands for one label.
+        The labels are only rendered as strings when needed, see render.
+        """
+        self.kinds = []
+        # Index of the letter of a LETTER node, number of the split of a SPLIT node, 0 for a MERGE node.
+        self.values = []
+        # Nodes each node comes from: none for a LETTER node, the node split for a SPLIT node, the two nodes merged, in
+        # the order of their labels, for a MERGE node.
+        self.parents = []
+        # Number of times the cluster labelled by each node has split.
+        self.num_splits = []
+        self.num_letters = 0
+        self._node_of_key = {}
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def _get_node(self, kind, value, parents):
+        """
+        Get the node of the given kind, value and parents, adding it if it doesn't exist yet.
+
+        Args:
+            kind (int): Kind of node.
+            value (int): Letter index or split number. See values.
+            parents (tuple): Nodes the node comes from. See parents.
+
+        Returns:
+            int: The node.
+        """
+        key = (kind, value, parents)
+        node = self._node_of_key.get(key)
+        if node is None:
+            node = len(self.kinds)
+            self.kinds.append(kind)
+            self.values.append(value)
+            self.parents.append(parents)
+            self.num_splits.append(0)
+            self._node_of_key[key] = node
+        return node
+
+    def new_letter(self):
+        """
+        Get a node for the next unused letter.
+
+        Returns:
+            int: The node.
+        """
+        node = self._get_node(self.LETTER, self.num_letters, ())
+        self.num_letters += 1
+        return node
+
+    def split(self, node):
+        """
+        Get a node for a new split of a node. The first split of A is A|1, the second one A|2, and so on.
+
+        Args:
+            node (int): The node split.
+
+        Returns:
+            int: The node of the split.
+        """
+        self.num_splits[node] += 1
+        return self._get_node(self.SPLIT, self.num_splits[node], (node,))
+
+    def merge(self, nodes, labels=None):
+        """
+        Get the node for the merge of nodes. The merge of more than two nodes is the merge of the first two, by label,
+        merged with the third, and so on, just as it is rendered. So the merge of A, B and C is the same node as the
+        merge of (A,B) and C, and splits of ((A,B),C) are numbered once whichever way it came about.
+
+        Args:
+            nodes (iterable): The nodes merged.
+            labels (dict, optional): Labels already rendered, by node. See render.
+
+        Returns:
+            int: The node of the merge, or the node itself if there is only one.
+        """
+        labels = {} if labels is None else labels
+        nodes = sorted(set(nodes), key=lambda merged_node: self.render(merged_node, labels))
+        node = nodes[0]
+        for merged_node in nodes[1:]:
+            node = self._get_node(self.MERGE, 0, (node, merged_node))
+        return node
+
+    @staticmethod
+    def get_letter(index):
+        """
+        Get a letter label: A to Z for the first 26, then AA to ZZ, AAA to ZZZ, and so on.
+
+        Args:
+            index (int): Index of the letter.
+
+        Returns:
+            str: The letter label.
+        """
+        return string.ascii_uppercase[index % 26] * (index // 26 + 1)
+
+    def render(self, node, labels):
+        """
+        Render the label of a node as a string. A merge is written as its labels, sorted, in nested parentheses, e.g.
+        ((A|1,B),B|2).
+
+        Args:
+            node (int): The node.
+            labels (dict): Labels already rendered, by node. The labels rendered along the way are added to it.
+
+        Returns:
+            str: The label.
+        """
+        stack = [node]
+        while len(stack) > 0:
+            current = stack[-1]
+            if current in labels:
+                stack.pop()
+                continue
+            # Lineages can be long, so the labels of the nodes it comes from are rendered first without recursing.
+            missing = [parent for parent in self.parents[current] if parent not in labels]
+            if len(missing) > 0:
+                stack.extend(missing)
+                continue
+            stack.pop()
+
+            kind = self.kinds[current]
+            if kind == self.LETTER:
+                label = self.get_letter(self.values[current])
+            elif kind == self.SPLIT:
+                label = f'{labels[self.parents[current][0]]}|{self.values[current]}'
+            else:
+                first_parent, second_parent = self.parents[current]
+                label = f'({labels[first_parent]},{labels[second_parent]})'
+            labels[current] = label
+        return labels[node]
+
+    def parse(self, label):
+        """
+        Get the node of a rendered label. Used to restore states saved when the labels were kept as strings.
+
+        Args:
+            label (str): The label.
+
+        Returns:
+            int: The node.
+        """
+        if label.startswith('(') and label.endswith(')'):
+            depth = 0
+            for position, character in enumerate(label):
+                if character == '(':
+                    depth += 1
+                elif character == ')':
+                    depth -= 1
+                elif character == ',' and depth == 1:
+                    return self.merge((self.parse(label[1:position]), self.parse(label[position + 1:-1])))
+
+        split_label, separator, split_number = label.rpartition('|')
+        if separator and split_number.isdigit():
+            return self._get_node(self.SPLIT, int(split_number), (self.parse(split_label),))
+
+        index = 26 * (len(label) - 1) + string.ascii_uppercase.index(label[0])
+        return self._get_node(self.LETTER, index, ())
 
 
 class TrackByLineage(object):
     def __init__(self):
         self.child_clusters = []
         self.parent_clusters = []
-        self.letters = deque(string.ascii_uppercase)
-        self.split_per_id = dict((el, 0) for el in self.letters)
+        self.lineage = LineageLabels()
+        # Labels rendered so far, by node. Only those of the parent clusters are kept from one time point to the next.
+        self._labels = {}
+        # (parent id, child cluster, kind) of each edge between a parent cluster and a child cluster. See
+        # get_child_edges.
+        self.child_edges = []
+
+    def __setstate__(self, state):
+        """Restore state from the unpickled state values."""
+        self.__dict__.update(state)
+        self.__dict__.setdefault('child_edges', [])
+        if 'lineage' in state:
+            return
 
-    def repopulate_letters(self, iteration):
-        letters = []
-        for alphabet in string.ascii_uppercase:
-            letters.append(alphabet * iteration)
-        self.letters = deque(letters)
+        # States saved when the labels were kept as strings, along with the letters left and the number of splits of
+        # each label.
+        letters = self.__dict__.pop('letters')
+        split_per_id = self.__dict__.pop('split_per_id')
+        self.lineage = LineageLabels()
+        self._labels = {}
+        self.lineage.num_letters = 26 * len(letters[0]) - len(letters)
+        for label, num_splits in split_per_id.items():
+            if num_splits > 0:
+                self.lineage.num_splits[self.lineage.parse(label)] = num_splits
+        for cluster in self.parent_clusters + self.child_clusters:
+            if isinstance(cluster.id, str):
+                cluster.id = self.lineage.parse(cluster.id)
 
     def get_new_letter(self):
-        new_letter = self.letters.popleft()
-        if len(self.letters) == 0:
-            self.repopulate_letters(len(new_letter) + 1)
-        return new_letter
+        return self.lineage.new_letter()
+
+    def get_label(self, node):
+        """
+        Get the lineage label of a cluster as written in the results, e.g. (A|1,B).
+
+        Args:
+            node (int): Id of the cluster, as set by calculate_ids. Ids of clusters restored from a state saved when
+                they were kept as strings are labels already.
+
+        Returns:
+            str: The label.
+        """
+        if isinstance(node, str):
+            return node
+        return self.lineage.render(node, self._labels)
+
+    def get_node(self, id):
+        """
+        Get the node of the lineage a cluster id stands for.
+
+        Args:
+            id (int): Id of the cluster, as set by calculate_ids. Ids of clusters restored from a state saved when
+                they were kept as strings are parsed.
+
+        Returns:
+            int: The node.
+        """
+        return self.lineage.parse(id) if isinstance(id, str) else id
+
+    def get_child_edges(self):
+        """
+        Get the edges between the parent clusters and the child clusters found by calculate_ids.
+
+        Returns:
+            list: (parent id, child id, kind) of each edge. The kind is INHERIT if the child inherited the parent's
+                label, SPLIT if it got a new split of it.
+        """
+        return [(parent, child.id, kind) for parent, child, kind in self.child_edges]
 
     def add_new_child_cluster(self, cluster):
         self.child_clusters.append(cluster)
@@ -36,6 +264,8 @@ class TrackByLineage(object):
         offspring = defaultdict(list)
         # Get the cluster label from previous day.
         parent_pcores_to_id = self.get_parent_pcore_to_id()
+        parent_ids = set(parent.id for parent in self.parent_clusters)
+        self.child_edges = []
         for cluster in self.child_clusters:
             cluster.set_parents(parent_pcores_to_id=parent_pcores_to_id)
 
@@ -53,21 +283,22 @@ class TrackByLineage(object):
             # https://stackoverflow.com/questions/403421/how-to-sort-a-list-of-objects-based-on-an-attribute-of-the-objects
             children = sorted(children, key=lambda x: len(x.pcore_ids), reverse=True)
 
-            # If cluster B split into B and B|1 in day 1, then split again to produce B, B|1, and B|2 in day
-            # 2, i.e. B split again in day 2, we need to make sure we do not assign the new split label B|1
-            # as in day 1, cluster B already split into B|1. To do this, we need to remember the number of
-            # split cluster B has had.
-            parent_num_split = self.split_per_id.get(parent, 0)
-
             for i in range(0, len(children)):
                 child = children[i]
                 # Cluster with biggest number of pcores. It inherits the previous day label.
                 if i == 0:
                     child.add_id(parent)
+                    kind = INHERIT
                 else:
-                    parent_num_split += 1
-                    child.add_id(f'{parent}|{parent_num_split}')
-            self.split_per_id[parent] = parent_num_split
+                    # If cluster B split into B and B|1 in day 1, then split again to produce B, B|1, and B|2 in day
+                    # 2, i.e. B split again in day 2, we need to make sure we do not assign the new split label B|1
+                    # as in day 1, cluster B already split into B|1. The lineage remembers the number of splits of
+                    # each node for this.
+                    child.add_id(self.lineage.split(parent))
+                    kind = SPLIT
+                # New letters are not labels of parent clusters.
+                if parent in parent_ids:
+                    self.child_edges.append((parent, child, kind))
 
         # Assign the id to each child. Handle merges if a cluster has separate parents.
         self.assign_child_id()
@@ -84,35 +315,29 @@ class TrackByLineage(object):
     def transfer_child_to_parent(self):
         self.parent_clusters = self.child_clusters
         self.child_clusters = []
+        self._labels = {parent.id: self._labels[parent.id] for parent in self.parent_clusters
+                        if parent.id in self._labels}
 
     def assign_child_id(self):
         """
         Not a simple join method because of the merging. When there are multiple items in self.label set, that means
         there has been a merge somewhere along the line.
 
-        When merging we need to enclose the merging clusters' label in parenthesis.
-        Moreover, we need to separate the merging clusters' label by comma.
-
-        For example, cluster A|1 and B merges. The resulting labels should be (A|1, B).
-        If that cluster merges again, say with cluster B|2, then the label will become ((A|1, B), B|2).
+        The child gets the node of the merge of its labels. When rendered, the merging clusters' labels are enclosed in
+        parenthesis and separated by comma. For example, cluster A|1 and B merges. The resulting labels should be
+        (A|1, B). If that cluster merges again, say with cluster B|2, then the label will become ((A|1, B), B|2).
         """
         for child in self.child_clusters:
-            if len(child.id) == 1:
-                child.id = ''.join(sorted(child.id))
-            else:
-                labels_as_list = list(sorted(child.id))
-                label_with_parenthesis = ['(', labels_as_list[0], ',', labels_as_list[1], ')']
-                if len(label_with_parenthesis) > 2:
-                    for i in range(2, len(labels_as_list)):
-                        label_with_parenthesis = ['('] + label_with_parenthesis + [',', labels_as_list[i], ')']
-
-                child.id = ''.join(label_with_parenthesis)
+            child.id = self.lineage.merge(child.id, self._labels)
 
 
 class TrackByHistoricalAssociation(object):
-    def __init__(self):
+    def __init__(self, match_by_id=False):
         self.current_clusters = []
         self.previous_timepoint_clusters = []
+        # True to associate a pcore that was in one of the previous time point's clusters with that cluster straight
+        # away, rather than with the cluster of the previous pcore closest to it.
+        self.match_by_id = match_by_id
 
     def set_current_clusters(self, clusters):
         self.current_clusters = clusters
@@ -123,25 +348,87 @@ class TrackByHistoricalAssociation(object):
                 cluster.add_historical_associate(None)
             return
 
-        # TODO need improvement. Too many loops here. Can maybe get each cluster to do the evaluation
-        for cluster in self.current_clusters:
-
-            for pcore in cluster.pcore_objects:
-                closest_distance = None
-                closest_previous_timepoint_cluster = None
-                # This is only for finding out which pcore is the closest.
-                closest_pcore = None
-
-                for previous_timepoint_cluster in self.previous_timepoint_clusters:
-                    for previous_pcore in previous_timepoint_cluster.pcore_objects:
-                        projected_distance = pcore.get_projected_dist_to_point(previous_pcore.cluster_centroids)
-                        if closest_distance is None or projected_distance < closest_distance:
-                            closest_distance = projected_distance
-                            closest_previous_timepoint_cluster = previous_timepoint_cluster.id
-                            closest_pcore = previous_pcore.id
-
-                cluster.add_historical_associate(closest_previous_timepoint_cluster)
-                cluster.add_historical_associate_pcore(closest_pcore)
+        # The pcores of all the previous time point's clusters, then those of all the current clusters, are gathered
+        # from the clusters' snapshots: the cluster each belongs to, its id, creation time, centroid and preferred
+        # dimension vector.
+        previous_pcores = self._gather_pcores(self.previous_timepoint_clusters)
+        current_pcores = self._gather_pcores(self.current_clusters)
+        previous_clusters, previous_ids, previous_creation_times, previous_centroids, _ = previous_pcores
+        current_clusters, current_ids, current_creation_times, current_centroids, current_preferred_dimensions = \
+            current_pcores
+
+        # Index in previous_pcores of the previous pcore each current pcore is associated with.
+        closest = np.full(len(current_ids), -1, dtype=int)
+        if self.match_by_id:
+            closest = self._match_pcores_by_id(previous_ids, previous_creation_times, current_ids,
+                                               current_creation_times)
+
+        # The closest previous pcore to each current pcore left is found with a single blocked distance calculation.
+        # The projected distance is measured with the preferred dimension vector of the current pcore.
+        unmatched = np.flatnonzero(closest < 0)
+        if len(previous_ids) > 0 and len(unmatched) > 0:
+            closest[unmatched], _ = closest_points(previous_centroids, current_centroids[unmatched],
+                                                   current_preferred_dimensions[unmatched], divide=True)
+
+        for index, cluster in enumerate(current_clusters):
+            closest_previous_timepoint_cluster = None
+            # This is only for finding out which pcore is the closest.
+            closest_pcore = None
+
+            if closest[index] >= 0:
+                closest_previous_timepoint_cluster = previous_clusters[closest[index]].id
+                closest_pcore = [previous_ids[closest[index]]]
+
+            cluster.add_historical_associate(closest_previous_timepoint_cluster)
+            cluster.add_historical_associate_pcore(closest_pcore)
+
+    @staticmethod
+    def _gather_pcores(clusters):
+        """
+        Gather the pcores of clusters from their snapshots.
+
+        Args:
+            clusters (list): The clusters.
+
+        Returns:
+            tuple: For each pcore, in cluster order: the cluster it belongs to (list), its id (list), creation time,
+                centroid and preferred dimension vector (numpy.array each).
+        """
+        pcore_clusters = [cluster for cluster in clusters for _ in cluster.pcore_rows]
+        ids = [cluster.pcore_snapshot.ids[row] for cluster in clusters for row in cluster.pcore_rows]
+        if len(ids) == 0:
+            return pcore_clusters, ids, np.zeros(0, dtype=int), np.zeros((0, 0)), np.zeros((0, 0))
+        snapshots = [cluster.pcore_snapshot for cluster in clusters if len(cluster.pcore_rows) > 0]
+        rows = [cluster.pcore_rows for cluster in clusters if len(cluster.pcore_rows) > 0]
+        return (pcore_clusters, ids,
+                np.concatenate([snapshot.creation_time_in_hrs[r] for snapshot, r in zip(snapshots, rows)]),
+                np.concatenate([snapshot.cluster_centroids[r] for snapshot, r in zip(snapshots, rows)]),
+                np.concatenate([snapshot.preferred_dimension_vectors[r] for snapshot, r in zip(snapshots, rows)]))
+
+    @staticmethod
+    def _match_pcores_by_id(previous_ids, previous_creation_times, current_ids, current_creation_times):
+        """
+        Match the current pcores that were in one of the previous time point's clusters with themselves. A pcore keeps
+        its id for as long as it exists and ids are not reused, but a previous pcore with the same id and a different
+        creation time is taken to be another pcore, in case the ids were given by something that does reuse them.
+
+        Args:
+            previous_ids (list): Id of each pcore of the previous time point's clusters.
+            previous_creation_times (numpy.array): Creation time of each pcore of the previous time point's clusters.
+            current_ids (list): Id of each pcore of the current clusters.
+            current_creation_times (numpy.array): Creation time of each pcore of the current clusters.
+
+        Returns:
+            numpy.array: Index in previous_ids of the pcore each current pcore matches, -1 for those that match none.
+        """
+        previous_index_of_pcore = {id: index for index, id in enumerate(previous_ids)}
+        matched = np.full(len(current_ids), -1, dtype=int)
+        for index, id in enumerate(current_ids):
+            previous_index = previous_index_of_pcore.get(id)
+            if previous_index is not None and \
+                    previous_creation_times[previous_index] == current_creation_times[index]:
+                matched[index] = previous_index
+        return matched
 
     def transfer_current_to_previous(self):
         self.previous_timepoint_clusters = self.current_clusters
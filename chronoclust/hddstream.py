@@ -16,17 +16,37 @@ __email__ = "ghar1821@uni.sydney.edu.au"
 __status__ = "Development"
 
 import numpy as np
+import bisect
+import copy
 import sys
 import logging
 import io
+import os
+import xml.etree.ElementTree as et
 
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.metrics import adjusted_rand_score
 from tqdm import tqdm
+from . import jit_kernels
+from .kernels import closest_centroids
 from .predecon import PreDeCon
 from .helper_objects import Microcluster
 from .helper_objects import MicroclusterAsDatapoint
+from .microcluster_store import MicroclusterStore
+from .microcluster_index import MicroclusterIndex
 
 
 class HDDStream(object):
+    # Number of closest microclusters kept for each point when adding points in batch.
+    BATCH_CANDIDATES = 8
+    # Used when adding points in batch, in place of the index of a candidate microcluster the point can't be added to
+    # because of its pdim.
+    NOT_A_CANDIDATE = -1
+    # Below this number of microclusters, scoring them all is faster than querying the spatial index. The index was
+    # still slower with about 6000 microclusters and only faster with about 29000.
+    INDEX_MIN_MICROCLUSTERS = 16384
+
     def __init__(self, config_as_xml, logger):
         """
         Initialise hddstream object. All the attributes here are named based on Ntoutsi paper.
@@ -50,13 +70,26 @@ class HDDStream(object):
         self.omicron = None
 
         # The following attributes are used in the algorithm implementation.
-        self.pcore_MC = []
-        self.outlier_MC = []
+        self.pcore_MC = MicroclusterStore()
+        self.outlier_MC = MicroclusterStore()
+        # Id given to the next microcluster created. Ids are never reused, and a microcluster keeps its id when it is
+        # upgraded or downgraded.
+        self.next_microcluster_id = 0
         self.final_clusters = []
         self.last_data_timestamp = 0
         self.dataset_dimensionality = 0
         self.logger = logger
         self.dataset_size = 0
+        # True to use the Numba kernels for the online microcluster maintenance. Set from the config.
+        self.use_jit = False
+        # Neighbourhood graph of the pcores found by the last offline clustering, updated by the next one.
+        self.offline_neighbourhood_graph = None
+        # Centroid of each pcore, by id, at the last offline clustering. None if there hasn't been one.
+        self.offline_pcore_centroids = None
+        # Number of online microcluster maintenances since the last offline clustering.
+        self.timepoints_since_offline = 0
+        # True to run offline clustering after the next online microcluster maintenance, whatever the offline policy.
+        self.offline_requested = False
 
         # used for logging
         self.logger = logger
@@ -65,15 +98,40 @@ class HDDStream(object):
         """Return state values to be pickled."""
         return (self.pi, self.mu, self.epsilon, self.epsilon_squared, self.upsilon, self.delta, self.delta_squared,
                 self.beta, self.k, self.lambbda, self.omicron, self.pcore_MC, self.outlier_MC,
-                self.last_data_timestamp, self.dataset_dimensionality, self.dataset_size)
+                self.last_data_timestamp, self.dataset_dimensionality, self.dataset_size, self.next_microcluster_id,
+                self.final_clusters, self.offline_neighbourhood_graph, self.offline_pcore_centroids,
+                self.timepoints_since_offline, self.offline_requested)
 
     def __setstate__(self, state):
         """Restore state from the unpickled state values."""
         self.pi, self.mu, self.epsilon, self.epsilon_squared, self.upsilon, self.delta, self.delta_squared, \
         self.beta, self.k, self.lambbda, self.omicron, self.pcore_MC, self.outlier_MC, self.last_data_timestamp, \
-        self.dataset_dimensionality, self.dataset_size = state
+        self.dataset_dimensionality, self.dataset_size = state[:16]
 
-        self.final_clusters = []
+        # Program states saved before MicroclusterStore existed keep the microclusters in lists.
+        if isinstance(self.pcore_MC, list):
+            self.pcore_MC = MicroclusterStore.from_microclusters(self.pcore_MC)
+        if isinstance(self.outlier_MC, list):
+            self.outlier_MC = MicroclusterStore.from_microclusters(self.outlier_MC)
+
+        if len(state) > 16:
+            self.next_microcluster_id = state[16]
+        else:
+            # Program states saved before ids were unique. Carry on after the largest id in use.
+            ids = [next(iter(microcluster.id)) for microcluster in list(self.pcore_MC) + list(self.outlier_MC)]
+            self.next_microcluster_id = max(ids, default=-1) + 1
+
+        # Program states saved before the offline schedule was kept run offline clustering on the first time point.
+        if len(state) > 17:
+            self.final_clusters, self.offline_neighbourhood_graph, self.offline_pcore_centroids, \
+            self.timepoints_since_offline, self.offline_requested = state[17:22]
+        else:
+            self.final_clusters = []
+            self.offline_neighbourhood_graph = None
+            self.offline_pcore_centroids = None
+            self.timepoints_since_offline = 0
+            self.offline_requested = False
+        self.use_jit = False
 
     def set_logger(self, logger):
         self.logger = logger
@@ -202,37 +260,1021 @@ class HDDStream(object):
                 # Save memory. Don't store every points.
                 omc.reset_points()
 
-        num_datapoints = input_dataset.shape[0]
+        self._set_up_microcluster_indices()
+        self._set_up_jit()
+
+        num_regions = self._get_optional_config("online_regions", 1, int)
+        num_shards = self._get_optional_config("online_shards", 1, int)
 
         self.logger.info("Starting online microcluster maintenance for timepoint {}".format(input_dataset_daystamp))
+        if num_regions > 1 and input_dataset.shape[0] >= num_regions:
+            self._add_datapoints_in_regions(input_dataset, input_dataset_daystamp, num_regions)
+        elif num_shards > 1 and input_dataset.shape[0] >= num_shards:
+            self._add_datapoints_in_shards(input_dataset, input_dataset_daystamp, num_shards)
+        else:
+            self._add_datapoints(input_dataset, input_dataset_daystamp)
+
+        self.logger.info("Finish online microcluster maintenance for timepoint {}".format(input_dataset_daystamp))
+        self.logger.info("Online maintenance yield {} pcores and {} outlier".format(
+            len(self.pcore_MC), len(self.outlier_MC)))
+
+        self.last_data_timestamp = input_dataset_daystamp
+
+        self.timepoints_since_offline += 1
+        if self._is_offline_clustering_due():
+            self.offline_clustering(input_dataset_daystamp)
+        else:
+            self.logger.info("Skipping offline clustering for timepoint {}, reusing the last clusters".format(
+                input_dataset_daystamp))
+            self._remap_final_clusters()
+
+    def request_offline_clustering(self):
+        """
+        Make the next online microcluster maintenance end with offline clustering, whatever the offline policy.
+
+        Returns:
+            None.
+        """
+        self.offline_requested = True
+
+    def _is_offline_clustering_due(self):
+        """
+        Check whether offline clustering is to be run after the online microcluster maintenance, following the
+        offline_policy config element:
+            - always (default): after every online microcluster maintenance.
+            - every: once every offline_interval online microcluster maintenances.
+            - on_change: when the fraction of pcores created, deleted or moved since the last offline clustering is
+              above offline_change_threshold. See _get_changed_pcore_fraction.
+            - on_request: only when asked to with request_offline_clustering.
+        Whatever the policy, it is run if asked to with request_offline_clustering, or if it never has been.
+
+        Returns:
+            bool: True if it is to be run.
+        """
+        policy = self._get_optional_config("offline_policy", "always", str)
+        if policy == "always" or self.offline_requested or self.offline_pcore_centroids is None:
+            return True
+        if policy == "every":
+            return self.timepoints_since_offline >= self._get_optional_config("offline_interval", 1, int)
+        if policy == "on_change":
+            return self._get_changed_pcore_fraction() > self._get_optional_config("offline_change_threshold", 0.0,
+                                                                                   float)
+        if policy == "on_request":
+            return False
+        raise ValueError("Unknown offline_policy {}.".format(policy))
+
+    def _get_changed_pcore_fraction(self):
+        """
+        Get the fraction of pcores created, deleted or moved since the last offline clustering, out of the pcores now
+        and those deleted. A pcore has moved if any value of its centroid moved further than offline_change_tolerance.
+
+        Returns:
+            float: The fraction.
+        """
+        tolerance = self._get_optional_config("offline_change_tolerance", 0.0, float)
+        pcore_ids = set()
+        num_changed = 0
+        for pcore in self.pcore_MC:
+            pcore_id = next(iter(pcore.id))
+            pcore_ids.add(pcore_id)
+            previous_centroid = self.offline_pcore_centroids.get(pcore_id)
+            if previous_centroid is None or np.any(np.abs(pcore.cluster_centroids - previous_centroid) > tolerance):
+                num_changed += 1
+
+        num_deleted = len(self.offline_pcore_centroids.keys() - pcore_ids)
+        return (num_changed + num_deleted) / max(len(pcore_ids) + num_deleted, 1)
+
+    def _remap_final_clusters(self):
+        """
+        Rebuild the clusters found by the last offline clustering from the pcores they contained that still exist,
+        with their current CF1, CF2 and weight, the way PreDeCon builds them. Clusters left with no pcore are dropped.
+        Pcores created since are not in any cluster until the next offline clustering.
+
+        Returns:
+            None.
+        """
+        pcores = {next(iter(pcore.id)): pcore for pcore in self.pcore_MC}
+        remapped_clusters = []
+        for cluster in self.final_clusters:
+            remapped_cluster = Microcluster(cf1=np.zeros(self.dataset_dimensionality),
+                                            cf2=np.zeros(self.dataset_dimensionality), id=set(),
+                                            preferred_dimension_vector=np.ones(self.dataset_dimensionality))
+            for pcore_id in cluster.id:
+                pcore = pcores.get(pcore_id)
+                if pcore is not None:
+                    remapped_cluster.add_new_cluster(Microcluster(cf1=np.copy(pcore.CF1), cf2=np.copy(pcore.CF2),
+                                                                  id=pcore_id,
+                                                                  cumulative_weight=pcore.cumulative_weight))
+            remapped_cluster.update_preferred_dimensions(self.delta_squared, self.k)
+
+            if remapped_cluster.cumulative_weight > 0:
+                remapped_clusters.append(remapped_cluster)
+        self.final_clusters = remapped_clusters
+
+    def _get_optional_config(self, name, default, value_type):
+        """
+        Get the value of an optional element of the config. These are read when needed rather than when hddstream is
+        created so a program state restored with a new config picks them up.
+
+        Args:
+            name (str): Name of the config element.
+            default: Value to use if the element is not in the config.
+            value_type (type): Type to convert the element's text to.
+
+        Returns:
+            Value of the config element.
+        """
+        element = self.config.find(name)
+        if element is None:
+            return default
+        return value_type(element.text)
+
+    def _set_up_microcluster_indices(self):
+        """
+        Set up the spatial index over the centroids of the pcore and outlier microclusters, if enabled in the config. The grid cells are by default 1.25 times as wide as the furthest a point can be from a new outlier
+        microcluster and still be added to it, so outlier microclusters only become wide microclusters once their
+        weight has decayed below about a quarter.
+
+        Returns:
+            None.
+        """
+        use_index = self._get_optional_config("spatial_index", 0, int) > 0
+        cell_width = self._get_index_cell_width()
+
+        for microclusters in (self.pcore_MC, self.outlier_MC):
+            microclusters.index = MicroclusterIndex(microclusters, cell_width, self.epsilon_squared, self.k) \
+                if use_index else None
+
+    def _get_index_cell_width(self):
+        """
+        Get the width of the grid cells of the spatial index. See _set_up_microcluster_indices.
+
+        Returns:
+            float: The width.
+        """
+        default_cell_width = 2.5 * np.sqrt(max(self.k, 1.0) * self.epsilon_squared)
+        return self._get_optional_config("index_cell_width", default_cell_width, float)
+
+    def _add_datapoints(self, datapoints, datapoints_timestamp, first_datapoint_index=0):
+        """
+        Add points one after the other (or one block after the other in batch mode) to the microclusters.
+
+        Args:
+            datapoints (numpy.array): 2d array, each row containing a point.
+            datapoints_timestamp (int): Timestamp of the points.
+            first_datapoint_index (int, optional): Row of the first point in the input dataset. The others follow it.
+
+        Returns:
+            None.
+        """
+        num_datapoints = datapoints.shape[0]
+        batch_size = self._get_optional_config("batch_size", 1, int)
+
         # progress bar widget
         progress_bar = TqdmToLogger(self.logger, level=logging.INFO)
-        for row in tqdm(range(num_datapoints), file=progress_bar, mininterval=1):
-            # You may find sometimes the progress line doesn't work well. In that case uncomment below.
-            datapoint = input_dataset[row]
+        if batch_size > 1:
+            with tqdm(total=num_datapoints, file=progress_bar, mininterval=1) as progress:
+                for row in range(0, num_datapoints, batch_size):
+                    block = datapoints[row:row + batch_size]
+                    self._add_datapoints_in_batch(block, datapoints_timestamp, first_datapoint_index + row)
+                    progress.update(len(block))
+        else:
+            for row in tqdm(range(num_datapoints), file=progress_bar, mininterval=1):
+                self._add_datapoint(datapoints[row], datapoints_timestamp, first_datapoint_index + row)
 
-            # trial1 contains boolean that indicates whether the point has successfully been added to a potential
-            # microcluster. See Figure 1 in paper[1].
-            trial1 = self._add_to_pcore(datapoint, input_dataset_daystamp)
-            trial2 = False
+    def _add_datapoints_in_shards(self, input_dataset, input_dataset_daystamp, num_shards):
+        """
+        Add points to the microclusters in parallel. This is an approximation of adding them one after the other.
 
-            if not trial1:
-                # code will get here if the point cannot be added to any potential microcluster. In this case we'll
-                # see if we can add it to an outlier microcluster
-                trial2 = self._add_to_outlier(datapoint, input_dataset_daystamp)
+        The points are split into contiguous shards, each added by a separate process to its own copy of the
+        microclusters as they were before the time point. The shards are then merged into the microclusters: points a
+        shard added to an existing microcluster are added to it, as CF1, CF2 and weight are additive. Microclusters
+        created by different shards are merged together if the result stays within the radius threshold (see
+        _merge_new_microclusters), and become pcore microclusters if they meet the conditions for it.
 
-            # No need to check if trial2 is none as it won't even get there if trial1 is true.
-            if not trial1 and not trial2:
-                # We create a new outlier cluster for the datapoint.
-                self._create_new_outlier_cluster(datapoint, input_dataset_daystamp)
+        If the shard_divergence_check config element is set, the points are also added one after the other to a copy
+        of the microclusters, and how far the result of the shards is from it is logged.
 
-        self.logger.info("Finish online microcluster maintenance for timepoint {}".format(input_dataset_daystamp))
-        self.logger.info("Online maintenance yield {} pcores and {} outlier".format(
-            len(self.pcore_MC), len(self.outlier_MC)))
+        Args:
+            input_dataset (numpy.array): 2d array containing input dataset for a given point in time.
+            input_dataset_daystamp (int): timestamp of the input dataset in day i.e. day 1, day 2, etc.
+            num_shards (int): Number of shards to split the points into.
 
-        self.last_data_timestamp = input_dataset_daystamp
+        Returns:
+            None.
+        """
+        sequential = None
+        if self._get_optional_config("shard_divergence_check", 0, int) > 0:
+            sequential = copy.deepcopy(self)
+            sequential.set_config(self.config)
+            sequential.set_logger(self.logger)
+            sequential._set_up_microcluster_indices()
+            sequential._set_up_jit()
+
+        boundaries = np.linspace(0, input_dataset.shape[0], num_shards + 1).astype(int).tolist()
+        config_as_string = et.tostring(self.config)
+        self.logger.info("Adding points in {} shards".format(num_shards))
+        with ProcessPoolExecutor(max_workers=min(num_shards, os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(add_datapoints_in_shard, self, config_as_string, input_dataset[start:end],
+                                       input_dataset_daystamp, start)
+                       for start, end in zip(boundaries[:-1], boundaries[1:])]
+            shards = [future.result() for future in futures]
+        self._merge_shards(shards, input_dataset)
+
+        if sequential is not None:
+            sequential._add_datapoints(input_dataset, input_dataset_daystamp)
+            self._log_shard_divergence(sequential, input_dataset.shape[0])
+
+    def _merge_shards(self, shards, input_dataset):
+        """
+        Merge the microclusters of the shards into these microclusters. See _add_datapoints_in_shards.
+
+        Args:
+            shards (list): HDDStream of each shard, in order, after adding its points.
+            input_dataset (numpy.array): 2d array containing input dataset for a given point in time.
+
+        Returns:
+            None.
+        """
+        first_new_id = self.next_microcluster_id
+        existing = {next(iter(microcluster.id)): microcluster
+                    for microcluster in list(self.pcore_MC) + list(self.outlier_MC)}
+        num_existing_points = {microcluster_id: len(microcluster.point_indices)
+                               for microcluster_id, microcluster in existing.items()}
+
+        changed = {}
+        new_microclusters = []
+        for shard_number, shard in enumerate(shards):
+            shard_microclusters = sorted(list(shard.pcore_MC) + list(shard.outlier_MC),
+                                         key=lambda microcluster: next(iter(microcluster.id)))
+            for microcluster in shard_microclusters:
+                microcluster_id = next(iter(microcluster.id))
+                if microcluster_id >= first_new_id:
+                    new_microclusters.append((shard_number, microcluster))
+                    continue
+
+                new_point_indices = microcluster.point_indices[num_existing_points[microcluster_id]:]
+                if len(new_point_indices) > 0:
+                    points = input_dataset[np.frombuffer(new_point_indices, dtype=np.int64)]
+                    existing_microcluster = existing[microcluster_id]
+                    existing_microcluster.CF1 = existing_microcluster.CF1 + points.sum(axis=0)
+                    existing_microcluster.CF2 = existing_microcluster.CF2 + (points ** 2).sum(axis=0)
+                    existing_microcluster.cumulative_weight += len(points)
+                    existing_microcluster.point_indices.extend(new_point_indices)
+                    changed[microcluster_id] = existing_microcluster
+
+        for microcluster in changed.values():
+            microcluster.set_centroid()
+            microcluster.update_preferred_dimensions(self.delta_squared, self.k)
+            if microcluster in self.outlier_MC:
+                self._upgrade_outlier_microcluster(microcluster)
+
+        for microcluster in self._merge_new_microclusters(new_microclusters, len(shards)):
+            # As when adding points one after the other, an outlier microcluster is only upgraded once it is given
+            # points after the one it was created for.
+            if len(microcluster.point_indices) > 1 and microcluster.cumulative_weight >= self.beta * self.mu and \
+                    microcluster.pdim <= self.pi:
+                microcluster.id = [self._new_microcluster_id()]
+                self.pcore_MC.append(microcluster)
+            else:
+                microcluster.id = {self._new_microcluster_id()}
+                self.outlier_MC.append(microcluster)
+
+    def _merge_new_microclusters(self, new_microclusters, num_shards):
+        """
+        Merge together microclusters created by different shards. Going through them in order, a microcluster is
+        merged into the closest (projected distance between centroids) of the microclusters kept so far that the
+        shards it came from did not create, and whose projected radius stays within the radius threshold after merging
+        it. It is kept as is if there is none.
+
+        Args:
+            new_microclusters (list): The microclusters created by each shard, as tuples of the shard's number and the
+                microcluster. Ordered by shard, then by creation.
+            num_shards (int): Number of shards.
+
+        Returns:
+            list: The merged microclusters, holding their own values. Their ids are not set.
+        """
+        num_dimensions = self.dataset_dimensionality
+        cf1 = np.zeros((len(new_microclusters), num_dimensions))
+        cf2 = np.zeros((len(new_microclusters), num_dimensions))
+        cumulative_weight = np.zeros(len(new_microclusters))
+        centroids = np.zeros((len(new_microclusters), num_dimensions))
+        preferred_dimension_vector = np.ones((len(new_microclusters), num_dimensions))
+        from_shard = np.zeros((len(new_microclusters), num_shards), dtype=bool)
+        creation_time = []
+        point_indices = []
+
+        num_kept = 0
+        for shard_number, microcluster in new_microclusters:
+            merged_into = None
+            if num_kept > 0:
+                weight = cumulative_weight[:num_kept, np.newaxis] + microcluster.cumulative_weight
+                variance = ((cf2[:num_kept] + microcluster.CF2) / weight) - \
+                           ((cf1[:num_kept] + microcluster.CF1) / weight) ** 2
+                radius_squared = (variance / np.where(variance <= self.delta_squared, self.k, 1.0)).sum(axis=1)
+                distance = (((centroids[:num_kept] - microcluster.cluster_centroids) ** 2) /
+                            preferred_dimension_vector[:num_kept]).sum(axis=1)
+                distance[from_shard[:num_kept, shard_number] | (radius_squared > self.epsilon_squared)] = np.inf
+                closest = int(np.argmin(distance))
+                if np.isfinite(distance[closest]):
+                    merged_into = closest
+
+            if merged_into is None:
+                merged_into = num_kept
+                num_kept += 1
+                creation_time.append(microcluster.creation_time_in_hrs)
+                point_indices.append(array('q'))
+
+            cf1[merged_into] += microcluster.CF1
+            cf2[merged_into] += microcluster.CF2
+            cumulative_weight[merged_into] += microcluster.cumulative_weight
+            centroids[merged_into] = cf1[merged_into] / cumulative_weight[merged_into]
+            variance = (cf2[merged_into] / cumulative_weight[merged_into]) - centroids[merged_into] ** 2
+            preferred_dimension_vector[merged_into] = np.where(variance <= self.delta_squared, self.k, 1.0)
+            from_shard[merged_into, shard_number] = True
+            point_indices[merged_into].extend(microcluster.point_indices)
+
+        merged_microclusters = []
+        for row in range(num_kept):
+            microcluster = Microcluster(cf1=cf1[row], cf2=cf2[row], cumulative_weight=cumulative_weight[row],
+                                        creation_time_in_hrs=creation_time[row])
+            microcluster.set_centroid()
+            microcluster.update_preferred_dimensions(self.delta_squared, self.k)
+            microcluster.point_indices = point_indices[row]
+            merged_microclusters.append(microcluster)
+        return merged_microclusters
+
+    def _log_shard_divergence(self, sequential, num_datapoints):
+        """
+        Log how far the microclusters obtained by adding points in shards are from those obtained by adding them one
+        after the other.
+
+        Args:
+            sequential (HDDStream): Copy of this HDDStream to which the points were added one after the other.
+            num_datapoints (int): Number of points added.
+
+        Returns:
+            None.
+        """
+        def get_point_assignment(hddstream):
+            # Label each point with the microcluster it was added to (or -1 if it was not added to any).
+            labels = np.full(num_datapoints, -1)
+            in_pcore = np.zeros(num_datapoints, dtype=bool)
+            for label, microcluster in enumerate(list(hddstream.pcore_MC) + list(hddstream.outlier_MC)):
+                indices = np.frombuffer(microcluster.point_indices, dtype=np.int64)
+                labels[indices] = label
+                in_pcore[indices] = label < len(hddstream.pcore_MC)
+            return labels, in_pcore
+
+        sharded_labels, sharded_in_pcore = get_point_assignment(self)
+        sequential_labels, sequential_in_pcore = get_point_assignment(sequential)
+        self.logger.info("Divergence of sharded online maintenance from sequential:\n"
+                         "pcores = {} (sequential {})\n"
+                         "outliers = {} (sequential {})\n"
+                         "fraction of points in pcores = {:.4f} (sequential {:.4f})\n"
+                         "adjusted Rand index of the points' microclusters = {:.4f}".format(
+                             len(self.pcore_MC), len(sequential.pcore_MC), len(self.outlier_MC),
+                             len(sequential.outlier_MC), sharded_in_pcore.mean(), sequential_in_pcore.mean(),
+                             adjusted_rand_score(sequential_labels, sharded_labels)))
+
+    def _add_datapoints_in_regions(self, input_dataset, input_dataset_daystamp, num_regions):
+        """
+        Add points to the microclusters in parallel, giving exactly the same result as adding them one after the other
+        with _add_datapoint in the order set by _get_region_insertion_order: the points of each region in turn, then
+        the points on the borders between regions.
+
+        Each region is handed to a separate process, which adds its points to its own copy of the microclusters as they
+        were before the time point and records the decisions made for each point (see _record_datapoint_insertion).
+        Going through the regions in order, these decisions are then replayed on these microclusters, which only costs
+        updating the microclusters the points are added to. A decision is only replayed if the microclusters touched
+        by the earlier regions can't have changed it (see _is_record_invalidated). From the first point for which they
+        may have, the rest of the region is added one point at a time. The border points are added one at a time last.
+
+        Args:
+            input_dataset (numpy.array): 2d array containing input dataset for a given point in time.
+            input_dataset_daystamp (int): timestamp of the input dataset in day i.e. day 1, day 2, etc.
+            num_regions (int): Number of regions to split the points into.
+
+        Returns:
+            None.
+        """
+        regions, border = self._get_region_insertion_order(input_dataset, num_regions)
+
+        first_new_id = self.next_microcluster_id
+        existing = {next(iter(microcluster.id)): microcluster
+                    for microcluster in list(self.pcore_MC) + list(self.outlier_MC)}
+        num_existing_points = {microcluster_id: len(microcluster.point_indices)
+                               for microcluster_id, microcluster in existing.items()}
+
+        config_as_string = et.tostring(self.config)
+        self.logger.info("Adding points in {} regions, with {} points on their borders".format(num_regions,
+                                                                                              len(border)))
+        num_replayed = 0
+        with ProcessPoolExecutor(max_workers=min(num_regions, os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(record_insertions_in_region, self, config_as_string, input_dataset[indices],
+                                       indices, input_dataset_daystamp)
+                       for indices in regions]
+            # Regions are replayed as soon as they and all those before them are done.
+            for indices, future in zip(regions, futures):
+                num_replayed += self._replay_region(input_dataset, input_dataset_daystamp, indices, future.result(),
+                                                    existing, num_existing_points, first_new_id)
+
+        for datapoint_index in border.tolist():
+            self._add_datapoint(input_dataset[datapoint_index], input_dataset_daystamp, datapoint_index)
+
+        self.logger.info("Replayed the decisions of the regions for {} points, added {} points of the regions one at "
+                         "a time".format(num_replayed, input_dataset.shape[0] - len(border) - num_replayed))
+
+    def _get_region_insertion_order(self, input_dataset, num_regions):
+        """
+        Split the points into regions for _add_datapoints_in_regions. The regions are slabs along the dimension the
+        points are the most spread out along, holding about as many points each. Each point belongs to the region of
+        the centroid of its closest microcluster (projected distance), or of itself if there is no microcluster.
+
+        Points closer than the width of a grid cell of the spatial index to the border between two regions, or in a
+        different region than their closest microcluster, are likely to be added to a microcluster also touched by
+        the points of another region. They are set aside as border points.
+
+        Args:
+            input_dataset (numpy.array): 2d array containing input dataset for a given point in time.
+            num_regions (int): Number of regions to split the points into.
+
+        Returns:
+            tuple: List containing, for each region, a 1d array of the rows of its points in the input dataset in
+                increasing order, and a 1d array of the rows of the border points in increasing order.
+        """
+        anchors = input_dataset
+        stores = [microclusters for microclusters in (self.pcore_MC, self.outlier_MC) if len(microclusters) > 0]
+        if len(stores) > 0:
+            centroids = np.concatenate([microclusters.cluster_centroids[microclusters.rows] for microclusters in stores])
+            preferred_dimension_vectors = np.concatenate([microclusters.preferred_dimension_vector[microclusters.rows]
+                                                          for microclusters in stores])
+            closest, _ = closest_centroids(input_dataset, centroids, preferred_dimension_vectors, divide=True)
+            anchors = centroids[closest]
+
+        border_width = np.sqrt(max(self.k, 1.0) * self.epsilon_squared)
+        num_border = None
+        for candidate_dimension in range(input_dataset.shape[1]):
+            candidate_boundaries = self._get_region_boundaries(input_dataset[:, candidate_dimension],
+                                                               anchors[:, candidate_dimension], num_regions,
+                                                               border_width)
+            is_candidate_border = self._is_region_border(input_dataset[:, candidate_dimension],
+                                                         anchors[:, candidate_dimension], candidate_boundaries,
+                                                         border_width)
+            if num_border is None or is_candidate_border.sum() < num_border:
+                num_border = is_candidate_border.sum()
+                dimension, boundaries, is_border = candidate_dimension, candidate_boundaries, is_candidate_border
+
+        region = np.searchsorted(boundaries, anchors[:, dimension], side='right')
+        regions = [np.flatnonzero((region == region_number) & ~is_border) for region_number in range(num_regions)]
+        return regions, np.flatnonzero(is_border)
+
+    @staticmethod
+    def _get_region_boundaries(values, anchor_values, num_regions, border_width):
+        """
+        Place the borders between regions along a dimension. Each border is placed where the fewest points are within
+        border_width of it, between the quantiles of the anchors half a region before and after the even split.
+
+        Args:
+            values (numpy.array): Value of each point along the dimension.
+            anchor_values (numpy.array): Value of the anchor of each point along the dimension.
+            num_regions (int): Number of regions.
+            border_width (float): Distance to a border within which points are border points.
+
+        Returns:
+            numpy.array: Sorted values of the borders.
+        """
+        sorted_values = np.sort(values)
+        boundaries = []
+        for region_number in range(1, num_regions):
+            lowest, highest = np.quantile(anchor_values, [(region_number - 0.5) / num_regions,
+                                                          (region_number + 0.5) / num_regions])
+            candidates = np.linspace(lowest, highest, 33)
+            crowding = np.searchsorted(sorted_values, candidates + border_width) - \
+                np.searchsorted(sorted_values, candidates - border_width)
+            boundaries.append(candidates[np.argmin(crowding)])
+        return np.maximum.accumulate(boundaries)
+
+    @staticmethod
+    def _is_region_border(values, anchor_values, boundaries, border_width):
+        """
+        Find the border points: those closer than border_width to a border, or not in the same region as their anchor.
+
+        Args:
+            values (numpy.array): Value of each point along the dimension.
+            anchor_values (numpy.array): Value of the anchor of each point along the dimension.
+            boundaries (numpy.array): Sorted values of the borders.
+            border_width (float): Distance to a border within which points are border points.
+
+        Returns:
+            numpy.array: Boolean array, True for each border point.
+        """
+        distance_to_boundary = np.abs(values[:, np.newaxis] - boundaries).min(axis=1)
+        return (distance_to_boundary < border_width) | \
+            (np.searchsorted(boundaries, values, side='right') != np.searchsorted(boundaries, anchor_values,
+                                                                                   side='right'))
+
+    def _replay_region(self, input_dataset, input_dataset_daystamp, datapoint_indices, records, existing,
+                       num_existing_points, first_new_id):
+        """
+        Replay the decisions recorded for the points of a region, until one of them may have been changed by the
+        microclusters touched by the earlier regions. The rest of the points are added one at a time.
+
+        Args:
+            input_dataset (numpy.array): 2d array containing input dataset for a given point in time.
+            input_dataset_daystamp (int): timestamp of the input dataset in day i.e. day 1, day 2, etc.
+            datapoint_indices (numpy.array): Rows of the points of the region in the input dataset.
+            records (list): Decisions recorded for each point by _record_datapoint_insertion.
+            existing (dict): Id -> microcluster, for the microclusters which existed before the time point.
+            num_existing_points (dict): Id -> number of points, for the microclusters which existed before the time
+                point.
+            first_new_id (int): Id of the first microcluster created at the time point.
+
+        Returns:
+            int: Number of points whose decisions were replayed.
+        """
+        # Each point of the region takes at most one new row in each store, for an upgraded or new microcluster.
+        touched_ids = set()
+        touched = []
+        for microclusters in (self.pcore_MC, self.outlier_MC):
+            is_touched = np.zeros(microclusters.num_rows + len(datapoint_indices), dtype=bool)
+            for row in microclusters.rows.tolist():
+                microcluster = microclusters[row]
+                microcluster_id = next(iter(microcluster.id))
+                if microcluster_id >= first_new_id or \
+                        len(microcluster.point_indices) > num_existing_points[microcluster_id]:
+                    touched_ids.add(microcluster_id)
+                    is_touched[row] = True
+            touched.append(is_touched)
+        pcore_touched, outlier_touched = touched
+
+        # Id the region gave a microcluster it created -> the microcluster.
+        created = {}
+
+        def get_microcluster(microcluster_id):
+            return created[microcluster_id] if microcluster_id >= first_new_id else existing[microcluster_id]
+
+        datapoint_indices = datapoint_indices.tolist()
+        for position, (datapoint_index, record) in enumerate(zip(datapoint_indices, records)):
+            datapoint = input_dataset[datapoint_index]
+            pcore_search, outlier_search, new_microcluster_id = record
+
+            if self._is_search_invalidated(self.pcore_MC, datapoint, pcore_search, touched_ids, pcore_touched,
+                                           first_new_id, check_pdim=True) or \
+                    (outlier_search is not None and
+                     self._is_search_invalidated(self.outlier_MC, datapoint, outlier_search, touched_ids,
+                                                 outlier_touched, first_new_id, check_pdim=False)):
+                for datapoint_index in datapoint_indices[position:]:
+                    self._add_datapoint(input_dataset[datapoint_index], input_dataset_daystamp, datapoint_index)
+                return position
+
+            if pcore_search[0]:
+                pcore_mc = get_microcluster(pcore_search[1])
+                self._add_point_to_microcluster(self.pcore_MC, pcore_mc._row, datapoint, datapoint_index)
+            elif outlier_search[0]:
+                outlier_mc = get_microcluster(outlier_search[1])
+                self._add_point_to_microcluster(self.outlier_MC, outlier_mc._row, datapoint, datapoint_index)
+                self._upgrade_outlier_microcluster(outlier_mc)
+            else:
+                row = self._create_new_outlier_cluster(datapoint, input_dataset_daystamp, datapoint_index)
+                created[new_microcluster_id] = self.outlier_MC[row]
+
+        return len(datapoint_indices)
+
+    def _is_search_invalidated(self, microclusters, datapoint, search, touched_ids, touched, first_new_id, check_pdim):
+        """
+        Check whether a search for the closest microcluster recorded by a region (see _record_datapoint_insertion)
+        may have given another result had the microclusters touched by the earlier regions been as they are now.
+
+        The microclusters not touched by the earlier regions are as the region saw them. The search gives the same
+        result if the closest microcluster it found is one of them, and if no touched microcluster is now as close
+        (when the point was added to the closest microcluster) or can now take the point (when it wasn't). A tie
+        invalidates the search, as the microclusters created by the region may not be in the same rows here. When many
+        microclusters were touched and they are indexed, only those a query around the point finds are checked, as in
+        _find_closest_microcluster.
+
+        Args:
+            microclusters (MicroclusterStore): Microclusters searched.
+            datapoint (numpy.array): The point.
+            search (tuple): The search, as recorded by _record_datapoint_insertion.
+            touched_ids (set): Ids of the microclusters touched by the earlier regions.
+            touched (numpy.array): Boolean array, True for the rows of microclusters holding microclusters touched by
+                the earlier regions.
+            first_new_id (int): Id of the first microcluster created at the time point. Regions give the microclusters
+                they create ids from it too, so these can't be told apart from those created by other regions by id.
+            check_pdim (bool): True if only the microclusters whose pdim stays within pi after adding the point can
+                be chosen, as for pcore microclusters.
+
+        Returns:
+            bool: True if the search may have given another result.
+        """
+        added, microcluster_id, distance, tied = search
+        if tied or (microcluster_id is not None and microcluster_id < first_new_id and microcluster_id in touched_ids):
+            return True
+
+        index = microclusters.index
+        rows = np.flatnonzero(touched[:microclusters.num_rows])
+        if index is not None and len(rows) >= self.INDEX_MIN_MICROCLUSTERS:
+            rows = index.get_candidate_rows(datapoint, radius=np.sqrt(distance * index.max_scaling) if added else None)
+            rows = rows[touched[rows]]
+        if len(rows) == 0:
+            return False
+
+        tentative_pdim, touched_distance, tentative_radius_squared = microclusters.get_tentative_insertion(
+            datapoint, self.delta_squared, self.k, rows=rows)
+        possible = tentative_pdim <= self.pi if check_pdim else np.ones(len(rows), dtype=bool)
+        if added:
+            return bool(np.any(possible & (touched_distance <= distance)))
+        return bool(np.any(possible & (tentative_radius_squared <= self.epsilon_squared)))
+
+    def _record_datapoint_insertion(self, datapoint, datapoint_timestamp, datapoint_index):
+        """
+        Add a point as _add_datapoint does, and record the decisions made for _add_datapoints_in_regions. The closest
+        microclusters are searched for among all microclusters, so whether another one was exactly as close is known.
+
+        Args:
+            datapoint (numpy.array): The point.
+            datapoint_timestamp (int): Timestamp of the point.
+            datapoint_index (int): Row of the point in the input dataset.
+
+        Returns:
+            tuple: The search for a pcore microcluster, the search for an outlier microcluster (None if the point was
+                added to a pcore microcluster), and the id of the outlier microcluster created for the point (None if
+                it was added to an existing microcluster). Each search is a tuple of whether the point was added to
+                the closest microcluster, the id of the closest microcluster (None if there is none), its projected
+                distance to the point and whether another microcluster was exactly as close.
+        """
+        added, row, distance, tied = self._search_closest_microcluster(self.pcore_MC, datapoint, check_pdim=True)
+        pcore_search = (added, None if row is None else next(iter(self.pcore_MC[row].id)), distance, tied)
+        if added:
+            self._add_point_to_microcluster(self.pcore_MC, row, datapoint, datapoint_index)
+            return pcore_search, None, None
+
+        added, row, distance, tied = self._search_closest_microcluster(self.outlier_MC, datapoint, check_pdim=False)
+        outlier_search = (added, None if row is None else next(iter(self.outlier_MC[row].id)), distance, tied)
+        if added:
+            outlier_mc = self.outlier_MC[row]
+            self._add_point_to_microcluster(self.outlier_MC, row, datapoint, datapoint_index)
+            self._upgrade_outlier_microcluster(outlier_mc)
+            return pcore_search, outlier_search, None
+
+        row = self._create_new_outlier_cluster(datapoint, datapoint_timestamp, datapoint_index)
+        return pcore_search, outlier_search, next(iter(self.outlier_MC[row].id))
+
+    def _search_closest_microcluster(self, microclusters, datapoint, check_pdim):
+        """
+        Find the closest microcluster to a point among all microclusters, as _find_closest_microcluster_in_rows does.
+
+        Args:
+            microclusters (MicroclusterStore): Microclusters to search.
+            datapoint (numpy.array): The point.
+            check_pdim (bool): True if only the microclusters whose pdim stays within pi after adding the point can
+                be chosen.
+
+        Returns:
+            tuple: Whether the point can be added to the closest microcluster, its row (None if there is none), its
+                projected distance to the point and whether another microcluster is exactly as close.
+        """
+        if len(microclusters) == 0:
+            return False, None, None, False
+
+        tentative_pdim, distance, tentative_radius_squared = microclusters.get_tentative_insertion(
+            datapoint, self.delta_squared, self.k)
+        if check_pdim:
+            distance[tentative_pdim > self.pi] = np.inf
+        # argmin returns the first one if several are equally close. Free rows are infinitely far from any point.
+        closest = int(np.argmin(distance))
+        if np.isinf(distance[closest]):
+            return False, None, None, False
+
+        tied = np.count_nonzero(distance == distance[closest]) > 1
+        return bool(tentative_radius_squared[closest] <= self.epsilon_squared), closest, float(distance[closest]), tied
+
+    def _set_up_jit(self):
+        """
+        Use the Numba kernels (see jit_kernels) for the online microcluster maintenance if enabled in the config.
+        They are not used if Numba is not installed.
+
+        Returns:
+            None.
+        """
+        self.use_jit = self._get_optional_config("jit", 0, int) > 0
+        if self.use_jit and not jit_kernels.AVAILABLE:
+            self.logger.info("WARNING: Numba is not installed. Online microcluster maintenance will not use the jit "
+                             "kernels.")
+            self.use_jit = False
+
+    def _add_datapoint(self, datapoint, datapoint_timestamp, datapoint_index):
+        """
+        Add a point to a pcore microcluster, or to an outlier microcluster if it can't be added to any pcore, or to a
+        new outlier microcluster if it can't be added to any existing microcluster. See Figure 1 in paper[1].
+
+        Args:
+            datapoint (numpy.array): A point represented as an array of values, each containing the point's value for a
+                dimension.
+            datapoint_timestamp (int): Timestamp of the point.
+            datapoint_index (int): Row of the point in the input dataset.
+
+        Returns:
+            None.
+        """
+        # trial1 contains boolean that indicates whether the point has successfully been added to a potential
+        # microcluster. See Figure 1 in paper[1].
+        trial1 = self._add_to_pcore(datapoint, datapoint_index)
+        trial2 = False
+
+        if not trial1:
+            # code will get here if the point cannot be added to any potential microcluster. In this case we'll
+            # see if we can add it to an outlier microcluster
+            trial2 = self._add_to_outlier(datapoint, datapoint_index)
+
+        # No need to check if trial2 is none as it won't even get there if trial1 is true.
+        if not trial1 and not trial2:
+            # We create a new outlier cluster for the datapoint.
+            self._create_new_outlier_cluster(datapoint, datapoint_timestamp, datapoint_index)
+
+    def _add_datapoints_in_batch(self, datapoints, datapoints_timestamp, first_datapoint_index):
+        """
+        Add a block of points, giving exactly the same result as adding them one at a time with _add_datapoint.
+
+        All points are first scored against all microclusters in one go, finding for each point its few closest pcore
+        and outlier microclusters. The points are then committed in order. A microcluster touched (given a point or
+        created) by an earlier point of the block may now be closer, so those are scored again for each point. If all
+        the closest microclusters found in the first step have been touched, or have since been upgraded, the point
+        is handled as by _add_datapoint.
+
+        Args:
+            datapoints (numpy.array): 2d array, each row containing a point.
+            datapoints_timestamp (int): Timestamp of the points.
+            first_datapoint_index (int): Row of the first point in the input dataset. The others follow it.
+
+        Returns:
+            None.
+        """
+        closest_pcore = self._find_closest_microclusters_in_batch(self.pcore_MC, datapoints, check_pdim=True)
+        closest_outlier = self._find_closest_microclusters_in_batch(self.outlier_MC, datapoints, check_pdim=False)
+
+        # Rows of the microclusters touched so far. Each point takes at most one new row, for an upgraded or new
+        # microcluster, and the rows freed by upgraded microclusters are touched too.
+        pcore_touched = np.zeros(self.pcore_MC.num_rows + len(datapoints), dtype=bool)
+        outlier_touched = np.zeros(self.outlier_MC.num_rows + len(datapoints), dtype=bool)
+        touched_pcore_rows = []
+        touched_outlier_rows = []
+
+        for row, datapoint in enumerate(datapoints):
+            datapoint_index = first_datapoint_index + row
+            pcore_index, radius_squared = self._resolve_closest_microcluster_in_batch(
+                self.pcore_MC, datapoint, [values[row] for values in closest_pcore], pcore_touched,
+                touched_pcore_rows, check_pdim=True)
+
+            if pcore_index is not None and radius_squared <= self.epsilon_squared:
+                self._add_point_to_microcluster(self.pcore_MC, pcore_index, datapoint, datapoint_index)
+                if not pcore_touched[pcore_index]:
+                    pcore_touched[pcore_index] = True
+                    bisect.insort(touched_pcore_rows, pcore_index)
+                continue
+
+            outlier_index, radius_squared = self._resolve_closest_microcluster_in_batch(
+                self.outlier_MC, datapoint, [values[row] for values in closest_outlier], outlier_touched,
+                touched_outlier_rows, check_pdim=False)
+
+            if outlier_index is not None and radius_squared <= self.epsilon_squared:
+                outlier_mc = self.outlier_MC[outlier_index]
+                self._add_point_to_microcluster(self.outlier_MC, outlier_index, datapoint, datapoint_index)
+                if self._upgrade_outlier_microcluster(outlier_mc):
+                    pcore_index = outlier_mc._row
+                    if not pcore_touched[pcore_index]:
+                        pcore_touched[pcore_index] = True
+                        bisect.insort(touched_pcore_rows, pcore_index)
+            else:
+                outlier_index = self._create_new_outlier_cluster(datapoint, datapoints_timestamp, datapoint_index)
+
+            if not outlier_touched[outlier_index]:
+                outlier_touched[outlier_index] = True
+                bisect.insort(touched_outlier_rows, outlier_index)
+
+    def _find_closest_microclusters_in_batch(self, microclusters, datapoints, check_pdim):
+        """
+        Find the BATCH_CANDIDATES closest microclusters to each of several points, their projected distance to the
+        point, and the squared projected radius they would have after adding the point.
+
+        Args:
+            microclusters (MicroclusterStore): Microclusters to search.
+            datapoints (numpy.array): 2d array, each row containing a point.
+            check_pdim (bool): True if only the microclusters whose pdim stays within pi after adding the point can
+                be chosen, as for pcore microclusters.
+
+        Returns:
+            tuple: Three 2d numpy.array with a row per point, containing the index of the closest microclusters
+                ordered from the closest (NOT_A_CANDIDATE for those whose pdim would exceed pi), their projected
+                distance to the point and their squared projected radius after adding the point.
+        """
+        num_candidates = min(self.BATCH_CANDIDATES, microclusters.num_rows)
+        if num_candidates == 0:
+            empty = np.zeros((len(datapoints), 0))
+            return empty.astype(int), empty, empty
+
+        distance = microclusters.get_projected_dist_to_points(datapoints)
+        if num_candidates < microclusters.num_rows:
+            candidate_index = np.argpartition(distance, num_candidates - 1, axis=1)[:, :num_candidates]
+        else:
+            candidate_index = np.tile(np.arange(num_candidates), (len(datapoints), 1))
+        candidate_distance = np.take_along_axis(distance, candidate_index, axis=1)
+
+        # Order the candidates by distance. Ties go to the microcluster that comes first, as in the one point at a
+        # time search.
+        order = np.lexsort((candidate_index, candidate_distance))
+        candidate_index = np.take_along_axis(candidate_index, order, axis=1)
+        candidate_distance = np.take_along_axis(candidate_distance, order, axis=1)
+
+        tentative_pdim, _, candidate_radius_squared = microclusters.get_tentative_insertion(
+            np.repeat(datapoints, num_candidates, axis=0), self.delta_squared, self.k, rows=candidate_index.ravel())
+        candidate_radius_squared = candidate_radius_squared.reshape(candidate_index.shape)
+
+        if check_pdim:
+            # Checking the pdim of the candidates only rather than of all microclusters is enough. The point can't
+            # be added to the candidates with too high pdim, which are then skipped when looking for the closest.
+            candidate_index[tentative_pdim.reshape(candidate_index.shape) > self.pi] = self.NOT_A_CANDIDATE
 
-        self.offline_clustering(input_dataset_daystamp)
+        return candidate_index, candidate_distance, candidate_radius_squared
+
+    def _resolve_closest_microcluster_in_batch(self, microclusters, datapoint, candidates, touched, touched_rows,
+                                               check_pdim):
+        """
+        Find the closest microcluster to a point of a block given the closest ones found when the block started.
+        Untouched microclusters have not changed since then, so the closest of them is the first untouched
+        candidate, and only the touched ones need scoring again. Rows freed during the block are touched, and free
+        rows are infinitely far from any point.
+
+        Args:
+            microclusters (MicroclusterStore): Microclusters to search.
+            datapoint (numpy.array): The point.
+            candidates (list): The closest microclusters when the block started, as returned for the point by
+                _find_closest_microclusters_in_batch. Values are sorted by distance.
+            touched (numpy.array): Boolean array, True for each microcluster touched since the block started.
+            touched_rows (list): Sorted indices of the microclusters touched since the block started.
+            check_pdim (bool): True if only the microclusters whose pdim stays within pi after adding the point can
+                be chosen, as for pcore microclusters.
+
+        Returns:
+            tuple: Index of the closest microcluster (None if there is none) and its squared projected radius after
+                adding the point.
+        """
+        candidate_index, candidate_distance, candidate_radius_squared = candidates
+
+        closest_index, closest_distance, closest_radius_squared = -1, np.inf, np.inf
+        closest_untouched_known = len(candidate_index) == 0
+        for index, distance, radius_squared in zip(candidate_index, candidate_distance, candidate_radius_squared):
+            if index >= 0 and not touched[index]:
+                closest_index, closest_distance, closest_radius_squared = index, distance, radius_squared
+                # A microcluster which is not a candidate may be as close as the last candidate and come first.
+                closest_untouched_known = distance < candidate_distance[-1]
+                break
+
+        if not closest_untouched_known:
+            # We don't know which untouched microcluster is now the closest. Search them all.
+            return self._find_closest_microcluster(microclusters, datapoint, check_pdim)
+
+        if len(touched_rows) > 0:
+            touched_rows = np.array(touched_rows)
+            distance = microclusters.get_projected_dist_to_point(datapoint, rows=touched_rows)
+
+            # Only the touched microclusters closer than the closest untouched one are worth simulating adding the
+            # point to. Ties go to the microcluster that comes first, as in the one point at a time search.
+            closer = (distance < closest_distance) | ((distance == closest_distance) & (touched_rows < closest_index))
+            if closer.any():
+                closer_rows = touched_rows[closer]
+                tentative_pdim, distance, tentative_radius_squared = microclusters.get_tentative_insertion(
+                    datapoint, self.delta_squared, self.k, rows=closer_rows)
+                if check_pdim:
+                    distance[tentative_pdim > self.pi] = np.inf
+                closest_touched = np.argmin(distance)
+                if np.isfinite(distance[closest_touched]):
+                    closest_index = closer_rows[closest_touched]
+                    closest_distance = distance[closest_touched]
+                    closest_radius_squared = tentative_radius_squared[closest_touched]
+
+        if np.isinf(closest_distance):
+            return None, None
+        return closest_index, closest_radius_squared
+
+    def _find_closest_microcluster(self, microclusters, datapoint, check_pdim):
+        """
+        Find the microcluster closest to a point, and the squared projected radius it would have after adding the
+        point.
+
+        When the microclusters are indexed, only those close enough to the point are scored. Only the microclusters
+        found by a query around the point can take it, so if the closest of them can't, neither can the closest of
+        all microclusters. Otherwise, it is the closest of all microclusters unless another one is closer than
+        sqrt(k * its projected distance) along a grid dimension, which a second query finds.
+
+        Args:
+            microclusters (MicroclusterStore): Microclusters to search.
+            datapoint (numpy.array): The point.
+            check_pdim (bool): True if only the microclusters whose pdim stays within pi after adding the point can
+                be chosen, as for pcore microclusters. See Figure 2 line 3-4 in paper[1].
+
+        Returns:
+            tuple: Index of the closest microcluster (None if there is none, or if the index shows the point can't be
+                added to it) and its squared projected radius after adding the point.
+        """
+        index = microclusters.index
+        if index is None or len(microclusters) < self.INDEX_MIN_MICROCLUSTERS:
+            closest_index, _, radius_squared = self._find_closest_microcluster_in_rows(microclusters, datapoint,
+                                                                                       check_pdim)
+            return closest_index, radius_squared
+
+        rows = index.get_candidate_rows(datapoint)
+        closest_index, distance, radius_squared = self._find_closest_microcluster_in_rows(microclusters, datapoint,
+                                                                                          check_pdim, rows)
+        if closest_index is None or radius_squared > self.epsilon_squared:
+            return None, None
+
+        if distance * index.max_scaling >= index.cell_width ** 2:
+            # A microcluster outside the first query may still be closer.
+            rows = index.get_candidate_rows(datapoint, radius=np.sqrt(distance * index.max_scaling))
+            closest_index, _, radius_squared = self._find_closest_microcluster_in_rows(microclusters, datapoint,
+                                                                                       check_pdim, rows)
+        return closest_index, radius_squared
+
+    def _find_closest_microcluster_in_rows(self, microclusters, datapoint, check_pdim, rows=None):
+        """
+        Find which of some microclusters is the closest to a point. See _find_closest_microcluster.
+
+        Args:
+            microclusters (MicroclusterStore): Microclusters to search.
+            datapoint (numpy.array): The point.
+            check_pdim (bool): True if only the microclusters whose pdim stays within pi after adding the point can
+                be chosen.
+            rows (numpy.array, optional): Sorted rows of the microclusters to search. All microclusters if not given.
+
+        Returns:
+            tuple: Index of the closest microcluster (None if there is none), its projected distance to the point and
+                its squared projected radius after adding the point.
+        """
+        if len(microclusters) == 0 or (rows is not None and len(rows) == 0):
+            return None, None, None
+
+        if self.use_jit:
+            rows = np.arange(microclusters.num_rows) if rows is None else np.asarray(rows, dtype=np.int64)
+            closest, distance, radius_squared = jit_kernels.find_closest_microcluster(
+                microclusters.CF1, microclusters.CF2, microclusters.cumulative_weight, microclusters.cluster_centroids,
+                microclusters.preferred_dimension_vector, rows, datapoint, self.delta_squared, self.k, self.pi,
+                check_pdim)
+            if closest < 0:
+                return None, None, None
+            return rows[closest], distance, radius_squared
+
+        if check_pdim:
+            # We want to just temporarily add the point to each microcluster to see if the point can fit in it by
+            # checking the microcluster's pdim. This is done for all microclusters at once without interfering with
+            # the original microclusters.
+            tentative_pdim, distance, tentative_radius_squared = microclusters.get_tentative_insertion(
+                datapoint, self.delta_squared, self.k, rows=rows)
+            candidate_indices = np.flatnonzero(tentative_pdim <= self.pi)
+            if len(candidate_indices) == 0:
+                return None, None, None
+            # argmin returns the first one if several are equally close.
+            closest = candidate_indices[np.argmin(distance[candidate_indices])]
+        else:
+            distance = microclusters.get_projected_dist_to_point(datapoint, rows=rows)
+            closest = np.argmin(distance)
+
+        # Free rows are infinitely far from any point.
+        if np.isinf(distance[closest]):
+            return None, None, None
+        closest_index = closest if rows is None else rows[closest]
+        if check_pdim:
+            return closest_index, distance[closest], tentative_radius_squared[closest]
+
+        _, _, tentative_radius_squared = microclusters.get_tentative_insertion(datapoint, self.delta_squared, self.k,
+                                                                               rows=[closest_index])
+        return closest_index, distance[closest], tentative_radius_squared[0]
+
+    def _add_point_to_microcluster(self, microclusters, row, datapoint, datapoint_index):
+        """
+        Add a point to a microcluster and update its preferred dimensions.
+
+        Args:
+            microclusters (MicroclusterStore): Microclusters the microcluster is in.
+            row (int): Row of the microcluster.
+            datapoint (numpy.array): The point.
+            datapoint_index (int): Row of the point in the input dataset.
+
+        Returns:
+            None.
+        """
+        microcluster = microclusters[row]
+        if self.use_jit:
+            jit_kernels.add_point(microclusters.CF1, microclusters.CF2, microclusters.cumulative_weight,
+                                  microclusters.cluster_centroids, microclusters.preferred_dimension_vector,
+                                  microclusters.pdim, row, datapoint, self.delta_squared, self.k)
+            microcluster.point_indices.append(datapoint_index)
+            microclusters.mark_changed(row)
+        else:
+            microcluster.add_new_point(datapoint, datapoint_index)
+            microcluster.update_preferred_dimensions(self.delta_squared, self.k)
 
     def _decay_clusters_weight(self, interval):
         """
@@ -246,11 +1288,9 @@ class HDDStream(object):
         Returns:
             None.
         """
-        for pcore in self.pcore_MC:
-            self.decay_a_cluster_weight(interval, pcore)
-
-        for outlier_mc in self.outlier_MC:
-            self.decay_a_cluster_weight(interval, outlier_mc)
+        decay_factor = 2 ** (-self.lambbda * interval)
+        self.pcore_MC.decay(decay_factor)
+        self.outlier_MC.decay(decay_factor)
 
     def decay_a_cluster_weight(self, interval, microcluster):
         """
@@ -269,57 +1309,31 @@ class HDDStream(object):
         microcluster.CF2 *= decay_factor
         microcluster.cumulative_weight *= decay_factor
 
-    def _add_to_pcore(self, datapoint, datapoint_timestamp):
+    def _add_to_pcore(self, datapoint, datapoint_index):
         """
         Add point (datapoint) to a pcore microcluster.
         Args:
             datapoint (numpy.array): A point represented as an array of values, each containing the point's value for a
                 dimension.
+            datapoint_index (int): Row of the point in the input dataset.
 
         Returns:
             bool: False if addition failed i.e. some conditions are not met, True if addition was performed.
         """
-        closest_distance = None
-        closest_cluster_index = None
-
-        # calculate distances between datapoint and all pcore MCs.
-        for index, pmc in enumerate(self.pcore_MC):
+        closest_cluster_index, projected_radius_squared = self._find_closest_microcluster(self.pcore_MC, datapoint,
+                                                                                          check_pdim=True)
 
-            # In the Figure 2 paper[1] line 3-4,
-            # we want to just temporarily add data_autoencoder point to each microcluster to
-            # see if the datapoint can fit in it by checking the microcluster's pdim. We don't want to interfere the
-            # original microcluster, so we clone it and pretend to add a point it.
-            temp_pmc = pmc.get_copy_with_new_point(datapoint, self.delta_squared, self.k)
-
-            pdim_temp_pmc = (np.array(temp_pmc.preferred_dimension_vector) != 1).sum()
-
-            if pdim_temp_pmc <= self.pi:
-                # Rather than keeping array of potential microclusters, we just calculate distance to it, and compare
-                # to see if there has been one that was closer before. If there hasn't
-                # then store this as closest. Otherwise leave it.
-                distance = pmc.get_projected_dist_to_point(datapoint)
-                if closest_distance is None or distance < closest_distance:
-                    closest_distance = distance
-                    closest_cluster_index = index
-
-        if closest_distance is not None:
+        if closest_cluster_index is not None:
             # We got here when there exists a potential microcluster that can accomodate the point. We then check to
             # see if the potential microcluster can actually accomodate the point i.e. its radius will not blow out
             # beyond the radius threshold. See line 14-15 in Figure 2 paper[1].
-            tmp_closest_cluster = self.pcore_MC[closest_cluster_index].get_copy_with_new_point(datapoint,
-                                                                                               self.delta_squared,
-                                                                                               self.k)
-            projected_radius_squared = tmp_closest_cluster.calculate_projected_radius_squared()
-
             if projected_radius_squared <= self.epsilon_squared:
 
-                self.pcore_MC[closest_cluster_index].add_new_point(datapoint, datapoint_timestamp)
-                self.pcore_MC[closest_cluster_index].update_preferred_dimensions(self.delta_squared,
-                                                                                 self.k)
+                self._add_point_to_microcluster(self.pcore_MC, closest_cluster_index, datapoint, datapoint_index)
                 return True
         return False
 
-    def _add_to_outlier(self, datapoint, datapoint_timestamp):
+    def _add_to_outlier(self, datapoint, datapoint_index):
         """
         Add a datapoint to outlier microcluster. This can be improved by consolidating it with the add to pcore
         since it's so similar.
@@ -330,34 +1344,21 @@ class HDDStream(object):
         Args:
             datapoint (numpy.array): A point represented as an array of values, each containing a point's value for a
                 dimension.
+            datapoint_index (int): Row of the point in the input dataset.
 
         Returns:
             bool: False if addition failed i.e. some conditions are not met, True if addition was performed.
         """
-        closest_distance = None
-        closest_cluster_index = None
-
         # Find closest outlier microcluster.
-        for index, omc in enumerate(self.outlier_MC):
-            distance = omc.get_projected_dist_to_point(datapoint)
-            if closest_distance is None or distance < closest_distance:
-                closest_distance = distance
-                closest_cluster_index = index
+        closest_cluster_index, projected_radius_squared = self._find_closest_microcluster(self.outlier_MC, datapoint,
+                                                                                          check_pdim=False)
 
-        if closest_distance is not None:
+        if closest_cluster_index is not None:
             # We got here when there exists an outlier microcluster that can accomodate the point. We then check to
             # see if the outlier microcluster can actually accomodate the point i.e. its radius will not blow out
             # beyond the radius threshold.
-
-            tmp_outlier_mc = self.outlier_MC[closest_cluster_index].get_copy_with_new_point(datapoint,
-                                                                                            self.delta_squared,
-                                                                                            self.k)
-            projected_radius_squared = tmp_outlier_mc.calculate_projected_radius_squared()
-
             if projected_radius_squared <= self.epsilon_squared:
-                self.outlier_MC[closest_cluster_index].add_new_point(datapoint, datapoint_timestamp)
-                self.outlier_MC[closest_cluster_index].update_preferred_dimensions(self.delta_squared,
-                                                                                   self.k)
+                self._add_point_to_microcluster(self.outlier_MC, closest_cluster_index, datapoint, datapoint_index)
 
                 # From here on, we then check whether the outlier microcluster can be upgraded to pcore microcluster.
                 self._upgrade_outlier_microcluster(self.outlier_MC[closest_cluster_index])
@@ -377,19 +1378,20 @@ class HDDStream(object):
             outlier_mc (:obj:`Microcluster`): Outlier Microcluster to be upgraded.
 
         Returns:
-            None.
+            bool: True if the outlier microcluster was upgraded, False otherwise.
         """
         weight_threshold_obeyed = outlier_mc.cumulative_weight >= self.beta * \
                                                                    self.mu
-        pdim_threshold_obeyed = np.array(outlier_mc.preferred_dimension_vector > 1).sum() <= \
-                                self.pi
+        pdim_threshold_obeyed = outlier_mc.pdim <= self.pi
 
         if weight_threshold_obeyed and pdim_threshold_obeyed:
-            outlier_mc.id = list(range(len(self.pcore_MC), len(self.pcore_MC) + 1))
-            self.outlier_MC.remove(outlier_mc)
-            self.pcore_MC.append(outlier_mc)
+            # The microcluster keeps its id, as a list like the ids of the other pcore microclusters.
+            outlier_mc.id = [next(iter(outlier_mc.id))]
+            self.outlier_MC.move_rows([outlier_mc._row], self.pcore_MC)
+            return True
+        return False
 
-    def _create_new_outlier_cluster(self, datapoint, creation_time):
+    def _create_new_outlier_cluster(self, datapoint, creation_time, datapoint_index):
         """
         Create a new outlier microcluster for a datapoint and add it to the outlier microcluster list.
 
@@ -397,16 +1399,29 @@ class HDDStream(object):
             datapoint (numpy.array): A point represented as an array of values, each containing a point's value for a
                 dimension.
             creation_time (int): Time when the cluster is created.
+            datapoint_index (int): Row of the point in the input dataset.
 
         Returns:
-            None.
+            int: Row of the new outlier microcluster in outlier_MC.
         """
-        outlier_mc_id = set(range(len(self.outlier_MC), len(self.outlier_MC) + 1))
+        outlier_mc_id = {self._new_microcluster_id()}
         outlier_mc = Microcluster(cf1=np.zeros(len(datapoint)), cf2=np.zeros(len(datapoint)), id=outlier_mc_id,
                                   creation_time_in_hrs=creation_time)
-        outlier_mc.add_new_point(datapoint, creation_time)
+        outlier_mc.add_new_point(datapoint, datapoint_index)
         outlier_mc.update_preferred_dimensions(self.delta_squared, self.k)
         self.outlier_MC.append(outlier_mc)
+        return outlier_mc._row
+
+    def _new_microcluster_id(self):
+        """
+        Hand out the id for a new microcluster. Ids are given in increasing order, so they are unique.
+
+        Returns:
+            int: The id.
+        """
+        microcluster_id = self.next_microcluster_id
+        self.next_microcluster_id += 1
+        return microcluster_id
 
     def offline_clustering(self, dataset_daystamp):
         """
@@ -420,34 +1435,50 @@ class HDDStream(object):
 
         datapoints = {}
 
-        num_core = 0
-        for cluster in self.pcore_MC:
-
-            # For offline clustering, the core status of each cluster is determined by the cluster itself rather than
-            #  by PreDeCon.
+        # For offline clustering, the core status of each cluster is determined by the cluster itself rather than
+        #  by PreDeCon.
+        clusters_are_core = self.pcore_MC.is_core(self.epsilon_squared, self.mu, self.pi)
+        num_core = int(clusters_are_core.sum())
+
+        # PreDeCon assigns the pcores on the border of two clusters to the one expanded first, so the pcores are given
+        # in the order they were created, which doesn't depend on the rows of the store freed and reused along the way.
+        rows = sorted(self.pcore_MC.rows.tolist(), key=lambda row: next(iter(self.pcore_MC[row].id)))
+        for row in rows:
+            cluster = self.pcore_MC[row]
+            cluster_is_core = clusters_are_core[row]
             cluster_id = next(iter(cluster.id))
 
-            cluster_is_core = cluster.is_core(self.epsilon_squared, self.mu,
-                                              self.pi)
-            if cluster_is_core:
-                num_core += 1
-
-            datapoints[cluster_id] = MicroclusterAsDatapoint(datapoint_dimension_values=cluster.cluster_centroids,
-                                                             datapoint_id=cluster_id, is_core_cluster=cluster_is_core,
-                                                             cluster_CF1=cluster.CF1, cluster_CF2=cluster.CF2,
-                                                             cluster_cumulative_weight=cluster.cumulative_weight)
+            # Copies, as the rows of the microcluster store will change once the next dataset is processed.
+            datapoints[cluster_id] = MicroclusterAsDatapoint(
+                datapoint_dimension_values=np.copy(cluster.cluster_centroids), datapoint_id=cluster_id,
+                is_core_cluster=bool(cluster_is_core), cluster_CF1=np.copy(cluster.CF1),
+                cluster_CF2=np.copy(cluster.CF2), cluster_cumulative_weight=cluster.cumulative_weight)
         num_pcore = len(self.pcore_MC) - num_core
         self.logger.info(f'Starting offline clustering with {num_core} core clusters and {num_pcore} pcore clusters.')
 
+        # Unless disabled in the config, only the parts of the last neighbourhood graph affected by the pcores which
+        # were created, deleted or moved are found again.
+        incremental = self._get_optional_config("incremental_offline", 1, int) > 0
         predecon_offline = PreDeCon(datapoints=datapoints, dataset_dimensionality=self.dataset_dimensionality,
                                     epsilon=self.upsilon,
                                     delta=self.delta,
                                     lambbda=self.pi,
                                     mu=self.mu,
-                                    k=self.k)
+                                    k=self.k,
+                                    neighbourhood_graph=self.offline_neighbourhood_graph if incremental else None,
+                                    change_tolerance=self._get_optional_config("offline_change_tolerance", 0.0, float),
+                                    num_workers=self._get_optional_config("offline_workers", 1, int))
         predecon_offline.run()
+        self.logger.info(f'Offline clustering found the neighbourhood of {predecon_offline.num_updated_datapoints} '
+                         f'and expanded the clusters of {predecon_offline.num_expanded_datapoints} out of '
+                         f'{len(datapoints)} pcore clusters.')
 
         self.final_clusters = predecon_offline.clusters
+        self.offline_neighbourhood_graph = predecon_offline.neighbourhood_graph if incremental else None
+        self.offline_pcore_centroids = {cluster_id: datapoint.dimension_values
+                                        for cluster_id, datapoint in datapoints.items()}
+        self.timepoints_since_offline = 0
+        self.offline_requested = False
         self.logger.info('Finish offline clustering for dataset with timepoint: {}'.format(dataset_daystamp))
         self.logger.info("Offline clustering yield {} cores.".format(len(self.final_clusters)))
 
@@ -458,30 +1489,66 @@ class HDDStream(object):
     def _downgrade_potential_microclusters(self):
         """
         Downgrade a potential microcluster if its weight and preferred dimensionality of the cluster conditions are
-        no longer obeyed as in Definition 6 in paper[1].
+        no longer obeyed as in Definition 6 in paper[1]. All the pcore microclusters are checked at once, and those
+        to downgrade are moved to the outlier microclusters together, keeping their id.
         """
-
-        for potential_cluster in self.pcore_MC:
-            weight_threshold_obeyed = potential_cluster.cumulative_weight < self.beta * \
-                                                                             self.mu
-            pdim_threshold_obeyed = np.array(potential_cluster.preferred_dimension_vector > 1).sum() > \
-                                    self.pi
-
-            if weight_threshold_obeyed or pdim_threshold_obeyed:
-
-                potential_cluster.id = list(range(len(self.outlier_MC), len(self.outlier_MC) + 1))
-                self.pcore_MC.remove(potential_cluster)
-                self.outlier_MC.append(potential_cluster)
+        rows = self.pcore_MC.rows
+        weight_threshold_broken = self.pcore_MC.cumulative_weight[rows] < self.beta * self.mu
+        pdim_threshold_broken = self.pcore_MC.pdim[rows] > self.pi
+        self.pcore_MC.move_rows(rows[weight_threshold_broken | pdim_threshold_broken], self.outlier_MC)
 
     def _downgrade_outlier_microclusters(self):
         """
-        Delete outlier microcluster. See section 4.4 in paper [1].
+        Delete outlier microcluster. See section 4.4 in paper [1]. All the outlier microclusters are checked at once,
+        and those to delete are removed together.
         """
-        for outlier_cluster in self.outlier_MC:
+        rows = self.outlier_MC.rows
+        self.outlier_MC.remove_rows(rows[self.outlier_MC.cumulative_weight[rows] <= self.omicron])
 
-            if outlier_cluster.cumulative_weight <= self.omicron:
-                self.outlier_MC.remove(outlier_cluster)
-                del outlier_cluster
+
+def add_datapoints_in_shard(hddstream, config_as_string, datapoints, datapoints_timestamp, first_datapoint_index):
+    """
+    Add a shard of points to a copy of HDDStream's microclusters. Run by the worker processes of
+    HDDStream._add_datapoints_in_shards.
+
+    Args:
+        hddstream (HDDStream): Copy of the HDDStream, as unpickled in the worker process.
+        config_as_string (bytes): HDDStream's config, as xml.
+        datapoints (numpy.array): 2d array, each row containing a point.
+        datapoints_timestamp (int): Timestamp of the points.
+        first_datapoint_index (int): Row of the first point in the input dataset. The others follow it.
+
+    Returns:
+        HDDStream: The HDDStream after adding the points.
+    """
+    hddstream.set_config(et.fromstring(config_as_string))
+    hddstream.set_logger(logging.getLogger(__name__))
+    hddstream._set_up_microcluster_indices()
+    hddstream._set_up_jit()
+    hddstream._add_datapoints(datapoints, datapoints_timestamp, first_datapoint_index)
+    return hddstream
+
+
+def record_insertions_in_region(hddstream, config_as_string, datapoints, datapoint_indices, datapoints_timestamp):
+    """
+    Add the points of a region to a copy of HDDStream's microclusters, recording the decisions made for each point. Run
+    by the worker processes of HDDStream._add_datapoints_in_regions.
+
+    Args:
+        hddstream (HDDStream): Copy of the HDDStream, as unpickled in the worker process.
+        config_as_string (bytes): HDDStream's config, as xml.
+        datapoints (numpy.array): 2d array, each row containing a point of the region.
+        datapoint_indices (numpy.array): Row of each point in the input dataset.
+        datapoints_timestamp (int): Timestamp of the points.
+
+    Returns:
+        list: The decisions made for each point, as returned by HDDStream._record_datapoint_insertion.
+    """
+    hddstream.set_config(et.fromstring(config_as_string))
+    hddstream.set_logger(logging.getLogger(__name__))
+    hddstream._set_up_jit()
+    return [hddstream._record_datapoint_insertion(datapoint, datapoints_timestamp, datapoint_index)
+            for datapoint, datapoint_index in zip(datapoints, datapoint_indices.tolist())]
 
 
 class TqdmToLogger(io.StringIO):
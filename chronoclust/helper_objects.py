@@ -5,7 +5,10 @@ Contain all the objects used in both hddstream and PreDeCon algorithm.
 
 import numpy as np
 
+from array import array
 from decimal import Decimal
+from .kernels import closest_centroids, get_projected_dist_to_point, sum_over_dimensions
+from .microcluster_store import STORED_ATTRIBUTES, VECTOR_ATTRIBUTES, SCALAR_ATTRIBUTES
 
 __author__ = "Givanna Putri, Deeksha Singh, Mark Read, and Tao Tang"
 __copyright__ = "Copyright 2017, Cytoclust Project"
@@ -117,7 +120,55 @@ class Datapoint(object):
         self._classification = 'n'
 
 
+class StoredAttribute(object):
+    def __init__(self, name):
+        """
+        Attribute of a Microcluster which lives in a row of a MicroclusterStore when the microcluster is attached to
+        one, and in the microcluster itself otherwise.
+
+        Args:
+            name (str): Name of the attribute.
+        """
+        self.name = name
+        self.private_name = '_' + name
+
+    def __get__(self, microcluster, owner):
+        if microcluster is None:
+            return self
+        if microcluster._store is None:
+            return microcluster.__dict__.get(self.private_name)
+        return microcluster._store.get_value(self.name, microcluster._row)
+
+    def __set__(self, microcluster, value):
+        if microcluster._store is None:
+            microcluster.__dict__[self.private_name] = value
+        else:
+            microcluster._store.set_value(self.name, microcluster._row, value)
+
+
+class PreferenceAttribute(StoredAttribute):
+    def __set__(self, microcluster, value):
+        """
+        Set the preferred dimension vector, dropping what a microcluster holding its own values has cached about it
+        (see Microcluster.get_preference_summary). The vector must be replaced rather than modified in place for the
+        cache to stay correct.
+        """
+        super().__set__(microcluster, value)
+        microcluster.__dict__.pop('_preference_summary', None)
+
+
 class Microcluster(object):
+    CF1 = StoredAttribute('CF1')
+    CF2 = StoredAttribute('CF2')
+    cumulative_weight = StoredAttribute('cumulative_weight')
+    preferred_dimension_vector = PreferenceAttribute('preferred_dimension_vector')
+    cluster_centroids = StoredAttribute('cluster_centroids')
+    creation_time_in_hrs = StoredAttribute('creation_time_in_hrs')
+
+    # MicroclusterStore this microcluster is a view of, and the row it occupies. None if it holds its own values.
+    _store = None
+    _row = None
+
     def __init__(self, cf1=None, cf2=None, id=set(), cumulative_weight=0,
                  preferred_dimension_vector=None, cluster_centroids=None, creation_time_in_hrs=0):
         """
@@ -144,8 +195,55 @@ class Microcluster(object):
         self.preferred_dimension_vector = preferred_dimension_vector
         self.cluster_centroids = cluster_centroids
         self.creation_time_in_hrs = creation_time_in_hrs
-        self.points = []
-        self.points_timestamp = []
+        # Row, in the dataset of the current time point, of each point added to the microcluster since the time point
+        # started. The points themselves are not kept: they are read from the dataset when needed.
+        self.point_indices = array('q')
+
+    def __setstate__(self, state):
+        """Restore state from the unpickled state values, including those pickled before MicroclusterStore existed."""
+        for name in STORED_ATTRIBUTES:
+            if name in state:
+                state['_' + name] = state.pop(name)
+        # Program states saved before point indices were used kept copies of the points, which can't be mapped back to
+        # rows. They are only used for the time point the state was saved at, so they can be dropped.
+        if 'points' in state:
+            del state['points']
+            state.pop('points_timestamp', None)
+            state['point_indices'] = array('q')
+        self.__dict__.update(state)
+
+    def attach(self, store, row):
+        """
+        Make this microcluster a view of a row in a MicroclusterStore. Only to be called by the store.
+
+        Args:
+            store (MicroclusterStore): Store holding this microcluster's values.
+            row (int): Row of this microcluster in the store.
+
+        Returns:
+            None.
+        """
+        for name in STORED_ATTRIBUTES:
+            self.__dict__.pop('_' + name, None)
+        self.__dict__.pop('_preference_summary', None)
+        self._store = store
+        self._row = row
+
+    def detach(self):
+        """
+        Copy this microcluster's values out of its MicroclusterStore so it holds its own values again. Only to be
+        called by the store.
+
+        Returns:
+            None.
+        """
+        values = {name: np.copy(getattr(self, name)) for name in VECTOR_ATTRIBUTES}
+        for name in SCALAR_ATTRIBUTES:
+            values[name] = getattr(self, name)
+        self._store = None
+        self._row = None
+        for name, value in values.items():
+            setattr(self, name, value)
 
     def update_preferred_dimensions(self, variance_threshold_squared, k_constant):
         """
@@ -161,26 +259,50 @@ class Microcluster(object):
         Returns:
             None.
         """
-        num_dimensions = self.CF1.shape[0]
+        if self._store is not None:
+            self._store.update_preferred_dimensions(variance_threshold_squared, k_constant, rows=self._row)
+            return
 
-        # initialise the dimension preference vector to 1. Initially assume that each dimension has variance greater
-        # than the threshold.
-        self.preferred_dimension_vector = np.ones(num_dimensions)
+        squared_variance = (self.CF2 / self.cumulative_weight) - ((self.CF1 / self.cumulative_weight) ** 2)
+        # A dimension is preferred (k_constant) if its variance is within the threshold, and not preferred (1)
+        # otherwise.
+        self.preferred_dimension_vector = np.where(squared_variance <= variance_threshold_squared, k_constant, 1.0)
 
-        for index in range(num_dimensions):
-            squared_variance = (self.CF2[index] / self.cumulative_weight) - (
-                    (self.CF1[index] / self.cumulative_weight) ** 2)
-            # only need to change the dimension preference to p_k as the list was initially initialised with 1.
-            if squared_variance <= variance_threshold_squared:
-                self.preferred_dimension_vector[index] = k_constant
+    def get_preference_summary(self):
+        """
+        Get the reciprocal of the preferred dimension vector and the preference dimensionality (pdim), which only
+        change when the preferred dimension vector does. A microcluster holding its own values caches them until its
+        preferred dimension vector is set again. The store keeps the pdim of the microclusters it holds.
 
-    def add_new_point(self, new_point_values, new_point_timestamp, new_point_weight=1):
+        Returns:
+            tuple: The reciprocal of the preferred dimension vector (numpy.array) and the pdim (int).
+        """
+        summary = self.__dict__.get('_preference_summary')
+        if summary is None:
+            preferred_dimension_vector = self.preferred_dimension_vector
+            if self._store is None:
+                pdim = int((preferred_dimension_vector > 1).sum())
+            else:
+                pdim = int(self._store.pdim[self._row])
+            summary = (1.0 / preferred_dimension_vector, pdim)
+            if self._store is None:
+                self.__dict__['_preference_summary'] = summary
+        return summary
+
+    @property
+    def pdim(self):
+        """Preference dimensionality i.e. number of dimensions whose preference is not 1."""
+        return self.get_preference_summary()[1]
+
+    def add_new_point(self, new_point_values, new_point_index=None, new_point_weight=1):
         """
         Add new point to the microcluster. In our usage, each point is initially of weight 1. This makes sum of
         weight to be the same as number of points.
 
         Args:
             new_point_values (numpy.array): The datapoint represented as an array of value of each of its dimension.
+            new_point_index (int, optional): Row of the datapoint in the dataset of the current time point. Not
+                recorded if not given.
             new_point_weight (int, optional): Weight of the datapoint to be added. Default to 1.
 
         Returns:
@@ -191,8 +313,8 @@ class Microcluster(object):
         self.cumulative_weight += new_point_weight
         # update the cluster centroid as it may have moved with the introduction of new data_autoencoder point.
         self.set_centroid()
-        self.points.append(new_point_values.tolist())
-        self.points_timestamp.append(new_point_timestamp)
+        if new_point_index is not None:
+            self.point_indices.append(new_point_index)
 
     def set_centroid(self):
         """
@@ -213,11 +335,7 @@ class Microcluster(object):
         Returns:
             Float: Projected distance between this point and point given as argument.
         """
-
-        dist = 0.0
-        for c_i, p_i, d_i in zip(self.cluster_centroids, other_point, self.preferred_dimension_vector):
-            dist += ((p_i - c_i) ** 2) / d_i
-        return dist
+        return get_projected_dist_to_point(self.cluster_centroids, other_point, self.preferred_dimension_vector)
 
     def calculate_projected_radius_squared(self):
         """
@@ -226,14 +344,9 @@ class Microcluster(object):
         Returns:
             Float: Squared Projected radius.
         """
-        radius_squared = 0.0
-        for i in range(self.CF1.shape[0]):
-            dimension = 1.0 / self.preferred_dimension_vector[i]
-            value = (self.CF2[i] / self.cumulative_weight) - \
-                    ((self.CF1[i] / self.cumulative_weight) ** 2)
-            radius_squared += dimension * value
-
-        return radius_squared
+        inverse_preferred_dimension_vector, _ = self.get_preference_summary()
+        variance = (self.CF2 / self.cumulative_weight) - ((self.CF1 / self.cumulative_weight) ** 2)
+        return sum_over_dimensions(inverse_preferred_dimension_vector * variance)
 
     def get_copy(self):
         """
@@ -263,7 +376,7 @@ class Microcluster(object):
             Microcluster: A clone of itself with new datapoint added in it.
         """
         temp_pmc = self.get_copy()
-        temp_pmc.add_new_point(datapoint, -1)
+        temp_pmc.add_new_point(datapoint)
         temp_pmc.update_preferred_dimensions(variance_threshold_squared, k_constant)
 
         return temp_pmc
@@ -281,10 +394,9 @@ class Microcluster(object):
             bool: True if cluster is a core. False otherwise.
         """
         radius_squared = self.calculate_projected_radius_squared()
-        pdim = (np.array(self.preferred_dimension_vector) > 1).sum()
         return (radius_squared <= radius_threshold_squared
                 and self.cumulative_weight >= density_threshold
-                and pdim <= max_subspace_dimensionality)
+                and self.pdim <= max_subspace_dimensionality)
 
     def add_new_cluster(self, cluster):
         """
@@ -306,10 +418,8 @@ class Microcluster(object):
         self.set_centroid()
 
     def reset_points(self):
-        self.points.clear()
-        self.points_timestamp.clear()
-        del self.points[:]
-        del self.points_timestamp[:]
+        # A new array rather than emptying this one, as tracking Cluster objects may share it.
+        self.point_indices = array('q')
 
 
 class MicroclusterAsDatapoint(Datapoint, Microcluster):
@@ -375,6 +485,54 @@ class MicroclusterAsDatapoint(Datapoint, Microcluster):
         return set()
 
 
+class PcoreSnapshot(object):
+    def __init__(self, ids, cluster_centroids, preferred_dimension_vectors, creation_time_in_hrs):
+        """
+        Read-only snapshot of the pcores at a time point, holding what tracking needs of them: their id, centroid,
+        preferred dimension vector and creation time. The clusters of a time point share it and refer to their pcores
+        by row, so tracking keeps no copy of the pcores, nor of their points.
+
+        Args:
+            ids (list): Id of each pcore.
+            cluster_centroids (list): Centroid of each pcore.
+            preferred_dimension_vectors (list): Preferred dimension vector of each pcore.
+            creation_time_in_hrs (list): Creation time of each pcore.
+        """
+        self.ids = list(ids)
+        self.row_of_id = {id: row for row, id in enumerate(self.ids)}
+        dimensionality = len(cluster_centroids[0]) if len(cluster_centroids) > 0 else 0
+        self.cluster_centroids = np.array(cluster_centroids, dtype=float).reshape(len(self.ids), dimensionality)
+        self.preferred_dimension_vectors = np.array(preferred_dimension_vectors, dtype=float).reshape(
+            len(self.ids), dimensionality)
+        self.creation_time_in_hrs = np.array(creation_time_in_hrs, dtype=int)
+        for values in (self.cluster_centroids, self.preferred_dimension_vectors, self.creation_time_in_hrs):
+            values.flags.writeable = False
+
+    def __setstate__(self, state):
+        """Restore state from the unpickled state values."""
+        self.__dict__.update(state)
+        for values in (self.cluster_centroids, self.preferred_dimension_vectors, self.creation_time_in_hrs):
+            values.flags.writeable = False
+
+    @classmethod
+    def from_microcluster_store(cls, store):
+        """
+        Take a snapshot of the microclusters in a store. The centroids are calculated from CF1 and the weight rather
+        than taken from the store, as they may not have been updated since the last points were added.
+
+        Args:
+            store (MicroclusterStore): The store, e.g. HDDStream's pcores.
+
+        Returns:
+            PcoreSnapshot: Snapshot of the microclusters, in the store's row order.
+        """
+        rows = store.rows
+        return cls([next(iter(store[row].id)) for row in rows],
+                   store.CF1[rows] / store.cumulative_weight[rows, np.newaxis],
+                   store.preferred_dimension_vector[rows],
+                   store.creation_time_in_hrs[rows])
+
+
 class Cluster(object):
     def __init__(self, pcore_ids, cluster_centroid=None, cumulative_weight=None, preferred_dimensions=None):
         """
@@ -395,8 +553,10 @@ class Cluster(object):
         self.centroid = cluster_centroid
         self.cumulative_weight = cumulative_weight
 
-        # Used by track by historical association
-        self.pcore_objects = []
+        # Used by track by historical association. The values of the cluster's pcores are rows pcore_rows of
+        # pcore_snapshot, aligned with pcore_ids.
+        self.pcore_snapshot = None
+        self.pcore_rows = np.zeros(0, dtype=int)
         self.historical_associates = set()
 
         # For find the closest gate
@@ -405,6 +565,21 @@ class Cluster(object):
         # This is only to find out which pcore is the closest when adding historical associate
         self.historical_associates_pcores = set()
 
+    def __setstate__(self, state):
+        """Restore state from the unpickled state values."""
+        self.__dict__.update(state)
+        # Clusters saved before pcore snapshots kept a copy of each of their pcores. Put them in a snapshot of their
+        # own.
+        pcore_objects = self.__dict__.pop('pcore_objects', None)
+        if pcore_objects is not None:
+            self.set_pcore_snapshot(PcoreSnapshot(
+                [next(iter(pcore.id)) for pcore in pcore_objects],
+                [pcore.cluster_centroids for pcore in pcore_objects],
+                [pcore.preferred_dimension_vector for pcore in pcore_objects],
+                [pcore.creation_time_in_hrs for pcore in pcore_objects]))
+        else:
+            self.pcore_rows.flags.writeable = False
+
     def add_id(self, id):
         self.id.update([id])
 
@@ -419,16 +594,19 @@ class Cluster(object):
     def get_parents(self):
         return self.parents
 
-    def add_pcore_objects(self, pcore_id_to_object):
-        for pcore_id in self.pcore_ids:
-            pcore = pcore_id_to_object[pcore_id]
-            pcore_copy = pcore.get_copy()
-            pcore_copy.preferred_dimension_vector = np.zeros(
-                len(pcore.preferred_dimension_vector)) + pcore.preferred_dimension_vector
-            pcore_copy.set_centroid()
-            pcore_copy.id = pcore.id
-            pcore_copy.points = pcore.points[:]
-            self.pcore_objects.append(pcore_copy)
+    def set_pcore_snapshot(self, pcore_snapshot):
+        """
+        Set the snapshot the cluster's pcores are in.
+
+        Args:
+            pcore_snapshot (PcoreSnapshot): Snapshot of the pcores of the time point the cluster is found at.
+
+        Returns:
+            None.
+        """
+        self.pcore_snapshot = pcore_snapshot
+        self.pcore_rows = np.array([pcore_snapshot.row_of_id[pcore_id] for pcore_id in self.pcore_ids], dtype=int)
+        self.pcore_rows.flags.writeable = False
 
     def add_historical_associate(self, associate):
         self.historical_associates.update([associate])
@@ -441,29 +619,74 @@ class Cluster(object):
         """
         self.historical_associates_pcores.update(pcore_id)
 
-    def get_historical_associates_as_str(self):
-        return '&'.join(str(s) for s in self.historical_associates)
+    def get_historical_associates_as_str(self, get_label=str):
+        """
+        Get the historical associates as written in the results.
+
+        Args:
+            get_label (function, optional): Gives the label of an associate from its id. See TrackByLineage.get_label.
+
+        Returns:
+            str: The labels of the associates separated by &. An associate that is None is written as None.
+        """
+        return '&'.join(str(s) if s is None else get_label(s) for s in self.historical_associates)
 
     def get_historical_associates_pcore_as_str(self):
         return '&'.join(str(s) for s in self.historical_associates_pcores)
 
+    def _get_centroid_values(self):
+        """
+        Get the centroid and preferred dimensions as float arrays. The centroid is kept as a list of Decimal for
+        printing, so the converted arrays are cached, for as long as the centroid and preferred dimensions are not
+        replaced.
+
+        Returns:
+            tuple: The centroid and the preferred dimensions, each as a numpy.array of float.
+        """
+        cached = self.__dict__.get('_centroid_values')
+        if cached is None or cached[0] is not self.centroid or cached[1] is not self.preferred_dimensions:
+            cached = (self.centroid, self.preferred_dimensions, np.array(self.centroid, dtype=float),
+                      np.array(self.preferred_dimensions, dtype=float))
+            self._centroid_values = cached
+        return cached[2], cached[3]
+
     def get_projected_dist_to_point(self, other_point):
         """
-        This is exact copy of the microcluster version.
-        TODO Merge this with microcluster.
+        Calculate the projected distance between this cluster's centroid and a datapoint. Same as the microcluster
+        version.
+
+        Args:
+            other_point (numpy.array): The datapoint represented as an array of value of each of its dimension.
+
+        Returns:
+            Float: Projected distance between the centroid and the datapoint.
+        """
+        centroid, preferred_dimensions = self._get_centroid_values()
+        return get_projected_dist_to_point(centroid, np.asarray(other_point, dtype=float), preferred_dimensions)
+
+    def get_closest_point(self, points):
         """
+        Find the point closest to this cluster's centroid in projected distance.
 
-        dist = 0.0
-        for c_i, p_i, d_i in zip(self.centroid, other_point, self.preferred_dimensions):
-            dist += ((float(p_i) - float(c_i)) ** 2) / float(d_i)
-        return dist
+        Args:
+            points (numpy.array): 2d array, each row containing a point. There must be at least one.
+
+        Returns:
+            int: Index of the closest point, the lowest one if several are equally close.
+        """
+        centroid, preferred_dimensions = self._get_centroid_values()
+        closest, _ = closest_centroids(centroid[np.newaxis], points, preferred_dimensions, divide=True)
+        return int(closest[0])
 
     def get_dist_to_point(self, other_point):
         """
-        This is exact copy of the microcluster version.
-        TODO Merge this with microcluster.
+        Calculate the squared euclidean distance between this cluster's centroid and a datapoint.
+
+        Args:
+            other_point (numpy.array): The datapoint represented as an array of value of each of its dimension.
+
+        Returns:
+            Float: Squared euclidean distance between the centroid and the datapoint.
         """
-        dist = 0.0
-        for i, cluster_centroid in enumerate(self.centroid):
-            dist += ((float(other_point[i]) - float(cluster_centroid)) ** 2)
-        return dist
+        centroid, _ = self._get_centroid_values()
+        return sum_over_dimensions((np.asarray(other_point, dtype=float) - centroid) ** 2)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""
+Cache of the parsed input data files, so each file is only parsed once rather than on every read of every run. The
+files are read by the reader of their format, see readers.
+
+Each file is parsed into a .npy file holding its values, which is opened memory-mapped, and a .json schema holding its
+attributes (the header), its format, the shape and type of the values, the minimum and maximum of each attribute, and
+the path, size and modification time of the file. The schemas make a catalog of the statistics of the data files,
+which is enough to fit the scaler without reading any values. The cache entry of a file is named after its absolute
+path and is parsed again if the size or modification time of the file change.
+
+The .npy files are uncompressed, so the cache takes about 8 bytes per value of every data file, often many times the
+size of the gzipped csv files. Without a cache directory nothing is written: the schemas are only kept in memory and
+the files are parsed each time their values are read.
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+from .readers import get_file_format
+from .readers import read_data_file
+
+__author__ = "Givanna Putri, Deeksha Singh, Mark Read, and Tao Tang"
+__copyright__ = "Copyright 2017, Cytoclust Project"
+__credits__ = ["Givanna Putri", "Deeksha Singh", "Mark Read", "Tao Tang"]
+__version__ = "0.0.1"
+__maintainer__ = "Givanna Putri"
+__email__ = "ghar1821@uni.sydney.edu.au"
+__status__ = "Development"
+
+# Version of the layout of the cache entries. Entries of another version are parsed again.
+CACHE_VERSION = 1
+
+
+class IngestCache(object):
+    def __init__(self, cache_dir=None):
+        """
+        Cache of parsed input data files, stored in a directory which is created if it doesn't exist. The directory can
+        be shared by several runs, e.g. of a parameter sweep.
+
+        Args:
+            cache_dir (str, optional): Directory of the cache. If None, only the schemas are kept, in memory.
+        """
+        self.cache_dir = cache_dir
+        # Schemas of the files parsed, by absolute path, when there is no cache directory.
+        self._schemas = {}
+        if cache_dir is not None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _get_entry_paths(self, filename):
+        """
+        Get the paths of the cache entry of a file.
+
+        Args:
+            filename (str): Path of the data file.
+
+        Returns:
+            tuple: Paths of the schema and of the values.
+        """
+        key = hashlib.sha1(os.path.abspath(filename).encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.json'), os.path.join(self.cache_dir, key + '.npy')
+
+    @staticmethod
+    def _get_source(filename):
+        """Get what identifies the version of a data file: its absolute path, size and modification time."""
+        stat = os.stat(filename)
+        return {'path': os.path.abspath(filename), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    def _read_schema(self, filename, file_format=None):
+        """
+        Read the schema of the cache entry of a file, if it is up to date.
+
+        Args:
+            filename (str): Path of the data file.
+            file_format (str, optional): Format of the file given in the input xml, if any. See
+                readers.get_file_format.
+
+        Returns:
+            dict: The schema, None if the file is not in the cache or has changed since it was cached.
+        """
+        if self.cache_dir is None:
+            schema = self._schemas.get(os.path.abspath(filename))
+            if schema is None or schema['source'] != self._get_source(filename) or \
+                    schema['format'] != get_file_format(filename, file_format):
+                return None
+            return schema
+
+        schema_path, values_path = self._get_entry_paths(filename)
+        try:
+            with open(schema_path) as f:
+                schema = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if schema.get('version') != CACHE_VERSION or schema.get('source') != self._get_source(filename) or \
+                schema['format'] != get_file_format(filename, file_format) or \
+                (schema['values_cached'] and not os.path.exists(values_path)):
+            return None
+        return schema
+
+    def _parse(self, filename, file_format=None):
+        """
+        Parse a data file and write its cache entry.
+
+        Args:
+            filename (str): Path of the data file.
+            file_format (str, optional): Format of the file given in the input xml, if any. See
+                readers.get_file_format.
+
+        Returns:
+            tuple: Schema of the cache entry and the values parsed.
+        """
+        source = self._get_source(filename)
+        file_format = get_file_format(filename, file_format)
+        attributes, values = read_data_file(filename, file_format)
+        # Values the reader can't give a plain numpy type for (e.g. text) can't be memory-mapped. Only the schema of
+        # those files is cached.
+        values_cached = self.cache_dir is not None and not values.dtype.hasobject
+        data_min, data_max = get_min_max(values)
+        schema = {'version': CACHE_VERSION, 'source': source, 'format': file_format, 'attributes': attributes,
+                  'num_rows': len(values), 'shape': list(values.shape), 'dtype': values.dtype.str,
+                  'values_cached': values_cached, 'min': data_min, 'max': data_max}
+        if self.cache_dir is None:
+            self._schemas[source['path']] = schema
+            return schema, values
+
+        # Write to temporary files first, so a run that is killed or a concurrent run never leaves a half written
+        # entry. The values are written before the schema, which is what makes the entry valid.
+        schema_path, values_path = self._get_entry_paths(filename)
+        suffix = '.{}.tmp'.format(os.getpid())
+        if values_cached:
+            with open(values_path + suffix, 'wb') as f:
+                np.save(f, values)
+            os.replace(values_path + suffix, values_path)
+        with open(schema_path + suffix, 'w') as f:
+            json.dump(schema, f)
+        os.replace(schema_path + suffix, schema_path)
+        return schema, values
+
+    def ingest(self, filename, file_format=None):
+        """
+        Parse a data file into the cache, unless it is already there.
+
+        Args:
+            filename (str): Path of the data file.
+            file_format (str, optional): Format of the file given in the input xml, if any. See
+                readers.get_file_format.
+
+        Returns:
+            dict: Schema of the cache entry, holding the file's attributes, and the shape and type of its values.
+        """
+        schema = self._read_schema(filename, file_format)
+        return schema if schema is not None else self._parse(filename, file_format)[0]
+
+    def ingest_all(self, filenames, num_workers=1, file_formats=None):
+        """
+        Parse data files into the cache, those which are not already there, in parallel.
+
+        Args:
+            filenames (list): Path of each data file.
+            num_workers (int, optional): Number of processes parsing the files. 1 parses them in this process.
+            file_formats (list, optional): Format of each file given in the input xml, None for those given none.
+
+        Returns:
+            list: Schema of the cache entry of each file. See ingest.
+        """
+        file_formats = [None] * len(filenames) if file_formats is None else file_formats
+        schemas = [self._read_schema(filename, file_format) for filename, file_format in zip(filenames, file_formats)]
+        missing = [index for index, schema in enumerate(schemas) if schema is None]
+        num_workers = min(num_workers, len(missing), os.cpu_count() or 1)
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                parsed = executor.map(ingest_file, repeat(self.cache_dir), [filenames[index] for index in missing],
+                                      [file_formats[index] for index in missing])
+                for index, schema in zip(missing, parsed):
+                    schemas[index] = schema
+                    if self.cache_dir is None:
+                        self._schemas[schema['source']['path']] = schema
+        else:
+            for index in missing:
+                schemas[index] = self.ingest(filenames[index], file_formats[index])
+        return schemas
+
+    def get_attributes(self, filename, file_format=None):
+        """
+        Get the attributes of a data file i.e. its header.
+
+        Args:
+            filename (str): Path of the data file.
+            file_format (str, optional): Format of the file given in the input xml, if any. See
+                readers.get_file_format.
+
+        Returns:
+            list: Name of each attribute.
+        """
+        return list(self.ingest(filename, file_format)['attributes'])
+
+    def read(self, filename, file_format=None):
+        """
+        Read the values of a data file, parsing it into the cache first if needed.
+
+        Args:
+            filename (str): Path of the data file.
+            file_format (str, optional): Format of the file given in the input xml, if any. See
+                readers.get_file_format.
+
+        Returns:
+            numpy.array: The values, a row per datapoint. Read-only and memory-mapped, unless the file can't be cached.
+        """
+        schema = self._read_schema(filename, file_format)
+        if schema is None:
+            schema, values = self._parse(filename, file_format)
+            if not schema['values_cached']:
+                return values
+        elif not schema['values_cached']:
+            return read_data_file(filename, file_format)[1]
+        return np.load(self._get_entry_paths(filename)[1], mmap_mode='r')
+
+
+def get_min_max(values):
+    """
+    Get the minimum and maximum of each attribute, ignoring missing values as the scaler does.
+
+    Args:
+        values (numpy.array): Values of a data file, a row per datapoint.
+
+    Returns:
+        tuple: The minimum and the maximum of each attribute, as lists. None if there are no datapoints.
+    """
+    if len(values) == 0:
+        return None, None
+    values = np.asarray(values, dtype=float)
+    return np.nanmin(values, axis=0).tolist(), np.nanmax(values, axis=0).tolist()
+
+
+def ingest_file(cache_dir, filename, file_format):
+    """
+    Parse a data file into a cache. Run by the worker processes of IngestCache.ingest_all.
+
+    Args:
+        cache_dir (str): Directory of the cache, None to only get the schema.
+        filename (str): Path of the data file.
+        file_format (str): Format of the file given in the input xml, if any.
+
+    Returns:
+        dict: Schema of the cache entry of the file.
+    """
+    return IngestCache(cache_dir).ingest(filename, file_format)
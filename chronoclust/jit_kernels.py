@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Kernels of HDDStream's online microcluster maintenance compiled with Numba, used instead of the NumPy code when the
+jit config element is set and Numba is installed.
+
+Adding points one at a time means scoring every candidate microcluster for every point, then updating the one the point
+is added to. With NumPy, each of those steps makes several temporary arrays as large as the microclusters scored, which
+dominates when there are few of them. The kernels below do it in a single pass over the rows of a MicroclusterStore's
+arrays, without temporaries. They do every operation in the same order as the NumPy code (see
+MicroclusterStore.get_tentative_insertion, MicroclusterStore.update_preferred_dimensions and
+Microcluster.add_new_point), so both give exactly the same results.
+
+Numba is an optional dependency. Without it the kernels are left as plain Python functions, which give the same results
+but are far too slow to be used other than to check them.
+"""
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+__author__ = "Givanna Putri, Deeksha Singh, Mark Read, and Tao Tang"
+__copyright__ = "Copyright 2017, Cytoclust Project"
+__credits__ = ["Givanna Putri", "Deeksha Singh", "Mark Read", "Tao Tang"]
+__version__ = "0.0.1"
+__maintainer__ = "Givanna Putri"
+__email__ = "ghar1821@uni.sydney.edu.au"
+__status__ = "Development"
+
+# True if Numba is installed, so the kernels are compiled.
+AVAILABLE = njit is not None
+
+
+def _jit(function):
+    """Compile a function with Numba if it is installed, and leave it as is otherwise."""
+    return function if njit is None else njit(cache=True)(function)
+
+
+@_jit
+def find_closest_microcluster(cf1, cf2, cumulative_weight, cluster_centroids, preferred_dimension_vector, rows,
+                              datapoint, variance_threshold_squared, k_constant, max_pdim, check_pdim):
+    """
+    Find which of some microclusters is the closest to a point, its projected distance to the point and the squared
+    projected radius it would have after adding the point. Same as HDDStream._find_closest_microcluster_in_rows.
+
+    Args:
+        cf1 (numpy.array): 2d array containing the CF1 of each microcluster.
+        cf2 (numpy.array): 2d array containing the CF2 of each microcluster.
+        cumulative_weight (numpy.array): Weight of each microcluster.
+        cluster_centroids (numpy.array): 2d array containing the centroid of each microcluster.
+        preferred_dimension_vector (numpy.array): 2d array containing the preferred dimension vector of each
+            microcluster.
+        rows (numpy.array): Sorted rows of the microclusters to search.
+        datapoint (numpy.array): The point.
+        variance_threshold_squared (float): The squared variance threshold (delta squared).
+        k_constant (float): Constant assigned to preferred dimensions.
+        max_pdim (int): Largest pdim a microcluster can have after adding the point (pi), if check_pdim is True.
+        check_pdim (bool): True if only the microclusters whose pdim stays within max_pdim after adding the point can
+            be chosen.
+
+    Returns:
+        tuple: Position in rows of the closest microcluster (-1 if there is none), its projected distance to the point
+            and its squared projected radius after adding the point.
+    """
+    num_dimensions = datapoint.shape[0]
+    closest = -1
+    closest_distance = np.inf
+
+    for position in range(rows.shape[0]):
+        row = rows[position]
+
+        if check_pdim:
+            tentative_weight = cumulative_weight[row] + 1
+            tentative_pdim = 0
+            for dimension in range(num_dimensions):
+                tentative_mean = (cf1[row, dimension] + datapoint[dimension]) / tentative_weight
+                tentative_variance = ((cf2[row, dimension] + datapoint[dimension] * datapoint[dimension]) /
+                                      tentative_weight) - tentative_mean * tentative_mean
+                if tentative_variance <= variance_threshold_squared and k_constant != 1:
+                    tentative_pdim += 1
+            if tentative_pdim > max_pdim:
+                continue
+
+        distance = 0.0
+        for dimension in range(num_dimensions):
+            difference = datapoint[dimension] - cluster_centroids[row, dimension]
+            distance += (difference * difference) / preferred_dimension_vector[row, dimension]
+        # Strictly closer only, so ties go to the microcluster that comes first.
+        if distance < closest_distance:
+            closest = position
+            closest_distance = distance
+
+    if closest < 0 or np.isinf(closest_distance):
+        return -1, np.inf, np.inf
+
+    row = rows[closest]
+    tentative_weight = cumulative_weight[row] + 1
+    tentative_radius_squared = 0.0
+    for dimension in range(num_dimensions):
+        tentative_mean = (cf1[row, dimension] + datapoint[dimension]) / tentative_weight
+        tentative_variance = ((cf2[row, dimension] + datapoint[dimension] * datapoint[dimension]) /
+                              tentative_weight) - tentative_mean * tentative_mean
+        preference = k_constant if tentative_variance <= variance_threshold_squared else 1.0
+        tentative_radius_squared += (1.0 / preference) * tentative_variance
+    return closest, closest_distance, tentative_radius_squared
+
+
+@_jit
+def add_point(cf1, cf2, cumulative_weight, cluster_centroids, preferred_dimension_vector, pdim, row, datapoint,
+              variance_threshold_squared, k_constant):
+    """
+    Add a point to the microcluster in a row, then update its centroid, preferred dimension vector and pdim. Same as
+    Microcluster.add_new_point followed by Microcluster.update_preferred_dimensions. The arrays are modified in place.
+
+    Args:
+        cf1 (numpy.array): 2d array containing the CF1 of each microcluster.
+        cf2 (numpy.array): 2d array containing the CF2 of each microcluster.
+        cumulative_weight (numpy.array): Weight of each microcluster.
+        cluster_centroids (numpy.array): 2d array containing the centroid of each microcluster.
+        preferred_dimension_vector (numpy.array): 2d array containing the preferred dimension vector of each
+            microcluster.
+        pdim (numpy.array): pdim of each microcluster.
+        row (int): Row of the microcluster.
+        datapoint (numpy.array): The point.
+        variance_threshold_squared (float): The squared variance threshold (delta squared).
+        k_constant (float): Constant assigned to preferred dimensions.
+
+    Returns:
+        None.
+    """
+    num_dimensions = datapoint.shape[0]
+    weight = cumulative_weight[row] + 1
+    cumulative_weight[row] = weight
+
+    num_preferred = 0
+    for dimension in range(num_dimensions):
+        cf1[row, dimension] += datapoint[dimension]
+        cf2[row, dimension] += datapoint[dimension] * datapoint[dimension]
+        cluster_centroids[row, dimension] = cf1[row, dimension] / weight
+
+        mean = cf1[row, dimension] / weight
+        squared_variance = (cf2[row, dimension] / weight) - mean * mean
+        preference = k_constant if squared_variance <= variance_threshold_squared else 1.0
+        preferred_dimension_vector[row, dimension] = preference
+        if preference > 1:
+            num_preferred += 1
+    pdim[row] = num_preferred
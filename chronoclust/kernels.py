@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+"""
+Distance kernels shared by HDDStream, PreDeCon, the cluster trackers and gate matching.
+
+All of them use the same (weighted) squared euclidean distance between a point x and a centroid c:
+    sum_i w_i * (x_i - c_i)^2
+where the weights are either all 1 (euclidean distance), the subspace preference vector of a point (weighted distance,
+see definition 3 in paper[2]), or the reciprocal of the preferred dimension vector of a microcluster (projected
+distance, see definition 8 in paper[1]). Projected distance divides by the preferred dimension vector rather than
+multiplying by its reciprocal, which rounds differently, so the kernels take a divide flag to tell them which one to do.
+
+There are two ways of calculating the distances between many points and many centroids:
+    - The difference form above, which adds one dimension at a time in order. It gives exactly the same values as the
+      per-dimension loops the algorithms were written with, so the decisions made on them do not change.
+    - The GEMM form ||x||^2_w - 2 x . (c o w) + ||c||^2_w, which gets most of the work done by matrix products (BLAS)
+      and is much faster on many points and centroids, but rounds differently and may even be slightly negative.
+closest_centroids, closest_points and centroids_within use the GEMM form to rule out most (point, centroid) pairs using
+a bound on its rounding error, then calculate the few pairs left in the difference form. They thus give exactly the
+results the difference form would, at close to the speed of the GEMM form.
+
+All many-to-many kernels work on blocks of points so the intermediate matrices never hold more than
+MAX_BLOCK_ELEMENTS values.
+"""
+
+import numpy as np
+
+__author__ = "Givanna Putri, Deeksha Singh, Mark Read, and Tao Tang"
+__copyright__ = "Copyright 2017, Cytoclust Project"
+__credits__ = ["Givanna Putri", "Deeksha Singh", "Mark Read", "Tao Tang"]
+__version__ = "0.0.1"
+__maintainer__ = "Givanna Putri"
+__email__ = "ghar1821@uni.sydney.edu.au"
+__status__ = "Development"
+
+# Maximum number of (point, centroid) pairs handled at once by the many-to-many kernels.
+MAX_BLOCK_ELEMENTS = 2 ** 16
+
+
+def sum_over_dimensions(values):
+    """
+    Sum a 2-D array along its dimensions (columns), adding one dimension at a time. values.sum(axis=1) uses pairwise
+    summation and therefore rounds differently from the per-dimension loops Microcluster used to have. Adding columns
+    in order gives exactly the same result as those loops, so decisions made on the summed values do not change.
+    A 1-D array, holding the values of a single microcluster, is summed the same way.
+
+    Args:
+        values (numpy.array): 2d array of shape (number of microclusters, number of dimensions), or 1d array of
+            shape (number of dimensions).
+
+    Returns:
+        numpy.array or float: 1d array containing the sum of each row, or the sum of a 1d array.
+    """
+    if values.ndim == 1:
+        # accumulate adds the values one at a time, in order.
+        return float(np.add.accumulate(values)[-1]) if len(values) > 0 else 0.0
+
+    total = np.zeros(values.shape[0])
+    for dimension_values in values.T:
+        total += dimension_values
+    return total
+
+
+def get_projected_dist_to_point(centroid, other_point, preferred_dimension_vector):
+    """
+    Calculate the projected distance between a centroid and a datapoint. See Definition 8 of paper[1]. The squared
+    difference along each dimension is divided by the dimension's preference, and added up one dimension at a time.
+
+    Args:
+        centroid (numpy.array): The centroid.
+        other_point (numpy.array): The datapoint represented as an array of value of each of its dimension.
+        preferred_dimension_vector (numpy.array): Preference of each dimension (1 or k_constant).
+
+    Returns:
+        Float: Projected distance between the centroid and the datapoint.
+    """
+    return sum_over_dimensions(((other_point - centroid) ** 2) / preferred_dimension_vector)
+
+
+def _get_block_size(num_centroids, max_block_elements):
+    """Number of points to handle at once so a block holds at most max_block_elements pairs."""
+    return max(1, max_block_elements // max(num_centroids, 1))
+
+
+def _scale(values, weights, divide):
+    """Multiply (or divide) values by weights."""
+    if weights is None:
+        return values
+    return values / weights if divide else values * weights
+
+
+def dist_squared(points, centroids, weights=None, divide=False, max_block_elements=MAX_BLOCK_ELEMENTS):
+    """
+    Calculate the weighted squared distance between each point and each centroid in the difference form, adding one
+    dimension at a time.
+
+    Args:
+        points (numpy.array): 2d array, each row containing a point.
+        centroids (numpy.array): 2d array, each row containing a centroid.
+        weights (numpy.array, optional): Weight of each dimension, either shared by all centroids (1d array) or for
+            each centroid (2d array with a row per centroid). All 1 if not given.
+        divide (bool, optional): True to divide the squared differences by the weights rather than multiplying them.
+        max_block_elements (int, optional): Maximum number of pairs to handle at once.
+
+    Returns:
+        numpy.array: 2d array of shape (number of points, number of centroids) containing the distances.
+    """
+    points = np.asarray(points, dtype=float)
+    centroids = np.asarray(centroids, dtype=float)
+    distance = np.zeros((len(points), len(centroids)))
+
+    block_size = _get_block_size(len(centroids), max_block_elements)
+    for start in range(0, len(points), block_size):
+        block = points[start:start + block_size]
+        block_distance = distance[start:start + block_size]
+        for dimension in range(centroids.shape[1]):
+            dimension_weights = None
+            if weights is not None:
+                dimension_weights = weights[dimension] if weights.ndim == 1 else weights[:, dimension]
+            block_distance += _scale((block[:, dimension, np.newaxis] - centroids[:, dimension]) ** 2,
+                                     dimension_weights, divide)
+    return distance
+
+
+def pair_dist_squared(points, centroids, weights=None, divide=False):
+    """
+    Calculate the weighted squared distance between each point and the centroid in the same row, in the difference
+    form, adding one dimension at a time.
+
+    Args:
+        points (numpy.array): 2d array, each row containing a point.
+        centroids (numpy.array): 2d array, each row containing the centroid paired with the point in the same row.
+        weights (numpy.array, optional): Weight of each dimension, either shared by all pairs (1d array) or for each
+            pair (2d array). All 1 if not given.
+        divide (bool, optional): True to divide the squared differences by the weights rather than multiplying them.
+
+    Returns:
+        numpy.array: The distance of each pair.
+    """
+    return sum_over_dimensions(_scale((points - centroids) ** 2, weights, divide))
+
+
+def gemm_dist_squared(points, centroids, weights=None, divide=False):
+    """
+    Calculate the weighted squared distance between each point and each centroid in the GEMM form, along with a bound
+    on how far each value can be from the one the difference form gives.
+
+    The difference form is exact to within (d + 2) roundings of its value, and each of the three terms of the GEMM form
+    is exact to within d + 2 roundings of its own value. As 2 |x . (c o w)| <= ||x||^2_w + ||c||^2_w, the two forms
+    differ by at most about 4 (d + 2) units of rounding times ||x||^2_w + ||c||^2_w. To keep these norms, and hence
+    the bound, small, the points and centroids are first moved so the centroids are centred on the origin, which
+    doesn't change the distances.
+
+    Args:
+        points (numpy.array): 2d array, each row containing a point.
+        centroids (numpy.array): 2d array, each row containing a centroid.
+        weights (numpy.array, optional): Weight of each dimension, either shared by all centroids (1d array) or for
+            each centroid (2d array with a row per centroid). All 1 if not given.
+        divide (bool, optional): True if the squared differences are to be divided by the weights.
+
+    Returns:
+        tuple: Two 2d arrays of shape (number of points, number of centroids), containing the distances and the bound
+            on their error.
+    """
+    centre = centroids.mean(axis=0) if len(centroids) > 0 else 0
+    points = points - centre
+    centroids = centroids - centre
+    if weights is None:
+        weights = np.ones(centroids.shape[1])
+    elif divide:
+        weights = 1.0 / weights
+
+    weighted_centroids = centroids * weights
+    centroid_norms = (weighted_centroids * centroids).sum(axis=1)
+    if weights.ndim == 1:
+        point_norms = ((points ** 2) @ weights)[:, np.newaxis]
+    else:
+        point_norms = (points ** 2) @ weights.T
+
+    distance = point_norms - 2 * (points @ weighted_centroids.T) + centroid_norms
+    # Generous unit of rounding: the reciprocal of the weights adds its own rounding when dividing.
+    error_bound = (8 * (centroids.shape[1] + 4) * np.finfo(float).eps) * (point_norms + centroid_norms)
+    return distance, error_bound
+
+
+def closest_centroids(points, centroids, weights=None, divide=False, max_block_elements=MAX_BLOCK_ELEMENTS):
+    """
+    Find the closest centroid to each point. The result is exactly what taking the first smallest distance given by
+    dist_squared would give, but only the pairs the GEMM form can't rule out are calculated in the difference form.
+
+    Args:
+        points (numpy.array): 2d array, each row containing a point.
+        centroids (numpy.array): 2d array, each row containing a centroid. There must be at least one.
+        weights (numpy.array, optional): Weight of each dimension, either shared by all centroids (1d array) or for
+            each centroid (2d array with a row per centroid). All 1 if not given.
+        divide (bool, optional): True to divide the squared differences by the weights rather than multiplying them.
+        max_block_elements (int, optional): Maximum number of pairs to handle at once.
+
+    Returns:
+        tuple: Two numpy.array containing, for each point, the index of the closest centroid (the lowest one in case
+            of a tie) and the distance to it.
+    """
+    points = np.asarray(points, dtype=float)
+    centroids = np.asarray(centroids, dtype=float)
+    closest = np.zeros(len(points), dtype=int)
+    closest_distance = np.zeros(len(points))
+
+    block_size = _get_block_size(len(centroids), max_block_elements)
+    for start in range(0, len(points), block_size):
+        block = points[start:start + block_size]
+        distance, error_bound = gemm_dist_squared(block, centroids, weights, divide)
+        # A centroid can only be the closest if its lowest possible distance is not above the highest possible
+        # distance of the centroid which looks the closest.
+        highest = (distance + error_bound).min(axis=1)
+        point_indices, centroid_indices = np.nonzero(distance - error_bound <= highest[:, np.newaxis])
+
+        exact_distance = np.full(distance.shape, np.inf)
+        pair_weights = weights if weights is None or weights.ndim == 1 else weights[centroid_indices]
+        exact_distance[point_indices, centroid_indices] = pair_dist_squared(block[point_indices],
+                                                                            centroids[centroid_indices],
+                                                                            pair_weights, divide)
+        block_closest = exact_distance.argmin(axis=1)
+        closest[start:start + block_size] = block_closest
+        closest_distance[start:start + block_size] = exact_distance[np.arange(len(block)), block_closest]
+
+    return closest, closest_distance
+
+
+def closest_points(points, centroids, weights=None, divide=False, max_block_elements=MAX_BLOCK_ELEMENTS):
+    """
+    Find the closest point to each centroid. This is closest_centroids the other way round, for when the weights
+    belong to the centroids: the result is exactly what taking the first smallest distance given by dist_squared in
+    each column would give, but only the pairs the GEMM form can't rule out are calculated in the difference form.
+    The centroids are handled a block at a time.
+
+    Args:
+        points (numpy.array): 2d array, each row containing a point. There must be at least one.
+        centroids (numpy.array): 2d array, each row containing a centroid.
+        weights (numpy.array, optional): Weight of each dimension, either shared by all centroids (1d array) or for
+            each centroid (2d array with a row per centroid). All 1 if not given.
+        divide (bool, optional): True to divide the squared differences by the weights rather than multiplying them.
+        max_block_elements (int, optional): Maximum number of pairs to handle at once.
+
+    Returns:
+        tuple: Two numpy.array containing, for each centroid, the index of the closest point (the lowest one in case
+            of a tie) and the distance to it.
+    """
+    points = np.asarray(points, dtype=float)
+    centroids = np.asarray(centroids, dtype=float)
+    closest = np.zeros(len(centroids), dtype=int)
+    closest_distance = np.zeros(len(centroids))
+
+    block_size = _get_block_size(len(points), max_block_elements)
+    for start in range(0, len(centroids), block_size):
+        block = centroids[start:start + block_size]
+        block_weights = weights if weights is None or weights.ndim == 1 else weights[start:start + block_size]
+        distance, error_bound = gemm_dist_squared(points, block, block_weights, divide)
+        # A point can only be the closest if its lowest possible distance is not above the highest possible distance
+        # of the point which looks the closest.
+        highest = (distance + error_bound).min(axis=0)
+        point_indices, centroid_indices = np.nonzero(distance - error_bound <= highest)
+
+        exact_distance = np.full(distance.shape, np.inf)
+        pair_weights = block_weights if weights is None or weights.ndim == 1 else block_weights[centroid_indices]
+        exact_distance[point_indices, centroid_indices] = pair_dist_squared(points[point_indices],
+                                                                            block[centroid_indices],
+                                                                            pair_weights, divide)
+        block_closest = exact_distance.argmin(axis=0)
+        closest[start:start + block_size] = block_closest
+        closest_distance[start:start + block_size] = exact_distance[block_closest, np.arange(len(block))]
+
+    return closest, closest_distance
+
+
+def centroids_within(points, centroids, radius_squared, weights=None, divide=False,
+                     max_block_elements=MAX_BLOCK_ELEMENTS):
+    """
+    Find, for each point, the centroids whose squared distance to it is within a radius. The result is exactly what
+    comparing the distances given by dist_squared with the radius would give, but only the pairs the GEMM form can't
+    decide on are calculated in the difference form.
+
+    Args:
+        points (numpy.array): 2d array, each row containing a point.
+        centroids (numpy.array): 2d array, each row containing a centroid.
+        radius_squared (float): Squared radius.
+        weights (numpy.array, optional): Weight of each dimension, either shared by all centroids (1d array) or for
+            each centroid (2d array with a row per centroid). All 1 if not given.
+        divide (bool, optional): True to divide the squared differences by the weights rather than multiplying them.
+        max_block_elements (int, optional): Maximum number of pairs to handle at once.
+
+    Returns:
+        numpy.array: Boolean 2d array of shape (number of points, number of centroids), True for the centroids within
+            the radius of the point.
+    """
+    points = np.asarray(points, dtype=float)
+    centroids = np.asarray(centroids, dtype=float)
+    within = np.zeros((len(points), len(centroids)), dtype=bool)
+    if len(centroids) == 0:
+        return within
+
+    block_size = _get_block_size(len(centroids), max_block_elements)
+    for start in range(0, len(points), block_size):
+        block = points[start:start + block_size]
+        distance, error_bound = gemm_dist_squared(block, centroids, weights, divide)
+        block_within = within[start:start + block_size]
+        block_within[distance + error_bound <= radius_squared] = True
+
+        # Pairs too close to the radius for the GEMM form to tell.
+        point_indices, centroid_indices = np.nonzero((distance - error_bound <= radius_squared) &
+                                                     (distance + error_bound > radius_squared))
+        pair_weights = weights if weights is None or weights.ndim == 1 else weights[centroid_indices]
+        exact_distance = pair_dist_squared(block[point_indices], centroids[centroid_indices], pair_weights, divide)
+        block_within[point_indices, centroid_indices] = exact_distance <= radius_squared
+
+    return within
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""
+Persistent store of the lineage and historical associations of the clusters found at each time point, kept next to the
+program state so the history of a cluster can be queried without reading the results back.
+
+The store is an SQLite database. Clusters are identified by the time point and the id TrackByLineage gave them (a node
+of its LineageLabels), along with their rendered label. Lineage edges link a cluster to the clusters of the previous
+time point it inherited its label from or split from. Association edges link a cluster to its historical associates.
+Rows are only ever added, a time point at a time. A new run clears the store, and a run restored from a program state
+removes the time points after the one the state was saved at, as they are processed again.
+"""
+
+import sqlite3
+
+__author__ = "Givanna Putri, Deeksha Singh, Mark Read, and Tao Tang"
+__copyright__ = "Copyright 2017, Cytoclust Project"
+__credits__ = ["Givanna Putri", "Deeksha Singh", "Mark Read", "Tao Tang"]
+__version__ = "0.0.1"
+__maintainer__ = "Givanna Putri"
+__email__ = "ghar1821@uni.sydney.edu.au"
+__status__ = "Development"
+
+# Kinds of lineage edge.
+INHERIT = 'inherit'
+SPLIT = 'split'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS clusters (
+    timepoint INTEGER NOT NULL,
+    cluster INTEGER NOT NULL,
+    label TEXT NOT NULL,
+    PRIMARY KEY (timepoint, cluster)
+);
+CREATE INDEX IF NOT EXISTS clusters_by_label ON clusters (label, timepoint);
+
+CREATE TABLE IF NOT EXISTS lineage_edges (
+    parent_timepoint INTEGER NOT NULL,
+    parent INTEGER NOT NULL,
+    timepoint INTEGER NOT NULL,
+    cluster INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    PRIMARY KEY (timepoint, cluster, parent)
+);
+CREATE INDEX IF NOT EXISTS lineage_edges_by_parent ON lineage_edges (parent_timepoint, parent);
+
+CREATE TABLE IF NOT EXISTS association_edges (
+    associate_timepoint INTEGER NOT NULL,
+    associate INTEGER NOT NULL,
+    timepoint INTEGER NOT NULL,
+    cluster INTEGER NOT NULL,
+    PRIMARY KEY (timepoint, cluster, associate)
+);
+CREATE INDEX IF NOT EXISTS association_edges_by_associate ON association_edges (associate_timepoint, associate);
+"""
+
+
+class LineageStore(object):
+    def __init__(self, path):
+        """
+        Open the store, creating it if it doesn't exist.
+
+        Args:
+            path (str): Path of the database file.
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def clear(self):
+        """Remove everything in the store, e.g. left by a previous run into the same output directory."""
+        with self.connection:
+            for table in ('clusters', 'lineage_edges', 'association_edges'):
+                self.connection.execute("DELETE FROM {}".format(table))
+
+    def remove_timepoints_after(self, timepoint):
+        """
+        Remove the time points after a time point, along with their edges.
+
+        Args:
+            timepoint (int): The time point.
+
+        Returns:
+            None.
+        """
+        with self.connection:
+            for table in ('clusters', 'lineage_edges', 'association_edges'):
+                self.connection.execute("DELETE FROM {} WHERE timepoint > ?".format(table), (timepoint,))
+
+    def has_timepoint(self, timepoint):
+        """
+        Check if the clusters of a time point are in the store.
+
+        Args:
+            timepoint (int): The time point.
+
+        Returns:
+            bool: True if they are.
+        """
+        return self.connection.execute("SELECT 1 FROM clusters WHERE timepoint = ? LIMIT 1",
+                                       (timepoint,)).fetchone() is not None
+
+    def get_previous_timepoint(self, timepoint):
+        """
+        Get the last time point in the store before a time point.
+
+        Args:
+            timepoint (int): The time point.
+
+        Returns:
+            int: The previous time point, None if there is none.
+        """
+        return self.connection.execute("SELECT MAX(timepoint) FROM clusters WHERE timepoint < ?",
+                                       (timepoint,)).fetchone()[0]
+
+    def add_timepoint(self, timepoint, previous_timepoint, clusters, lineage_edges, association_edges):
+        """
+        Add the clusters of a time point, with their edges to the clusters of the previous time point.
+
+        Args:
+            timepoint (int): The time point. It must not be in the store already.
+            previous_timepoint (int): Time point of the clusters the edges lead to, None if there is none.
+            clusters (list): (id, label) of each cluster.
+            lineage_edges (list): (parent id, id, kind) of each lineage edge, kind being INHERIT or SPLIT.
+            association_edges (list): (associate id, id) of each association edge.
+
+        Returns:
+            None.
+        """
+        with self.connection:
+            self.connection.executemany("INSERT INTO clusters VALUES (?, ?, ?)",
+                                        [(timepoint, cluster, label) for cluster, label in clusters])
+            if previous_timepoint is None:
+                return
+            self.connection.executemany(
+                "INSERT INTO lineage_edges VALUES (?, ?, ?, ?, ?)",
+                [(previous_timepoint, parent, timepoint, cluster, kind) for parent, cluster, kind in lineage_edges])
+            self.connection.executemany(
+                "INSERT INTO association_edges VALUES (?, ?, ?, ?)",
+                [(previous_timepoint, associate, timepoint, cluster) for associate, cluster in association_edges])
+
+    def find_clusters(self, label, timepoint=None):
+        """
+        Find the clusters with a label.
+
+        Args:
+            label (str): The label, e.g. (A|1,B).
+            timepoint (int, optional): Time point to look in. All time points if not given.
+
+        Returns:
+            list: (time point, id) of each cluster found, in time point order.
+        """
+        if timepoint is None:
+            return self.connection.execute("SELECT timepoint, cluster FROM clusters WHERE label = ? ORDER BY timepoint",
+                                           (label,)).fetchall()
+        return self.connection.execute("SELECT timepoint, cluster FROM clusters WHERE label = ? AND timepoint = ?",
+                                       (label, timepoint)).fetchall()
+
+    def get_label(self, timepoint, cluster):
+        """
+        Get the label of a cluster.
+
+        Args:
+            timepoint (int): Time point of the cluster.
+            cluster (int): Id of the cluster.
+
+        Returns:
+            str: The label, None if the cluster is not in the store.
+        """
+        row = self.connection.execute("SELECT label FROM clusters WHERE timepoint = ? AND cluster = ?",
+                                      (timepoint, cluster)).fetchone()
+        return None if row is None else row[0]
+
+    def get_parents(self, timepoint, cluster):
+        """
+        Get the clusters of the previous time point a cluster inherited its label from or split from.
+
+        Args:
+            timepoint (int): Time point of the cluster.
+            cluster (int): Id of the cluster.
+
+        Returns:
+            list: (time point, id, label, kind of edge) of each parent.
+        """
+        return self.connection.execute(
+            "SELECT e.parent_timepoint, e.parent, c.label, e.kind FROM lineage_edges e "
+            "JOIN clusters c ON c.timepoint = e.parent_timepoint AND c.cluster = e.parent "
+            "WHERE e.timepoint = ? AND e.cluster = ? ORDER BY c.label", (timepoint, cluster)).fetchall()
+
+    def get_children(self, timepoint, cluster):
+        """
+        Get the clusters of the next time point that inherited their label from a cluster or split from it.
+
+        Args:
+            timepoint (int): Time point of the cluster.
+            cluster (int): Id of the cluster.
+
+        Returns:
+            list: (time point, id, label, kind of edge) of each child.
+        """
+        return self.connection.execute(
+            "SELECT e.timepoint, e.cluster, c.label, e.kind FROM lineage_edges e "
+            "JOIN clusters c ON c.timepoint = e.timepoint AND c.cluster = e.cluster "
+            "WHERE e.parent_timepoint = ? AND e.parent = ? ORDER BY c.label", (timepoint, cluster)).fetchall()
+
+    def get_splits(self, timepoint, cluster):
+        """
+        Get the clusters a cluster split into at the next time point.
+
+        Args:
+            timepoint (int): Time point of the cluster.
+            cluster (int): Id of the cluster.
+
+        Returns:
+            list: The children of the cluster, as returned by get_children, if there are more than one. Empty
+                otherwise.
+        """
+        children = self.get_children(timepoint, cluster)
+        return children if len(children) > 1 else []
+
+    def get_merges(self, timepoint, cluster):
+        """
+        Get the clusters of the previous time point that merged into a cluster.
+
+        Args:
+            timepoint (int): Time point of the cluster.
+            cluster (int): Id of the cluster.
+
+        Returns:
+            list: The parents of the cluster, as returned by get_parents, if there are more than one. Empty otherwise.
+        """
+        parents = self.get_parents(timepoint, cluster)
+        return parents if len(parents) > 1 else []
+
+    def get_ancestors(self, timepoint, cluster):
+        """
+        Get all the clusters a cluster comes from, following the lineage edges back through the time points.
+
+        Args:
+            timepoint (int): Time point of the cluster.
+            cluster (int): Id of the cluster.
+
+        Returns:
+            list: (time point, id, label) of each ancestor, latest time point first.
+        """
+        return self.connection.execute(
+            "WITH RECURSIVE ancestors(timepoint, cluster) AS ("
+            "    SELECT parent_timepoint, parent FROM lineage_edges WHERE timepoint = ? AND cluster = ?"
+            "    UNION"
+            "    SELECT e.parent_timepoint, e.parent FROM lineage_edges e"
+            "    JOIN ancestors a ON e.timepoint = a.timepoint AND e.cluster = a.cluster) "
+            "SELECT a.timepoint, a.cluster, c.label FROM ancestors a "
+            "JOIN clusters c ON c.timepoint = a.timepoint AND c.cluster = a.cluster "
+            "ORDER BY a.timepoint DESC, c.label", (timepoint, cluster)).fetchall()
+
+    def get_descendants(self, timepoint, cluster):
+        """
+        Get all the clusters that come from a cluster, following the lineage edges forward through the time points.
+
+        Args:
+            timepoint (int): Time point of the cluster.
+            cluster (int): Id of the cluster.
+
+        Returns:
+            list: (time point, id, label) of each descendant, earliest time point first.
+        """
+        return self.connection.execute(
+            "WITH RECURSIVE descendants(timepoint, cluster) AS ("
+            "    SELECT timepoint, cluster FROM lineage_edges WHERE parent_timepoint = ? AND parent = ?"
+            "    UNION"
+            "    SELECT e.timepoint, e.cluster FROM lineage_edges e"
+            "    JOIN descendants d ON e.parent_timepoint = d.timepoint AND e.parent = d.cluster) "
+            "SELECT d.timepoint, d.cluster, c.label FROM descendants d "
+            "JOIN clusters c ON c.timepoint = d.timepoint AND c.cluster = d.cluster "
+            "ORDER BY d.timepoint, c.label", (timepoint, cluster)).fetchall()
+
+    def get_associates(self, timepoint, cluster):
+        """
+        Get the historical associates of a cluster, i.e. the clusters of the previous time point closest to its pcores.
+
+        Args:
+            timepoint (int): Time point of the cluster.
+            cluster (int): Id of the cluster.
+
+        Returns:
+            list: (time point, id, label) of each associate.
+        """
+        return self.connection.execute(
+            "SELECT e.associate_timepoint, e.associate, c.label FROM association_edges e "
+            "JOIN clusters c ON c.timepoint = e.associate_timepoint AND c.cluster = e.associate "
+            "WHERE e.timepoint = ? AND e.cluster = ? ORDER BY c.label", (timepoint, cluster)).fetchall()
+
+    def get_associated(self, timepoint, cluster):
+        """
+        Get the clusters of the next time point a cluster is a historical associate of.
+
+        Args:
+            timepoint (int): Time point of the cluster.
+            cluster (int): Id of the cluster.
+
+        Returns:
+            list: (time point, id, label) of each cluster.
+        """
+        return self.connection.execute(
+            "SELECT e.timepoint, e.cluster, c.label FROM association_edges e "
+            "JOIN clusters c ON c.timepoint = e.timepoint AND c.cluster = e.cluster "
+            "WHERE e.associate_timepoint = ? AND e.associate = ? ORDER BY c.label", (timepoint, cluster)).fetchall()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""
+Spatial index over the centroids of the microclusters in a MicroclusterStore, used by HDDStream to only score the
+microclusters a point can possibly be added to rather than all of them.
+
+The index is a uniform grid over the few dimensions along which the centroids are the most spread out. Projected
+distance only ever divides the squared difference along a dimension by 1 or k, so a microcluster whose centroid is
+further than r from a point along any grid dimension has a projected distance to it greater than r^2 / k.
+Likewise, a microcluster can only take a point if its projected radius stays within epsilon, which puts a bound on
+how far from its centroid that point can be (see acceptance_radius_squared).
+"""
+
+import itertools
+import numpy as np
+
+__author__ = "Givanna Putri, Deeksha Singh, Mark Read, and Tao Tang"
+__copyright__ = "Copyright 2017, Cytoclust Project"
+__credits__ = ["Givanna Putri", "Deeksha Singh", "Mark Read", "Tao Tang"]
+__version__ = "0.0.1"
+__maintainer__ = "Givanna Putri"
+__email__ = "ghar1821@uni.sydney.edu.au"
+__status__ = "Development"
+
+# Relative margin added to the bounds so rounding errors never make them prune a microcluster they shouldn't.
+BOUND_MARGIN = 1e-6
+
+
+def acceptance_radius_squared(cf1, cf2, cumulative_weight, radius_threshold_squared, k_constant):
+    """
+    Calculate how far (squared euclidean distance) from their centroid a point can be for microclusters to possibly
+    take it. Adding a point x to a microcluster of weight w changes the variance along dimension i to
+    (w / (w + 1)) * var_i + (w / (w + 1)^2) * (x_i - centroid_i)^2, and each of them is at least divided by k in the
+    projected radius. The projected radius of a microcluster can thus only stay within the radius threshold if
+    ||x - centroid||^2 <= ((w + 1)^2 / w) * (k * radius_threshold_squared - (w / (w + 1)) * sum_i var_i).
+
+    Args:
+        cf1 (numpy.array): 2d array containing the CF1 of each microcluster.
+        cf2 (numpy.array): 2d array containing the CF2 of each microcluster.
+        cumulative_weight (numpy.array): Weight of each microcluster.
+        radius_threshold_squared (float): Squared maximum projected radius (epsilon squared).
+        k_constant (float): Largest value a dimension can have in the preferred dimension vector.
+
+    Returns:
+        numpy.array: The bound for each microcluster, negative for those which can't take any point.
+    """
+    # A weight decayed all the way to 0 gives a huge bound rather than a division by 0.
+    weight = np.maximum(cumulative_weight, np.finfo(float).tiny)
+    variance = (cf2 / weight[:, np.newaxis]) - ((cf1 / weight[:, np.newaxis]) ** 2)
+    total_variance = np.maximum(variance, 0).sum(axis=1) * (1 - BOUND_MARGIN)
+    slack = (k_constant * radius_threshold_squared * (1 + BOUND_MARGIN)) - (weight / (weight + 1)) * total_variance
+    return ((weight + 1) ** 2 / weight) * slack * (1 + BOUND_MARGIN)
+
+
+class MicroclusterIndex(object):
+    # Maximum number of dimensions the grid is laid over.
+    MAX_GRID_DIMENSIONS = 3
+
+    def __init__(self, store, cell_width, radius_threshold_squared, k_constant):
+        """
+        Grid index over the centroids of the microclusters in a store. The store tells the index which
+        microclusters changed, and the index catches up with those changes before answering a query, so it stays
+        correct while centroids drift as points are added and microclusters are added or removed.
+
+        The grid cells hold the rows of the microclusters whose centroid is in them, so a query gathers rows with a
+        few array operations whatever the number of microclusters found. Microclusters which may take a point
+        further than cell_width from their centroid (see acceptance_radius_squared) are kept aside as wide
+        microclusters, and returned by every query.
+
+        Args:
+            store (MicroclusterStore): Store holding the microclusters to index.
+            cell_width (float): Width of a grid cell. This is also the radius of the default query.
+            radius_threshold_squared (float): Squared maximum projected radius (epsilon squared).
+            k_constant (float): Constant assigned to preferred dimensions in the preferred dimension vector.
+        """
+        self.store = store
+        self.cell_width = cell_width
+        self.radius_threshold_squared = radius_threshold_squared
+        # Projected distance divides by either 1 or k_constant.
+        self.max_scaling = max(float(k_constant), 1.0)
+
+        self.grid_dimensions = np.zeros(0, dtype=int)
+        # Grid cell (tuple of int) -> array of the rows of the microclusters whose centroid is in the cell.
+        self._cells = {}
+        # Microcluster -> its row and the grid cell it is in (None for wide microclusters).
+        self._locations = {}
+        self._wide = set()
+        self._wide_rows = np.zeros(0, dtype=int)
+        self._changed = set()
+        self._all_changed = True
+
+    def mark_changed(self, microcluster):
+        """
+        Record that a microcluster was added to, removed from or modified in the store.
+
+        Args:
+            microcluster (Microcluster): The microcluster.
+
+        Returns:
+            None.
+        """
+        self._changed.add(microcluster)
+
+    def mark_all_changed(self):
+        """Record that all microclusters of the store may have been modified."""
+        self._all_changed = True
+
+    def get_candidate_rows(self, datapoint, radius=None):
+        """
+        Get the rows of the microclusters whose centroid is within radius of a point along each grid dimension, and
+        of the wide microclusters. Any other microcluster is further than radius from the point, so its projected
+        distance to the point is greater than radius^2 / k, and it can't take the point.
+
+        Args:
+            datapoint (numpy.array): The point.
+            radius (float, optional): Radius of the query. Defaults to the width of a cell.
+
+        Returns:
+            numpy.array: Sorted rows of the microclusters.
+        """
+        self._catch_up()
+
+        radius = self.cell_width if radius is None else radius
+        radius = radius * (1 + BOUND_MARGIN)
+        values = datapoint[self.grid_dimensions]
+        lowest = np.floor((values - radius) / self.cell_width).astype(int).tolist()
+        highest = np.floor((values + radius) / self.cell_width).astype(int).tolist()
+
+        rows = [self._wide_rows]
+        if np.prod([high - low + 1 for low, high in zip(lowest, highest)], dtype=float) <= len(self._cells):
+            for cell in itertools.product(*[range(low, high + 1) for low, high in zip(lowest, highest)]):
+                cell_rows = self._cells.get(cell)
+                if cell_rows is not None:
+                    rows.append(cell_rows)
+        else:
+            # The query covers more cells than there are occupied cells. Go through the occupied ones instead.
+            for cell, cell_rows in self._cells.items():
+                if all(low <= value <= high for low, value, high in zip(lowest, cell, highest)):
+                    rows.append(cell_rows)
+
+        rows = np.concatenate(rows)
+        rows.sort()
+        return rows
+
+    def _catch_up(self):
+        """Bring the index up to date with the microclusters changed since the last query."""
+        if self._all_changed:
+            self._rebuild()
+            return
+        if len(self._changed) == 0:
+            return
+
+        # A row freed by a microcluster may have been taken by another one, so all changed microclusters are taken
+        # out of the index before putting back those still in the store.
+        for microcluster in self._changed:
+            self._discard(microcluster)
+        changed = [microcluster for microcluster in self._changed if microcluster in self.store]
+        self._changed = set()
+        if len(changed) > 0:
+            self._place(changed, np.array([microcluster._row for microcluster in changed]))
+        self._wide_rows = np.array(sorted(self._wide), dtype=int)
+
+    def _rebuild(self):
+        """Index all the microclusters of the store again, choosing the grid dimensions anew."""
+        self._cells = {}
+        self._locations = {}
+        self._wide = set()
+        self._changed = set()
+        self._all_changed = False
+
+        rows = self.store.rows
+        if len(rows) > 0:
+            # Lay the grid over the dimensions the centroids are the most spread out along, as these prune the most.
+            num_grid_dimensions = min(self.MAX_GRID_DIMENSIONS, self.store.dimensionality)
+            spread = np.ptp(self.store.cluster_centroids[rows], axis=0)
+            self.grid_dimensions = np.sort(np.argsort(-spread, kind='stable')[:num_grid_dimensions])
+            self._place([self.store[row] for row in rows], rows)
+
+        self._wide_rows = np.array(sorted(self._wide), dtype=int)
+
+    def _place(self, microclusters, rows):
+        """
+        Put microclusters in the cell their centroid is in, or aside as wide microclusters.
+
+        Args:
+            microclusters (list): The microclusters, not currently in the index.
+            rows (numpy.array): Rows of the microclusters in the store.
+
+        Returns:
+            None.
+        """
+        store = self.store
+        bound = acceptance_radius_squared(store.CF1[rows], store.CF2[rows], store.cumulative_weight[rows],
+                                          self.radius_threshold_squared, self.max_scaling)
+        is_wide = (bound > self.cell_width ** 2).tolist()
+        cells = np.floor(store.cluster_centroids[rows][:, self.grid_dimensions] / self.cell_width).astype(int)
+
+        new_rows = {}
+        for microcluster, row, wide, cell in zip(microclusters, rows.tolist(), is_wide, map(tuple, cells.tolist())):
+            if wide:
+                self._wide.add(row)
+                self._locations[microcluster] = (row, None)
+            else:
+                new_rows.setdefault(cell, []).append(row)
+                self._locations[microcluster] = (row, cell)
+
+        for cell, cell_rows in new_rows.items():
+            if cell in self._cells:
+                cell_rows = np.concatenate((self._cells[cell], cell_rows))
+            self._cells[cell] = np.array(cell_rows, dtype=int)
+
+    def _discard(self, microcluster):
+        """
+        Take a microcluster out of the index, if it is in it.
+
+        Args:
+            microcluster (Microcluster): The microcluster.
+
+        Returns:
+            None.
+        """
+        location = self._locations.pop(microcluster, None)
+        if location is None:
+            return
+
+        row, cell = location
+        if cell is None:
+            self._wide.discard(row)
+            return
+        cell_rows = self._cells[cell]
+        cell_rows = cell_rows[cell_rows != row]
+        if len(cell_rows) == 0:
+            del self._cells[cell]
+        else:
+            self._cells[cell] = cell_rows
@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+"""
+Contiguous, array-backed storage for HDDStream microclusters.
+
+Rather than every Microcluster holding its own CF1, CF2, centroid and preferred dimension vector, the store keeps them
+as rows of 2-D matrices (and weight, creation time and pdim as vectors) so decay, pdim counts and the other checks run
+as single array operations over all microclusters. Microcluster objects attached to a store are thin views of one row.
+
+A microcluster keeps its row for as long as it is in the store. Removing it frees the row, which is reused by the next
+microcluster added, so adding, removing and moving microclusters between stores take constant time.
+"""
+
+import numpy as np
+
+from .kernels import dist_squared, pair_dist_squared, sum_over_dimensions
+
+__author__ = "Givanna Putri, Deeksha Singh, Mark Read, and Tao Tang"
+__copyright__ = "Copyright 2017, Cytoclust Project"
+__credits__ = ["Givanna Putri", "Deeksha Singh", "Mark Read", "Tao Tang"]
+__version__ = "0.0.1"
+__maintainer__ = "Givanna Putri"
+__email__ = "ghar1821@uni.sydney.edu.au"
+__status__ = "Development"
+
+# Attributes stored per dimension i.e. as a row of a 2-D matrix.
+VECTOR_ATTRIBUTES = ('CF1', 'CF2', 'cluster_centroids', 'preferred_dimension_vector')
+# Attributes stored as a single value per microcluster.
+SCALAR_ATTRIBUTES = ('cumulative_weight', 'creation_time_in_hrs')
+STORED_ATTRIBUTES = VECTOR_ATTRIBUTES + SCALAR_ATTRIBUTES
+# Attributes a MicroclusterIndex over the store depends on.
+INDEXED_ATTRIBUTES = ('CF1', 'CF2', 'cluster_centroids', 'cumulative_weight')
+
+
+class MicroclusterStore(object):
+    def __init__(self, dimensionality=0, initial_capacity=64):
+        """
+        Collection of microclusters stored as contiguous arrays. It behaves like the list of Microcluster objects
+        HDDStream used to keep: it can be iterated (in row order), indexed by row, appended to and removed from.
+
+        Each microcluster occupies one row of the arrays. Free rows, left by removed microclusters, hold a
+        microcluster of weight 1 whose centroid is infinitely far from any point, so whole-array operations such as
+        finding the closest microcluster to a point never pick them. The array properties below have a value for
+        every row up to num_rows, free ones included. The rows property gives the rows in use.
+
+        Args:
+            dimensionality (int, optional): Number of dimensions of the microclusters. If 0, it is set when the first
+                microcluster is appended.
+            initial_capacity (int, optional): Number of rows to allocate upfront. The arrays grow as needed.
+        """
+        self.dimensionality = dimensionality
+        self._capacity = 0
+        self._arrays = {}
+        self._pdim = np.zeros(0, dtype=int)
+        self._in_use = np.zeros(0, dtype=bool)
+        # Microcluster views, aligned with the rows of the arrays. None for free rows.
+        self._microclusters = []
+        self._free_rows = []
+        self._allocate(max(initial_capacity, 1))
+        # MicroclusterIndex kept up to date with the microclusters in the store, if any. It is not pickled.
+        self.index = None
+
+    @classmethod
+    def from_microclusters(cls, microclusters):
+        """
+        Create a store holding the given microclusters, e.g. a list restored from an older program state.
+
+        Args:
+            microclusters (list): List of Microcluster objects.
+
+        Returns:
+            MicroclusterStore: The store containing all the microclusters, in the same order.
+        """
+        store = cls(initial_capacity=len(microclusters))
+        for microcluster in microclusters:
+            store.append(microcluster)
+        return store
+
+    def __getstate__(self):
+        """Return state values to be pickled. Only the rows up to num_rows are pickled."""
+        num_rows = self.num_rows
+        return {'dimensionality': self.dimensionality,
+                'arrays': {name: array[:num_rows] for name, array in self._arrays.items()},
+                'pdim': self._pdim[:num_rows],
+                'microclusters': self._microclusters,
+                'free_rows': self._free_rows}
+
+    def __setstate__(self, state):
+        """Restore state from the unpickled state values."""
+        self.dimensionality = state['dimensionality']
+        self._arrays = {name: np.array(array) for name, array in state['arrays'].items()}
+        self._pdim = np.array(state['pdim'])
+        self._microclusters = state['microclusters']
+        self._free_rows = state.get('free_rows', [])
+        self._in_use = np.array([microcluster is not None for microcluster in self._microclusters], dtype=bool)
+        self._capacity = len(self._pdim)
+        self.index = None
+
+    def __len__(self):
+        return len(self._microclusters) - len(self._free_rows)
+
+    def __iter__(self):
+        # Iterate over a copy so microclusters can be removed while iterating.
+        return iter([microcluster for microcluster in self._microclusters if microcluster is not None])
+
+    def __getitem__(self, row):
+        return self._microclusters[row]
+
+    def __contains__(self, microcluster):
+        return microcluster._store is self
+
+    @property
+    def num_rows(self):
+        """Number of rows that are either in use or free. Rows after these have never been used."""
+        return len(self._microclusters)
+
+    @property
+    def rows(self):
+        """Rows in use, in increasing order."""
+        return np.flatnonzero(self._in_use[:self.num_rows])
+
+    @property
+    def CF1(self):
+        return self._arrays['CF1'][:self.num_rows]
+
+    @property
+    def CF2(self):
+        return self._arrays['CF2'][:self.num_rows]
+
+    @property
+    def cluster_centroids(self):
+        return self._arrays['cluster_centroids'][:self.num_rows]
+
+    @property
+    def preferred_dimension_vector(self):
+        return self._arrays['preferred_dimension_vector'][:self.num_rows]
+
+    @property
+    def cumulative_weight(self):
+        return self._arrays['cumulative_weight'][:self.num_rows]
+
+    @property
+    def creation_time_in_hrs(self):
+        return self._arrays['creation_time_in_hrs'][:self.num_rows]
+
+    @property
+    def pdim(self):
+        """Preference dimensionality of each microcluster i.e. number of dimensions whose preference is not 1."""
+        return self._pdim[:self.num_rows]
+
+    def _allocate(self, capacity):
+        """
+        Allocate arrays large enough to hold capacity microclusters, keeping the values of the rows up to num_rows.
+
+        Args:
+            capacity (int): Number of rows to allocate.
+
+        Returns:
+            None.
+        """
+        num_rows = self.num_rows
+        arrays = {}
+        for name in VECTOR_ATTRIBUTES:
+            arrays[name] = np.zeros((capacity, self.dimensionality))
+        arrays['cumulative_weight'] = np.zeros(capacity)
+        arrays['creation_time_in_hrs'] = np.zeros(capacity, dtype=int)
+        pdim = np.zeros(capacity, dtype=int)
+        in_use = np.zeros(capacity, dtype=bool)
+
+        if num_rows > 0:
+            for name, array in self._arrays.items():
+                arrays[name][:num_rows] = array[:num_rows]
+            pdim[:num_rows] = self._pdim[:num_rows]
+            in_use[:num_rows] = self._in_use[:num_rows]
+
+        self._arrays = arrays
+        self._pdim = pdim
+        self._in_use = in_use
+        self._capacity = capacity
+        self._clear_rows(np.arange(num_rows, capacity))
+
+    def _clear_rows(self, rows):
+        """
+        Make rows hold a microcluster of weight 1 with a centroid infinitely far from any point, as free rows do.
+
+        Args:
+            rows (numpy.array): The rows.
+
+        Returns:
+            None.
+        """
+        for name in ('CF1', 'CF2', 'creation_time_in_hrs'):
+            self._arrays[name][rows] = 0
+        self._arrays['cluster_centroids'][rows] = np.inf
+        self._arrays['preferred_dimension_vector'][rows] = 1
+        self._arrays['cumulative_weight'][rows] = 1
+        self._pdim[rows] = 0
+
+    def _take_rows(self, num_rows):
+        """
+        Get rows to put microclusters in, reusing free rows first.
+
+        Args:
+            num_rows (int): Number of rows needed.
+
+        Returns:
+            list: The rows.
+        """
+        num_reused_rows = min(num_rows, len(self._free_rows))
+        rows = self._free_rows[len(self._free_rows) - num_reused_rows:]
+        del self._free_rows[len(self._free_rows) - num_reused_rows:]
+
+        first_new_row = self.num_rows
+        num_new_rows = num_rows - len(rows)
+        if first_new_row + num_new_rows > self._capacity:
+            self._allocate(max(2 * self._capacity, first_new_row + num_new_rows))
+        rows.extend(range(first_new_row, first_new_row + num_new_rows))
+        self._microclusters.extend([None] * num_new_rows)
+        return rows
+
+    def _release_rows(self, rows):
+        """
+        Free rows whose microclusters have been detached from or moved out of the store.
+
+        Args:
+            rows (list): The rows.
+
+        Returns:
+            None.
+        """
+        self._clear_rows(rows)
+        self._in_use[rows] = False
+        for row in rows:
+            self._microclusters[row] = None
+        self._free_rows.extend(rows)
+
+    def get_value(self, attribute, row):
+        """
+        Get the value of an attribute of the microcluster stored in a row. Per dimension attributes are returned as a
+        view of the row, so modifying them in place modifies the store.
+
+        Args:
+            attribute (str): Name of the attribute, one of STORED_ATTRIBUTES.
+            row (int): Row of the microcluster.
+
+        Returns:
+            numpy.array or scalar: Value of the attribute.
+        """
+        value = self._arrays[attribute][row]
+        if attribute == 'cumulative_weight':
+            return float(value)
+        if attribute == 'creation_time_in_hrs':
+            return int(value)
+        return value
+
+    def set_value(self, attribute, row, value):
+        """
+        Set the value of an attribute of the microcluster stored in a row.
+
+        Args:
+            attribute (str): Name of the attribute, one of STORED_ATTRIBUTES.
+            row (int): Row of the microcluster.
+            value (numpy.array or scalar): New value of the attribute.
+
+        Returns:
+            None.
+        """
+        self._arrays[attribute][row] = value
+        if attribute == 'preferred_dimension_vector':
+            self._pdim[row] = (self._arrays[attribute][row] > 1).sum()
+        if self.index is not None and attribute in INDEXED_ATTRIBUTES:
+            self.index.mark_changed(self._microclusters[row])
+
+    def mark_changed(self, row):
+        """
+        Tell the index over the store, if any, that the values of the microcluster in a row were modified directly in
+        the arrays rather than through the microcluster.
+
+        Args:
+            row (int): Row of the microcluster.
+
+        Returns:
+            None.
+        """
+        if self.index is not None:
+            self.index.mark_changed(self._microclusters[row])
+
+    def append(self, microcluster):
+        """
+        Add a microcluster to the store. The microcluster's values are copied into the store and the microcluster
+        becomes a view of its row.
+
+        Args:
+            microcluster (Microcluster): Microcluster to add. It must not be attached to another store.
+
+        Returns:
+            None.
+        """
+        if microcluster._store is not None:
+            raise ValueError("Microcluster {} is already stored in a MicroclusterStore.".format(microcluster.id))
+
+        if self.dimensionality == 0:
+            self.dimensionality = len(microcluster.CF1)
+            self._allocate(self._capacity)
+
+        row = self._take_rows(1)[0]
+        values = {name: getattr(microcluster, name) for name in STORED_ATTRIBUTES}
+        for name, value in values.items():
+            if value is not None:
+                self._arrays[name][row] = value
+        if values['preferred_dimension_vector'] is None:
+            self._arrays['preferred_dimension_vector'][row] = 1
+        if values['cluster_centroids'] is None:
+            self._arrays['cluster_centroids'][row] = 0
+        self._pdim[row] = (self._arrays['preferred_dimension_vector'][row] > 1).sum()
+
+        self._attach([microcluster], [row])
+
+    def _attach(self, microclusters, rows):
+        """
+        Make microclusters views of the rows holding their values.
+
+        Args:
+            microclusters (list): The microclusters.
+            rows (list): Row of each microcluster.
+
+        Returns:
+            None.
+        """
+        self._in_use[rows] = True
+        for microcluster, row in zip(microclusters, rows):
+            self._microclusters[row] = microcluster
+            microcluster.attach(self, row)
+            if self.index is not None:
+                self.index.mark_changed(microcluster)
+
+    def remove(self, microcluster):
+        """
+        Remove a microcluster from the store. The microcluster gets its own copy of its values back, and its row is
+        freed.
+
+        Args:
+            microcluster (Microcluster): Microcluster to remove.
+
+        Returns:
+            None.
+        """
+        if microcluster._store is not self:
+            raise ValueError("Microcluster {} is not stored in this MicroclusterStore.".format(microcluster.id))
+        self.remove_rows([microcluster._row])
+
+    def remove_rows(self, rows):
+        """
+        Remove the microclusters stored in some rows. They get their own copy of their values back.
+
+        Args:
+            rows (numpy.array): Rows of the microclusters to remove.
+
+        Returns:
+            None.
+        """
+        rows = list(rows)
+        for row in rows:
+            microcluster = self._microclusters[row]
+            microcluster.detach()
+            if self.index is not None:
+                self.index.mark_changed(microcluster)
+        self._release_rows(rows)
+
+    def move_rows(self, rows, destination):
+        """
+        Move the microclusters stored in some rows to another store, copying all their values at once. They become
+        views of their new rows.
+
+        Args:
+            rows (numpy.array): Rows of the microclusters to move.
+            destination (MicroclusterStore): Store to move them to.
+
+        Returns:
+            list: Rows of the microclusters in the destination store, in the same order.
+        """
+        rows = list(rows)
+        if len(rows) == 0:
+            return []
+        if destination.dimensionality == 0:
+            destination.dimensionality = self.dimensionality
+            destination._allocate(destination._capacity)
+
+        microclusters = [self._microclusters[row] for row in rows]
+        destination_rows = destination._take_rows(len(rows))
+        for name, array in self._arrays.items():
+            destination._arrays[name][destination_rows] = array[rows]
+        destination._pdim[destination_rows] = self._pdim[rows]
+
+        destination._attach(microclusters, destination_rows)
+        if self.index is not None:
+            for microcluster in microclusters:
+                self.index.mark_changed(microcluster)
+        self._release_rows(rows)
+        return destination_rows
+
+    def decay(self, decay_factor):
+        """
+        Decay the CF1, CF2 and weight of all microclusters.
+
+        Args:
+            decay_factor (float): Factor to multiply the values with.
+
+        Returns:
+            None.
+        """
+        self.CF1[:] *= decay_factor
+        self.CF2[:] *= decay_factor
+        self.cumulative_weight[:] *= decay_factor
+        # Free rows keep a weight of 1.
+        self.cumulative_weight[~self._in_use[:self.num_rows]] = 1
+        if self.index is not None:
+            self.index.mark_all_changed()
+
+    def set_centroids(self, rows=None):
+        """
+        Calculate and set the centroid of microclusters.
+
+        Args:
+            rows (numpy.array, optional): Rows of the microclusters to update. All microclusters if not given.
+
+        Returns:
+            None.
+        """
+        rows = self.rows if rows is None else rows
+        centroids = self._arrays['CF1'][rows] / self._arrays['cumulative_weight'][rows, np.newaxis]
+        self._arrays['cluster_centroids'][rows] = centroids
+        if self.index is not None:
+            self.index.mark_all_changed()
+
+    def update_preferred_dimensions(self, variance_threshold_squared, k_constant, rows=None):
+        """
+        Calculate the preferred dimensions (and pdim) of microclusters. See Microcluster.update_preferred_dimensions.
+
+        Args:
+            variance_threshold_squared (float): The squared variance threshold.
+            k_constant (int): Constant assigned to a dimension whose variance is smaller than the threshold.
+            rows (numpy.array, optional): Rows of the microclusters to update. All microclusters if not given.
+
+        Returns:
+            None.
+        """
+        rows = self.rows if rows is None else rows
+        weight = self._arrays['cumulative_weight'][rows, np.newaxis]
+        squared_variance = (self._arrays['CF2'][rows] / weight) - ((self._arrays['CF1'][rows] / weight) ** 2)
+        preferred = squared_variance <= variance_threshold_squared
+        self._arrays['preferred_dimension_vector'][rows] = np.where(preferred, k_constant, 1)
+        self._pdim[rows] = (self._arrays['preferred_dimension_vector'][rows] > 1).sum(axis=-1)
+
+    def calculate_projected_radius_squared(self):
+        """
+        Calculate the squared projected radius of all microclusters. See Microcluster.calculate_projected_radius_squared.
+
+        Returns:
+            numpy.array: Squared projected radius of the microcluster in each row (0 for free rows).
+        """
+        weight = self.cumulative_weight[:, np.newaxis]
+        variance = (self.CF2 / weight) - ((self.CF1 / weight) ** 2)
+        return sum_over_dimensions((1.0 / self.preferred_dimension_vector) * variance)
+
+    def get_projected_dist_to_point(self, other_point, rows=None):
+        """
+        Calculate the projected distance between every microcluster and a datapoint. See
+        Microcluster.get_projected_dist_to_point.
+
+        Args:
+            other_point (numpy.array): The datapoint represented as an array of value of each of its dimension.
+            rows (numpy.array, optional): Rows of the microclusters to calculate the distance for. All
+                microclusters if not given.
+
+        Returns:
+            numpy.array: Projected distance between each microcluster and the datapoint.
+        """
+        rows = slice(0, self.num_rows) if rows is None else rows
+        return pair_dist_squared(other_point, self._arrays['cluster_centroids'][rows],
+                                 self._arrays['preferred_dimension_vector'][rows], divide=True)
+
+    def get_projected_dist_to_points(self, datapoints):
+        """
+        Calculate the projected distance between every microcluster and each of several datapoints.
+
+        Args:
+            datapoints (numpy.array): 2d array, each row containing a datapoint.
+
+        Returns:
+            numpy.array: 2d array of shape (number of datapoints, number of microclusters) containing the projected
+                distances. Each value is exactly what get_projected_dist_to_point gives.
+        """
+        return dist_squared(datapoints, self.cluster_centroids, self.preferred_dimension_vector, divide=True)
+
+    def get_tentative_insertion(self, datapoint, variance_threshold_squared, k_constant, rows=None):
+        """
+        Simulate adding a datapoint to microclusters, without modifying any of them. As CF1 and CF2 are additive,
+        this gives for all microclusters at once the same values Microcluster.get_copy_with_new_point would give one
+        microcluster at a time, without creating any copy.
+
+        Args:
+            datapoint (numpy.array): The datapoint represented as an array of value of each of its dimension. It can
+                also be a 2d array with one datapoint per row in rows, in which case each datapoint is paired with
+                the microcluster in the same position in rows.
+            variance_threshold_squared (float): Variance threshold used to calculate the preferred dimension vector.
+            k_constant (int): k_constant used to calculate the preferred dimension vector.
+            rows (numpy.array, optional): Rows of the microclusters to simulate. All microclusters if not given.
+
+        Returns:
+            tuple: Three numpy.array, each containing a value per microcluster: the pdim after adding the datapoint,
+                the projected distance between the datapoint and the microcluster (before adding the datapoint), and
+                the squared projected radius after adding the datapoint.
+        """
+        rows = slice(0, self.num_rows) if rows is None else rows
+
+        tentative_weight = self._arrays['cumulative_weight'][rows, np.newaxis] + 1
+        tentative_cf1 = self._arrays['CF1'][rows] + datapoint
+        tentative_cf2 = self._arrays['CF2'][rows] + datapoint ** 2
+        tentative_variance = (tentative_cf2 / tentative_weight) - ((tentative_cf1 / tentative_weight) ** 2)
+        tentative_preferred_dimension_vector = np.where(tentative_variance <= variance_threshold_squared,
+                                                        k_constant, 1)
+
+        tentative_pdim = (tentative_preferred_dimension_vector != 1).sum(axis=1)
+        distance = pair_dist_squared(datapoint, self._arrays['cluster_centroids'][rows],
+                                     self._arrays['preferred_dimension_vector'][rows], divide=True)
+        tentative_radius_squared = sum_over_dimensions((1.0 / tentative_preferred_dimension_vector) *
+                                                       tentative_variance)
+
+        return tentative_pdim, distance, tentative_radius_squared
+
+    def is_core(self, radius_threshold_squared, density_threshold, max_subspace_dimensionality):
+        """
+        Check which microclusters are core microclusters. See Microcluster.is_core.
+
+        Args:
+            radius_threshold_squared (float): Squared minimum projected radius.
+            density_threshold (float): Squared maximum density threshold.
+            max_subspace_dimensionality (int): Minimum number of dimensions in pdim with value k_constant.
+
+        Returns:
+            numpy.array: Boolean array with a value per row, True for each row holding a core microcluster.
+        """
+        return ((self.calculate_projected_radius_squared() <= radius_threshold_squared)
+                & (self.cumulative_weight >= density_threshold)
+                & (self.pdim <= max_subspace_dimensionality)
+                & self._in_use[:self.num_rows])
@@ -5,9 +5,17 @@ PreDeCon algorithm. See the following paper for more information.
 [2] Bohm, Christian, et al. "Density connected clustering with local subspace preferences." Data Mining, 2004.
 The paper will be referred as paper[2].
 """
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import shared_memory
+
 import numpy as np
 
 from .helper_objects import Microcluster
+from .kernels import centroids_within
+from .kernels import pair_dist_squared
 
 __author__ = "Givanna Putri, Deeksha Singh, Mark Read, and Tao Tang"
 __copyright__ = "Copyright 2017, Cytoclust Project"
@@ -18,8 +26,76 @@ __email__ = "ghar1821@uni.sydney.edu.au"
 __status__ = "Development"
 
 
+class NeighbourhoodGraph(object):
+    def __init__(self, datapoint_ids, dimension_values, neighbour_starts, neighbour_rows, preference_vectors,
+                 is_weighted_neighbour, epsilon, delta, k):
+        """
+        Neighbourhoods, subspace preference vectors and weighted neighbours found by a run of PreDeCon, along with the
+        core status of the datapoints and the clusters expanded from them. Kept so the next run on mostly the same
+        datapoints only has to find those of the datapoints which changed, and only expands again the clusters that
+        may have changed. See PreDeCon._update_neighbourhood_graph and PreDeCon._find_replayable_expansions.
+
+        Args:
+            datapoint_ids (list): Id of the datapoint in each row.
+            dimension_values (numpy.array): 2d array containing the values of the datapoints the graph was found for,
+                one per row.
+            neighbour_starts (numpy.array): Position of the first neighbour of each datapoint in neighbour_rows.
+            neighbour_rows (numpy.array): Rows of the neighbours of each datapoint, in increasing order.
+            preference_vectors (numpy.array): 2d array containing the subspace preference vector of each datapoint.
+            is_weighted_neighbour (numpy.array): True for each neighbour in neighbour_rows which is also a weighted
+                neighbour.
+            epsilon (float): Epsilon the graph was found with.
+            delta (float): Delta the graph was found with.
+            k (int): K constant the graph was found with.
+        """
+        self.datapoint_ids = datapoint_ids
+        self.dimension_values = dimension_values
+        self.neighbour_starts = neighbour_starts
+        self.neighbour_rows = neighbour_rows
+        self.preference_vectors = preference_vectors
+        self.is_weighted_neighbour = is_weighted_neighbour
+        self.epsilon = epsilon
+        self.delta = delta
+        self.k = k
+        # Set by PreDeCon.run once the clusters are expanded. Whether each datapoint is a core point, whether its pdim
+        # is within lambda, and the ids of the datapoints each cluster was expanded with, in the order they were added
+        # to it, by id of the datapoint the cluster was started from.
+        self.is_core_point = None
+        self.is_pdim_within_lambda = None
+        self.expansions = None
+
+    def __setstate__(self, state):
+        """Restore state from the unpickled state values, including those pickled before the expansions were kept."""
+        self.__dict__.update(state)
+        self.__dict__.setdefault('is_core_point', None)
+        self.__dict__.setdefault('is_pdim_within_lambda', None)
+        self.__dict__.setdefault('expansions', None)
+
+    def is_compatible(self, dataset_dimensionality, epsilon, delta, k):
+        """
+        Check whether the graph can be updated by a run of PreDeCon with the given parameters.
+
+        Args:
+            dataset_dimensionality (int): Number of dimensions in the dataset.
+            epsilon (float): Epsilon for PreDeCon.
+            delta (float): Delta for PreDeCon.
+            k (int): K constant for PreDeCon.
+
+        Returns:
+            bool: True if it can.
+        """
+        return self.dimension_values.shape[1] == dataset_dimensionality and self.epsilon == epsilon and \
+            self.delta == delta and self.k == k
+
+
 class PreDeCon(object):
-    def __init__(self, datapoints, dataset_dimensionality, epsilon, delta, lambbda, mu, k):
+    # Default maximum number of values (e.g. distances between pairs of points) handled at once.
+    MAX_BLOCK_ELEMENTS = 2 ** 20
+    # Below this number of points (or pairs of points), handing them to worker processes costs more than it saves.
+    MIN_PARALLEL_SIZE = 2048
+
+    def __init__(self, datapoints, dataset_dimensionality, epsilon, delta, lambbda, mu, k,
+                 max_block_elements=MAX_BLOCK_ELEMENTS, neighbourhood_graph=None, change_tolerance=0.0, num_workers=1):
         """
         Create the PreDeCon object. The parameters used here have the same name and meaning as Bohm paper. Please
         refer to the paper for more information.
@@ -32,6 +108,18 @@ class PreDeCon(object):
             lambbda (float): Lambda for PreDeCon.
             mu (float): Mu for PreDeCon.
             k (int): K constant for PreDeCon.
+            max_block_elements (int, optional): Maximum number of values handled at once when finding the
+                neighbourhoods. Bounds the memory used.
+            neighbourhood_graph (:obj:NeighbourhoodGraph, optional): Graph found by a previous run on mostly the same
+                datapoints. Only the parts of it affected by the datapoints which were added, removed or moved are
+                found again, and only the clusters in the parts of it that changed are expanded again.
+            change_tolerance (float, optional): How far each value of a datapoint can move before it counts as moved
+                when updating neighbourhood_graph. With 0, the result is exactly what running from scratch would give.
+                Above 0, datapoints which moved less keep their previous neighbourhood, so the clusters are only an
+                approximation, the closer the lower the tolerance.
+            num_workers (int, optional): Number of processes finding the neighbourhoods, subspace preference vectors
+                and weighted neighbours, each for a block of the datapoints. The values of the datapoints are shared
+                with them through shared memory. 1 finds them all in this process.
             logger (:obj:`str`): Directory to put log file for PreDeCon execution.
         """
         self.datapoints = datapoints
@@ -43,15 +131,37 @@ class PreDeCon(object):
         self.lambbda = lambbda
         self.mu = mu
         self.k = k
+        self.max_block_elements = max_block_elements
+        self.neighbourhood_graph = neighbourhood_graph
+        self.change_tolerance = change_tolerance
+        self.num_workers = num_workers
+        # Number of datapoints whose neighbourhood and subspace preference vector were found by the last run, and
+        # number of datapoints in the parts of the graph whose clusters were expanded again rather than replayed.
+        self.num_updated_datapoints = 0
+        self.num_expanded_datapoints = 0
         self.clusters = []
 
+        # Id of the datapoint in each row of the arrays below.
+        self._datapoint_ids = []
+        # Weighted neighbours of all the datapoints, as the rows of the weighted neighbours of the datapoint in row i
+        # being _weighted_neighbour_rows[_weighted_neighbour_starts[i]:_weighted_neighbour_starts[i + 1]].
+        self._weighted_neighbour_starts = np.zeros(1, dtype=int)
+        self._weighted_neighbour_rows = np.zeros(0, dtype=int)
+        # Whether the pdim of each datapoint is within lambda, i.e. whether it can be directly reachable.
+        self._is_pdim_within_lambda = np.zeros(0, dtype=bool)
+
     def run(self):
         """
         Method to run PreDeCon.
+
+        If there is a neighbourhood graph from a previous run, the clusters of the parts of the graph that did not
+        change are rebuilt by adding the same datapoints in the same order as the previous run did, rather than
+        expanded again. See _find_replayable_expansions.
         
         Returns:
             None.
         """
+        previous_graph = self.neighbourhood_graph
         self._find_weighted_neighbours()
 
         # For each datapoint, check and update its core_point status. This is only true if we don't use PreDeCon for
@@ -59,7 +169,17 @@ class PreDeCon(object):
         # cluster) would have been set!
         self._set_is_core_pt()
 
-        for datapt_id, datapoint in self.datapoints.items():
+        # pdim doesn't change during the expansion, so it is calculated once for each datapoint.
+        self._is_pdim_within_lambda = np.array([self.datapoints[datapt_id].get_pdim() <= self.lambbda
+                                                for datapt_id in self._datapoint_ids], dtype=bool)
+        is_core_point = np.array([self.datapoints[datapt_id].is_core_point for datapt_id in self._datapoint_ids],
+                                 dtype=bool)
+
+        # Rows of the datapoints each cluster that can be replayed adds, by row of the datapoint it starts from.
+        replayable_expansions = self._find_replayable_expansions(previous_graph, is_core_point)
+        expansions = {}
+
+        for row, datapoint in enumerate(self.datapoints.values()):
 
             if datapoint.is_unclassified():
                 if datapoint.is_core_point:
@@ -71,7 +191,11 @@ class PreDeCon(object):
                                                preferred_dimension_vector=np.ones(len(datapoint.dimension_values)))
 
                     # Try to expand the new_cluster with the datapoint
-                    self._expand(new_cluster, datapoint)
+                    if row in replayable_expansions:
+                        added_rows = self._replay(new_cluster, replayable_expansions[row])
+                    else:
+                        added_rows = self._expand(new_cluster, row)
+                    expansions[datapoint.id] = [self._datapoint_ids[added_row] for added_row in added_rows]
 
                     new_cluster.update_preferred_dimensions(self.delta_squared, self.k)
 
@@ -82,38 +206,188 @@ class PreDeCon(object):
                 else:
                     datapoint.set_noise()
 
-    def _expand(self, cluster, datapoint):
+        self.neighbourhood_graph.is_core_point = is_core_point
+        self.neighbourhood_graph.is_pdim_within_lambda = self._is_pdim_within_lambda
+        self.neighbourhood_graph.expansions = expansions
+
+    def _expand(self, cluster, row):
         """
         Expand the cluster if possible. See Figure 4 line 6-14 in paper[2]
         
         Args:
             cluster (:obj:Microcluster): Cluster to be expanded
-            datapoint (:obj:Datapoint): Datapoint to expand the cluster with.
+            row (int): Row of the datapoint to expand the cluster with.
 
         Returns:
-            None.
+            list: Rows of the datapoints added to the cluster, in the order they were added.
         """
+        added_rows = []
 
-        # a copy of potential_cluster_members because it will be modified. We don't want to modify parameters. This
-        # will make a copy as the weighted_neighbour_pts contains ids as int.
-        queue = list(datapoint.weighted_neighbour_pts)
+        # Rows of the weighted neighbours of the datapoint, in the same order as its weighted_neighbour_pts.
+        queue = deque(self._weighted_neighbour_rows[self._weighted_neighbour_starts[row]:
+                                                    self._weighted_neighbour_starts[row + 1]].tolist())
 
         while len(queue) > 0:
             # q in paper[2]
-            first_datapt = self.datapoints[queue.pop(0)]
+            first_row = queue.popleft()
             # R in paper[2]
-            directly_reachable_pts = self._find_directly_reachable_points(first_datapt, list(self.datapoints.keys()))
+            directly_reachable_rows = self._find_directly_reachable_rows(first_row)
 
-            for dir_reachable_pt_id in directly_reachable_pts:
+            for dir_reachable_row in directly_reachable_rows:
                 # x in paper[2] figure 4.
-                x = self.datapoints[dir_reachable_pt_id]
+                x = self.datapoints[self._datapoint_ids[dir_reachable_row]]
 
                 # line 10-14 of figure 4 in paper[2]
                 if x.is_unclassified():
-                    queue.append(dir_reachable_pt_id)
+                    queue.append(dir_reachable_row)
                 if x.is_unclassified() or x.is_noise():
                     x.set_classified()
                     x.add_to_cluster(cluster)
+                    added_rows.append(dir_reachable_row)
+        return added_rows
+
+    def _replay(self, cluster, rows):
+        """
+        Add the datapoints a previous run expanded a cluster with to the cluster, in the same order.
+
+        Args:
+            cluster (:obj:Microcluster): Cluster to be rebuilt.
+            rows (list): Rows of the datapoints, in the order the previous run added them.
+
+        Returns:
+            list: Rows of the datapoints added to the cluster, in the order they were added.
+        """
+        added_rows = []
+        for row in rows:
+            x = self.datapoints[self._datapoint_ids[row]]
+            if x.is_unclassified() or x.is_noise():
+                x.set_classified()
+                x.add_to_cluster(cluster)
+                added_rows.append(row)
+        return added_rows
+
+    def _find_replayable_expansions(self, previous_graph, is_core_point):
+        """
+        Find the clusters of a previous run which the expansion would give again, so they can be rebuilt without
+        expanding them.
+
+        The expansion of a cluster only follows the weighted neighbours of core points, and only adds datapoints whose
+        pdim is within lambda. Clusters expanded from datapoints which are not connected that way (in either direction)
+        never meet, so the expansion of each group of connected datapoints gives the same clusters whatever happens to
+        the others. A datapoint changed if it was added, if its core status, its pdim being within lambda or its
+        weighted neighbours changed, or if it was a weighted neighbour of a datapoint which was removed. The clusters
+        of the groups of datapoints, connected by the weighted neighbours of either run, without any datapoint which
+        changed and whose datapoints are in the same order as in the previous run, are the same as in the previous run.
+
+        Args:
+            previous_graph (:obj:NeighbourhoodGraph): Graph of the previous run, if any.
+            is_core_point (numpy.array): Whether each datapoint is a core point now.
+
+        Returns:
+            dict: Rows of the datapoints each cluster which can be replayed was expanded with, in the order they were
+                added, by row of the datapoint it was started from.
+        """
+        num_points = len(self._datapoint_ids)
+        self.num_expanded_datapoints = num_points
+        if previous_graph is None or previous_graph is self.neighbourhood_graph or previous_graph.expansions is None:
+            return {}
+
+        previous_row_of_datapoint = {datapt_id: row for row, datapt_id in enumerate(previous_graph.datapoint_ids)}
+        previous_rows = np.array([previous_row_of_datapoint.get(datapt_id, -1) for datapt_id in self._datapoint_ids],
+                                 dtype=int)
+        kept_rows = np.flatnonzero(previous_rows >= 0)
+        row_of_previous_row = np.full(len(previous_graph.datapoint_ids), -1, dtype=int)
+        row_of_previous_row[previous_rows[kept_rows]] = kept_rows
+
+        # Weighted neighbours of the previous run, as the rows of the datapoints now (-1 for those removed).
+        previous_starts, previous_neighbour_rows = self._get_weighted_neighbours(previous_graph)
+        previous_neighbour_rows = row_of_previous_row[previous_neighbour_rows]
+
+        is_changed = previous_rows < 0
+        is_changed[kept_rows] |= previous_graph.is_core_point[previous_rows[kept_rows]] != is_core_point[kept_rows]
+        is_changed[kept_rows] |= previous_graph.is_pdim_within_lambda[previous_rows[kept_rows]] != \
+            self._is_pdim_within_lambda[kept_rows]
+        num_neighbours = np.diff(self._weighted_neighbour_starts)
+        is_changed[kept_rows] |= num_neighbours[kept_rows] != np.diff(previous_starts)[previous_rows[kept_rows]]
+        same_rows = kept_rows[~is_changed[kept_rows]]
+        differs = self._weighted_neighbour_rows[self._get_segment_positions(self._weighted_neighbour_starts,
+                                                                            same_rows)] != \
+            previous_neighbour_rows[self._get_segment_positions(previous_starts, previous_rows[same_rows])]
+        is_changed[np.repeat(same_rows, num_neighbours[same_rows])[differs]] = True
+        removed_neighbour_rows = previous_neighbour_rows[self._get_segment_positions(
+            previous_starts, np.flatnonzero(row_of_previous_row < 0))]
+        is_changed[removed_neighbour_rows[removed_neighbour_rows >= 0]] = True
+
+        # Group the datapoints connected through the weighted neighbours of core points, now or in the previous run.
+        point_rows = np.repeat(np.arange(num_points), num_neighbours)
+        previous_point_rows = np.repeat(row_of_previous_row, np.diff(previous_starts))
+        is_edge = is_core_point[point_rows]
+        is_previous_edge = (previous_point_rows >= 0) & (previous_neighbour_rows >= 0) & \
+            np.repeat(previous_graph.is_core_point, np.diff(previous_starts))
+        edge_point_rows = np.concatenate((point_rows[is_edge], previous_point_rows[is_previous_edge]))
+        edge_other_rows = np.concatenate((self._weighted_neighbour_rows[is_edge],
+                                          previous_neighbour_rows[is_previous_edge]))
+        groups = self._get_connected_groups(num_points, edge_point_rows, edge_other_rows)
+
+        is_group_changed = np.zeros(num_points, dtype=bool)
+        is_group_changed[groups[is_changed]] = True
+        # The expansion goes through the datapoints in order, so the datapoints of a group must still be in the same
+        # order.
+        unchanged_rows = np.flatnonzero(~is_group_changed[groups])
+        unchanged_rows = unchanged_rows[np.argsort(groups[unchanged_rows], kind='stable')]
+        is_reordered = (groups[unchanged_rows[1:]] == groups[unchanged_rows[:-1]]) & \
+            (previous_rows[unchanged_rows[1:]] < previous_rows[unchanged_rows[:-1]])
+        is_group_changed[groups[unchanged_rows[1:][is_reordered]]] = True
+        is_replayable = ~is_group_changed[groups]
+        self.num_expanded_datapoints = int(num_points - is_replayable.sum())
+
+        row_of_datapoint = {datapt_id: row for row, datapt_id in enumerate(self._datapoint_ids)}
+        replayable_expansions = {}
+        for seed_id, member_ids in previous_graph.expansions.items():
+            seed_row = row_of_datapoint.get(seed_id)
+            if seed_row is not None and is_replayable[seed_row]:
+                replayable_expansions[seed_row] = [row_of_datapoint[member_id] for member_id in member_ids]
+        return replayable_expansions
+
+    @staticmethod
+    def _get_weighted_neighbours(graph):
+        """
+        Get the weighted neighbours of the datapoints of a neighbourhood graph.
+
+        Args:
+            graph (:obj:NeighbourhoodGraph): The graph.
+
+        Returns:
+            tuple: The rows of the weighted neighbours of the datapoint in row i being rows[starts[i]:starts[i + 1]],
+                as starts and rows.
+        """
+        num_weighted_neighbours_before = np.concatenate(([0], np.cumsum(graph.is_weighted_neighbour)))
+        return num_weighted_neighbours_before[graph.neighbour_starts], \
+            graph.neighbour_rows[graph.is_weighted_neighbour]
+
+    @staticmethod
+    def _get_connected_groups(num_points, point_rows, other_rows):
+        """
+        Group points connected by edges, whatever their direction.
+
+        Args:
+            num_points (int): Number of points.
+            point_rows (numpy.array): Row of the first point of each edge.
+            other_rows (numpy.array): Row of the second point of each edge.
+
+        Returns:
+            numpy.array: Group of each point, as the lowest row in it.
+        """
+        groups = np.arange(num_points)
+        while True:
+            lowest = np.minimum(groups[point_rows], groups[other_rows])
+            new_groups = np.copy(groups)
+            np.minimum.at(new_groups, point_rows, lowest)
+            np.minimum.at(new_groups, other_rows, lowest)
+            new_groups = new_groups[new_groups]
+            if np.array_equal(new_groups, groups):
+                return groups
+            groups = new_groups
 
     def _set_is_core_pt(self):
         """
@@ -131,144 +405,457 @@ class PreDeCon(object):
         Method to find and set each datapoint's weighted neighbours. Done by first finding normal neighbours and
         calculating subspace preference vector for ALL datapoints.
         Then start calculating weighted neighbours based on those 2 information.
-        
+
+        All of it is done on arrays holding every datapoint, a block of datapoints or (datapoint, neighbour) pairs at a
+        time, so no more than max_block_elements values are handled at once. If there is a neighbourhood graph from a
+        previous run, only the parts of it that changed are found again.
+
         Returns:
             None.
         """
-        for datapt_id, datapt in self.datapoints.items():
-            # Find all the neighbour points and calculate the subspace preference vector
-            datapt.neighbour_pts = self._find_neighbour_points(datapt)
-            datapt.subspace_preference_vector = self._calculate_subspace_preference_vector(datapt)
-
-        # This MUST be done after the preference vectors for all points must have been calculated.
-        for datapt_id, datapt in self.datapoints.items():
-            for neighbour_pt_id in datapt.neighbour_pts:
-                dist = self._calculate_general_weighted_dist_squared(datapt, self.datapoints[neighbour_pt_id])
-                if dist <= self.epsilon_squared:
-                    datapt.weighted_neighbour_pts.append(neighbour_pt_id)
-
-    def _find_neighbour_points(self, point):
+        # Values of all the datapoints, stacked in a matrix so distances are calculated for many points at once.
+        datapoint_ids = list(self.datapoints.keys())
+        dimension_values = np.array([self.datapoints[datapt_id].dimension_values for datapt_id in datapoint_ids],
+                                    dtype=float).reshape(len(datapoint_ids), self.dataset_dimensionality)
+
+        graph = self.neighbourhood_graph
+        if graph is not None and graph.is_compatible(self.dataset_dimensionality, self.epsilon, self.delta, self.k):
+            graph = self._update_neighbourhood_graph(graph, datapoint_ids, dimension_values)
+        else:
+            graph = self._build_neighbourhood_graph(datapoint_ids, dimension_values)
+        self.neighbourhood_graph = graph
+
+        # Kept for the expansion, which follows the weighted neighbours from row to row.
+        self._datapoint_ids = datapoint_ids
+        self._weighted_neighbour_starts, self._weighted_neighbour_rows = self._get_weighted_neighbours(graph)
+
+        neighbour_starts = graph.neighbour_starts
+        neighbour_rows = graph.neighbour_rows
+        for row, datapt_id in enumerate(datapoint_ids):
+            datapt = self.datapoints[datapt_id]
+            start, end = neighbour_starts[row], neighbour_starts[row + 1]
+            datapt.neighbour_pts = [datapoint_ids[neighbour_row] for neighbour_row in neighbour_rows[start:end].tolist()]
+            datapt.subspace_preference_vector = graph.preference_vectors[row].tolist()
+            datapt.weighted_neighbour_pts.extend(
+                datapoint_ids[neighbour_row]
+                for neighbour_row in neighbour_rows[start:end][graph.is_weighted_neighbour[start:end]].tolist())
+
+    def _build_neighbourhood_graph(self, datapoint_ids, dimension_values):
         """
-        Find all points within point's neighbourhood.
+        Find the neighbourhood, subspace preference vector and weighted neighbours of every datapoint.
 
         Args:
-            point (:obj:Datapoint): Datapoint we are interested in finding the neighbourhood for
+            datapoint_ids (list): Id of the datapoint in each row of dimension_values.
+            dimension_values (numpy.array): 2d array containing the values of all the datapoints, one per row.
 
         Returns:
-            list: List of neighbourhood points' id.
+            NeighbourhoodGraph: The graph.
         """
-        neighbour_points_id = []
+        rows = np.arange(len(datapoint_ids))
 
-        for datapt_id, datapt in self.datapoints.items():
-            euclidean_dist = self._calculate_euclidean_dist(datapt.dimension_values, point.dimension_values)
+        # Neighbours of all the datapoints, as the rows of the neighbours of the datapoint in row i being
+        # neighbour_rows[neighbour_starts[i]:neighbour_starts[i + 1]].
+        neighbour_starts, neighbour_rows, preference_vectors = self._find_neighbourhoods(dimension_values, rows)
 
-            # See beginning of chapter 3 of paper[2] for neighbourhood points criteria
-            if euclidean_dist <= self.epsilon:
-                neighbour_points_id.append(datapt_id)
+        # This MUST be done after the preference vectors for all points must have been calculated.
+        point_rows = np.repeat(rows, np.diff(neighbour_starts))
+        is_weighted_neighbour = self._find_weighted_neighbours_among(point_rows, neighbour_rows, dimension_values,
+                                                                     preference_vectors)
 
-        return neighbour_points_id
+        self.num_updated_datapoints = len(rows)
+        return NeighbourhoodGraph(datapoint_ids, dimension_values, neighbour_starts, neighbour_rows, preference_vectors,
+                                  is_weighted_neighbour, self.epsilon, self.delta, self.k)
 
-    @staticmethod
-    def _calculate_euclidean_dist(a, b):
+    def _update_neighbourhood_graph(self, graph, datapoint_ids, dimension_values):
         """
-        Calculate Euclidean distance between two points.
+        Update the neighbourhood graph of a previous run for the current datapoints.
+
+        A datapoint is kept if it was in the previous run and none of its values moved further than change_tolerance
+        from those the graph was found for. Kept datapoints stay where they were in the graph, so the result is exactly
+        the graph of the kept datapoints at their previous values along with the other datapoints at their current
+        values. The datapoints whose neighbourhood may have changed are those which were not kept and those within
+        epsilon of where a datapoint was added, removed or moved to or from. Their neighbourhood and subspace
+        preference vector are found again, along with whether their neighbours are weighted neighbours. All other
+        datapoints keep theirs, which are what finding them again would give.
 
         Args:
-            a (numpy.array): point 1.
-            b (numpy.array): point 2.
+            graph (:obj:NeighbourhoodGraph): Graph found by the previous run.
+            datapoint_ids (list): Id of the datapoint in each row of dimension_values.
+            dimension_values (numpy.array): 2d array containing the values of all the datapoints, one per row.
 
         Returns:
-            Float: Euclidean Distance between 2 points.
+            NeighbourhoodGraph: The updated graph.
+        """
+        num_points = len(datapoint_ids)
+        previous_row_of_datapoint = {datapt_id: row for row, datapt_id in enumerate(graph.datapoint_ids)}
+        previous_rows = np.array([previous_row_of_datapoint.get(datapt_id, -1) for datapt_id in datapoint_ids],
+                                 dtype=int)
+
+        is_kept = previous_rows >= 0
+        kept_rows = np.flatnonzero(is_kept)
+        movement = np.abs(dimension_values[kept_rows] - graph.dimension_values[previous_rows[kept_rows]])
+        is_kept[kept_rows] = np.all(movement <= self.change_tolerance, axis=1)
+        kept_rows = np.flatnonzero(is_kept)
+
+        graph_values = np.copy(dimension_values)
+        graph_values[kept_rows] = graph.dimension_values[previous_rows[kept_rows]]
+        # Row of each previous datapoint now, -1 for those removed or moved.
+        row_of_previous_row = np.full(len(graph.datapoint_ids), -1, dtype=int)
+        row_of_previous_row[previous_rows[kept_rows]] = kept_rows
+
+        # Values a datapoint was added, removed or moved at.
+        changed_values = np.concatenate((graph_values[~is_kept], graph.dimension_values[row_of_previous_row < 0]))
+        is_updated = ~is_kept | self._is_near_any(graph_values, changed_values)
+
+        # The neighbourhoods of the other datapoints are the same, but the rows of the datapoints may be in another
+        # order. The preference vector of a datapoint whose neighbours are now in a different order is found again, as
+        # its variance would be added up in a different order.
+        kept_rows = np.flatnonzero(~is_updated)
+        kept_positions = self._get_segment_positions(graph.neighbour_starts, previous_rows[kept_rows])
+        kept_neighbour_rows = row_of_previous_row[graph.neighbour_rows[kept_positions]]
+        owners = np.repeat(np.arange(len(kept_rows)), np.diff(graph.neighbour_starts)[previous_rows[kept_rows]])
+        is_reordered = (np.diff(kept_neighbour_rows) <= 0) & (owners[1:] == owners[:-1])
+        if is_reordered.any():
+            is_updated[kept_rows[owners[1:][is_reordered]]] = True
+            kept_rows = np.flatnonzero(~is_updated)
+            kept_positions = self._get_segment_positions(graph.neighbour_starts, previous_rows[kept_rows])
+            kept_neighbour_rows = row_of_previous_row[graph.neighbour_rows[kept_positions]]
+
+        updated_rows = np.flatnonzero(is_updated)
+        updated_starts, updated_neighbour_rows, updated_preference_vectors = self._find_neighbourhoods(graph_values,
+                                                                                                       updated_rows)
+
+        num_neighbours = np.zeros(num_points, dtype=int)
+        num_neighbours[kept_rows] = np.diff(graph.neighbour_starts)[previous_rows[kept_rows]]
+        num_neighbours[updated_rows] = np.diff(updated_starts)
+        neighbour_starts = np.zeros(num_points + 1, dtype=int)
+        np.cumsum(num_neighbours, out=neighbour_starts[1:])
+        neighbour_rows = np.zeros(neighbour_starts[-1], dtype=int)
+        neighbour_rows[self._get_segment_positions(neighbour_starts, kept_rows)] = kept_neighbour_rows
+        neighbour_rows[self._get_segment_positions(neighbour_starts, updated_rows)] = updated_neighbour_rows
+
+        preference_vectors = np.zeros(graph_values.shape)
+        preference_vectors[kept_rows] = graph.preference_vectors[previous_rows[kept_rows]]
+        preference_vectors[updated_rows] = updated_preference_vectors
+
+        # Whether a neighbour is a weighted neighbour only changes if either of them was updated.
+        is_weighted_neighbour = np.zeros(len(neighbour_rows), dtype=bool)
+        is_weighted_neighbour[self._get_segment_positions(neighbour_starts, kept_rows)] = \
+            graph.is_weighted_neighbour[kept_positions]
+        point_rows = np.repeat(np.arange(num_points), num_neighbours)
+        to_check = is_updated[point_rows] | is_updated[neighbour_rows]
+        is_weighted_neighbour[to_check] = self._find_weighted_neighbours_among(
+            point_rows[to_check], neighbour_rows[to_check], graph_values, preference_vectors)
+
+        self.num_updated_datapoints = len(updated_rows)
+        return NeighbourhoodGraph(datapoint_ids, graph_values, neighbour_starts, neighbour_rows, preference_vectors,
+                                  is_weighted_neighbour, self.epsilon, self.delta, self.k)
+
+    def _find_neighbourhoods(self, dimension_values, rows):
         """
-        return np.linalg.norm(np.asarray(a) - np.asarray(b))
+        Find the neighbourhood and subspace preference vector of some points. See _find_neighbour_rows and
+        _calculate_subspace_preference_vectors. With more than one worker, each worker process finds them for a block
+        of the points, reading the values of the datapoints from shared memory. Each point's are found the same way
+        either way, so the result doesn't depend on the number of workers.
 
-    def _calculate_subspace_preference_vector(self, point):
+        Args:
+            dimension_values (numpy.array): 2d array containing the values of all the datapoints, one per row.
+            rows (numpy.array): Rows of the points whose neighbourhood is to be found.
+
+        Returns:
+            tuple: The neighbourhoods as returned by _find_neighbour_rows, followed by a 2d numpy.array containing the
+                subspace preference vector of each of the points.
         """
-        Calculate the subspace preference vector of a point (w_p in paper[2]). Refer to definition 3 of paper[2]
+        if self.num_workers <= 1 or len(rows) < self.MIN_PARALLEL_SIZE:
+            neighbour_starts, neighbour_rows = self._find_neighbour_rows(dimension_values, rows)
+            return neighbour_starts, neighbour_rows, self._calculate_subspace_preference_vectors(
+                dimension_values, rows, neighbour_starts, neighbour_rows)
+
+        values_memory, shared_values = share_array(dimension_values)
+        try:
+            with ProcessPoolExecutor(max_workers=min(self.num_workers, os.cpu_count() or 1)) as executor:
+                blocks = list(executor.map(find_neighbourhoods_in_block, repeat(self._get_worker_copy()),
+                                           repeat(shared_values), np.array_split(rows, self.num_workers)))
+        finally:
+            values_memory.close()
+            values_memory.unlink()
+
+        neighbour_starts = np.zeros(len(rows) + 1, dtype=int)
+        np.cumsum(np.concatenate([np.diff(block_starts) for block_starts, _, _ in blocks]), out=neighbour_starts[1:])
+        return neighbour_starts, np.concatenate([block_neighbour_rows for _, block_neighbour_rows, _ in blocks]), \
+            np.concatenate([block_preference_vectors for _, _, block_preference_vectors in blocks])
+
+    def _find_weighted_neighbours_among(self, point_rows, other_rows, dimension_values, preference_vectors):
+        """
+        Check which pairs of points are within epsilon of each other by the general weighted distance. See
+        _is_within_general_weighted_dist. With more than one worker, each worker process checks a block of the pairs,
+        reading the values and subspace preference vectors of the datapoints from shared memory.
 
         Args:
-            point (:obj:Datapoint): PreDeConDatapoint whose subspace preference vector is to be found
+            point_rows (numpy.array): Row of the first point of each pair in dimension_values.
+            other_rows (numpy.array): Row of the second point of each pair in dimension_values.
+            dimension_values (numpy.array): 2d array containing the values of all the datapoints, one per row.
+            preference_vectors (numpy.array): 2d array containing the subspace preference vector of all the
+                datapoints, one per row.
+
+        Returns:
+            numpy.array: Boolean array, True for each pair of points within epsilon of each other.
+        """
+        if self.num_workers <= 1 or len(point_rows) < self.MIN_PARALLEL_SIZE:
+            return self._is_within_general_weighted_dist(point_rows, other_rows, dimension_values, preference_vectors)
+
+        values_memory, shared_values = share_array(dimension_values)
+        preferences_memory, shared_preferences = share_array(preference_vectors)
+        try:
+            with ProcessPoolExecutor(max_workers=min(self.num_workers, os.cpu_count() or 1)) as executor:
+                blocks = list(executor.map(find_weighted_neighbours_in_block, repeat(self._get_worker_copy()),
+                                           repeat(shared_values), repeat(shared_preferences),
+                                           np.array_split(point_rows, self.num_workers),
+                                           np.array_split(other_rows, self.num_workers)))
+        finally:
+            for memory in (values_memory, preferences_memory):
+                memory.close()
+                memory.unlink()
+        return np.concatenate(blocks)
+
+    def _get_worker_copy(self):
+        """
+        Get a copy of this PreDeCon with the same parameters but no datapoints, to hand to the worker processes.
 
         Returns:
-            Array: Subspace preference vector represented by an array.
+            PreDeCon: The copy.
         """
-        subspace_preference_vector = []
-        for dimension in range(self.dataset_dimensionality):
-            variance = self._calculate_variance_along_dimension(point, dimension)
-            if variance <= self.delta:
-                subspace_preference_vector.append(self.k)
-            else:
-                subspace_preference_vector.append(1)
-        return subspace_preference_vector
+        return PreDeCon({}, self.dataset_dimensionality, self.epsilon, self.delta, self.lambbda, self.mu, self.k,
+                        max_block_elements=self.max_block_elements)
 
-    def _calculate_variance_along_dimension(self, point, dimension):
+    def _is_near_any(self, dimension_values, other_values):
         """
-        Calculate the variance of a point's neighbourhood points along a dimension.
-        See Definition 1 in paper[2].
+        Check, for each point, whether any of the other points is within epsilon of it, a block of points at a time.
 
         Args:
-            point (:obj:Datapoint): Current datapoint whose neighbourhood points' variance is to be calculated.
-            dimension (int): Current dimension whose variance to be calculated
+            dimension_values (numpy.array): 2d array containing the values of the points, one per row.
+            other_values (numpy.array): 2d array containing the values of the other points, one per row.
 
         Returns:
-            Float: Variance of neighbourhood of a point along a dimension
+            numpy.array: Boolean array, True for each point within epsilon of any of the other points.
         """
-        result = 0.0
-        for i in point.neighbour_pts:
-            result += (point.dimension_values[dimension] - self.datapoints[i].dimension_values[dimension]) ** 2
-        return result / len(point.neighbour_pts)
+        is_near = np.zeros(len(dimension_values), dtype=bool)
+        if len(other_values) == 0:
+            return is_near
+        block_size = max(1, self.max_block_elements // len(other_values))
+        for start in range(0, len(dimension_values), block_size):
+            is_near[start:start + block_size] = centroids_within(
+                dimension_values[start:start + block_size], other_values, self.epsilon_squared,
+                max_block_elements=self.max_block_elements).any(axis=1)
+        return is_near
 
-    def _calculate_general_weighted_dist_squared(self, p, q):
+    @staticmethod
+    def _get_segment_positions(starts, rows):
         """
-        Method to calculate weighted distance (squared version) between 2 points (dist_pref in paper [2]).
-        See definition 4 in paper[2].
+        Get the positions of the values of some rows in an array holding the values of each row one after the other,
+        the values of row i being between the positions starts[i] and starts[i + 1].
 
         Args:
-            p (:obj:Datapoint): Point 1.
-            q (:obj:Datapoint): Point 2.
+            starts (numpy.array): Position of the first value of each row, followed by the number of values.
+            rows (numpy.array): The rows.
 
         Returns:
-            Float: Squared weighted distance.
+            numpy.array: Positions of the values of the rows, row by row.
         """
-        return max(self._calculate_weighted_dist_squared(p, q),
-                   self._calculate_weighted_dist_squared(q, p))
+        num_values = starts[rows + 1] - starts[rows]
+        values_before = np.cumsum(num_values) - num_values
+        return np.repeat(starts[rows] - values_before, num_values) + np.arange(num_values.sum())
 
-    def _calculate_weighted_dist_squared(self, p, q):
+    def _find_neighbour_rows(self, dimension_values, rows):
         """
-        Calculate the weighted distance between 2 points (dist_p in paper[2]). See definition 3 in paper[2]
+        Find the neighbourhood of some points, i.e. the points within epsilon of each (euclidean distance). See the
+        beginning of chapter 3 of paper[2]. The squared euclidean distance is compared with the squared epsilon, a
+        block of points at a time.
 
         Args:
-            p (:obj:Datapoint): Point 1.
-            q (:obj:Datapoint): Point 2.
+            dimension_values (numpy.array): 2d array containing the values of all the datapoints, one per row.
+            rows (numpy.array): Rows of the points whose neighbourhood is to be found.
 
         Returns:
-            Float: Weighted distance between 2 points
+            tuple: Two 1d numpy.array. The rows of the neighbours of the point rows[i], in increasing order, are in
+                the second one, between the positions given by the values i and i + 1 of the first one.
         """
-        sum = 0.0
-        for i in range(self.dataset_dimensionality):
-            sum += p.subspace_preference_vector[i] * (p.dimension_values[i] - q.dimension_values[i]) ** 2
-        return sum
-
-    def _find_directly_reachable_points(self, point, potential_directly_reachable_points):
+        block_size = max(1, self.max_block_elements // max(len(dimension_values), 1))
+
+        neighbour_rows = [np.zeros(0, dtype=int)]
+        num_neighbours = [np.zeros(0, dtype=int)]
+        for start in range(0, len(rows), block_size):
+            is_neighbour = centroids_within(dimension_values[rows[start:start + block_size]], dimension_values,
+                                            self.epsilon_squared, max_block_elements=self.max_block_elements)
+            # nonzero goes through the block row by row, so the neighbours are grouped by point, in order.
+            neighbour_rows.append(np.nonzero(is_neighbour)[1])
+            num_neighbours.append(is_neighbour.sum(axis=1))
+
+        neighbour_starts = np.zeros(len(rows) + 1, dtype=int)
+        np.cumsum(np.concatenate(num_neighbours), out=neighbour_starts[1:])
+        return neighbour_starts, np.concatenate(neighbour_rows)
+
+    def _calculate_subspace_preference_vectors(self, dimension_values, rows, neighbour_starts, neighbour_rows):
         """
-        Given a point, find all directly reachable points.
+        Calculate the subspace preference vector (w_p in paper[2]) of some points. Refer to definition 3 of paper[2].
+
+        The variance of a point's neighbourhood along each dimension (see Definition 1 in paper[2]) is the mean of
+        the squared differences between the point and its neighbours. These are added up one neighbour at a time, in
+        order, for all points at once, so the variances are exactly those adding them up point by point gives.
 
         Args:
-            point (:obj:Datapoint): Point whose directly reachables points we want to find. If following Figure 4 in
-                paper[2] this should be q.
+            dimension_values (numpy.array): 2d array containing the values of all the datapoints, one per row.
+            rows (numpy.array): Rows of the points whose subspace preference vector is to be calculated.
+            neighbour_starts (numpy.array): Position of the first neighbour of each of the points in neighbour_rows.
+                See _find_neighbour_rows.
+            neighbour_rows (numpy.array): Rows of the neighbours of each of the points.
 
-        potential_directly_reachable_points (:obj:List): List of points that is potentially directly reachable from
-            the point.
+        Returns:
+            numpy.array: 2d array containing the subspace preference vector of each of the points, one per row.
+        """
+        num_neighbours = np.diff(neighbour_starts)
+        squared_differences_sum = np.zeros((len(rows), dimension_values.shape[1]))
+
+        # Points with the most neighbours first, so the points with a neighbour at a given position come first.
+        order = np.argsort(-num_neighbours, kind='stable')
+        sorted_num_neighbours = num_neighbours[order]
+        for position in range(sorted_num_neighbours[0] if len(order) > 0 else 0):
+            num_points = np.searchsorted(-sorted_num_neighbours, -position, side='left')
+            points = order[:num_points]
+            other_rows = neighbour_rows[neighbour_starts[points] + position]
+            squared_differences_sum[points] += (dimension_values[rows[points]] - dimension_values[other_rows]) ** 2
+
+        # Every point is in its own neighbourhood, so none has 0 neighbours.
+        variance = squared_differences_sum / np.maximum(num_neighbours, 1)[:, np.newaxis]
+        return np.where(variance <= self.delta, float(self.k), 1.0)
+
+    def _is_within_general_weighted_dist(self, point_rows, other_rows, dimension_values, preference_vectors):
+        """
+        Check whether the general weighted distance (dist_pref in paper [2]) between pairs of points is within
+        epsilon. See definition 4 in paper[2]. dist_pref is the largest of the weighted distances (dist_p in paper[2],
+        see definition 3) using either point's subspace preference vector, so it is within epsilon if both are. The
+        pairs are handled a block at a time.
+
+        Args:
+            point_rows (numpy.array): Row of the first point of each pair in dimension_values.
+            other_rows (numpy.array): Row of the second point of each pair in dimension_values.
+            dimension_values (numpy.array): 2d array containing the values of all the datapoints, one per row.
+            preference_vectors (numpy.array): 2d array containing the subspace preference vector of all the
+                datapoints, one per row.
 
         Returns:
-            List: List of directly reachable points
+            numpy.array: Boolean array, True for each pair of points within epsilon of each other.
+        """
+        is_within = np.zeros(len(point_rows), dtype=bool)
+        block_size = max(1, self.max_block_elements // max(self.dataset_dimensionality, 1))
+        for start in range(0, len(point_rows), block_size):
+            block_point_rows = point_rows[start:start + block_size]
+            block_other_rows = other_rows[start:start + block_size]
+            points = dimension_values[block_point_rows]
+            other_points = dimension_values[block_other_rows]
+            # dist_p weighted by the first point's preference vector, then by the second point's preference vector.
+            within_by_point = pair_dist_squared(other_points, points,
+                                                preference_vectors[block_point_rows]) <= self.epsilon_squared
+            within_by_other_point = pair_dist_squared(points, other_points,
+                                                      preference_vectors[block_other_rows]) <= self.epsilon_squared
+            is_within[start:start + block_size] = within_by_point & within_by_other_point
+        return is_within
+
+    def _find_directly_reachable_rows(self, row):
         """
-        dir_reachable_pts = []
-        for datapt_id in potential_directly_reachable_points:
-            point_is_core = point.is_core_point
-            pdim_datapt_less_than_threshold = self.datapoints[datapt_id].get_pdim() <= self.lambbda
-            datapt_is_neighbour_of_point = datapt_id in point.weighted_neighbour_pts
+        Given a point, find all directly reachable points. See definition 5 in paper[2]. These are the point's weighted
+        neighbours whose pdim is within lambda, if the point is a core point, and none otherwise.
 
-            if point_is_core and pdim_datapt_less_than_threshold and datapt_is_neighbour_of_point:
-                dir_reachable_pts.append(datapt_id)
-        return dir_reachable_pts
+        Args:
+            row (int): Row of the point whose directly reachable points we want to find. If following Figure 4 in
+                paper[2] this should be q.
+
+        Returns:
+            list: Rows of the directly reachable points, in the order of the datapoints.
+        """
+        if not self.datapoints[self._datapoint_ids[row]].is_core_point:
+            return []
+        weighted_neighbour_rows = self._weighted_neighbour_rows[self._weighted_neighbour_starts[row]:
+                                                                self._weighted_neighbour_starts[row + 1]]
+        return weighted_neighbour_rows[self._is_pdim_within_lambda[weighted_neighbour_rows]].tolist()
+
+
+def share_array(array):
+    """
+    Copy an array into a new block of shared memory, for worker processes to read it without it being pickled. The
+    block must be closed and unlinked once they are done.
+
+    Args:
+        array (numpy.array): The array.
+
+    Returns:
+        tuple: The block of shared memory, and what attach_shared_array needs to read the array from it.
+    """
+    memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)[...] = array
+    return memory, (memory.name, array.shape, array.dtype.str)
+
+
+def attach_shared_array(shared_array):
+    """
+    Read an array copied into shared memory by share_array. The block must be closed once the array is no longer used.
+
+    Args:
+        shared_array (tuple): What share_array returned to read the array.
+
+    Returns:
+        tuple: The block of shared memory, and the array, using it as its buffer.
+    """
+    name, shape, dtype = shared_array
+    memory = shared_memory.SharedMemory(name=name)
+    return memory, np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+
+def find_neighbourhoods_in_block(predecon, shared_values, rows):
+    """
+    Find the neighbourhood and subspace preference vector of a block of points. Run by the worker processes of
+    PreDeCon._find_neighbourhoods.
+
+    Args:
+        predecon (PreDeCon): Copy of the PreDeCon, as unpickled in the worker process.
+        shared_values (tuple): The values of all the datapoints, as shared by share_array.
+        rows (numpy.array): Rows of the points in the block.
+
+    Returns:
+        tuple: The result of PreDeCon._find_neighbourhoods for the block.
+    """
+    values_memory, dimension_values = attach_shared_array(shared_values)
+    try:
+        neighbour_starts, neighbour_rows = predecon._find_neighbour_rows(dimension_values, rows)
+        preference_vectors = predecon._calculate_subspace_preference_vectors(dimension_values, rows, neighbour_starts,
+                                                                             neighbour_rows)
+    finally:
+        # The array must be gone before the shared memory it uses can be closed.
+        del dimension_values
+        values_memory.close()
+    return neighbour_starts, neighbour_rows, preference_vectors
+
+
+def find_weighted_neighbours_in_block(predecon, shared_values, shared_preferences, point_rows, other_rows):
+    """
+    Check which of a block of pairs of points are within epsilon of each other by the general weighted distance. Run by
+    the worker processes of PreDeCon._find_weighted_neighbours_among.
+
+    Args:
+        predecon (PreDeCon): Copy of the PreDeCon, as unpickled in the worker process.
+        shared_values (tuple): The values of all the datapoints, as shared by share_array.
+        shared_preferences (tuple): The subspace preference vectors of all the datapoints, as shared by share_array.
+        point_rows (numpy.array): Row of the first point of each pair.
+        other_rows (numpy.array): Row of the second point of each pair.
+
+    Returns:
+        numpy.array: Boolean array, True for each pair of points within epsilon of each other.
+    """
+    values_memory, dimension_values = attach_shared_array(shared_values)
+    preferences_memory, preference_vectors = attach_shared_array(shared_preferences)
+    try:
+        return predecon._is_within_general_weighted_dist(point_rows, other_rows, dimension_values, preference_vectors)
+    finally:
+        del dimension_values, preference_vectors
+        values_memory.close()
+        preferences_memory.close()
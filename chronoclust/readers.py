@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Readers of the input data files. A data file holds a datapoint per row and an attribute per column, and can be:
+
+- csv: gzipped csv file with a header. The default, for files whose extension is not one of the others.
+- parquet: Parquet file (.parquet, .pq).
+- arrow: Arrow IPC file, also known as Feather (.arrow, .feather, .ipc).
+- hdf5: HDF5 file holding a single pandas DataFrame (.h5, .hdf5, .hdf).
+
+The format is given by the file extension, or by the format attribute of the file entry in the input xml. Parquet and
+Arrow files are read with pyarrow, decoding the columns on several threads, and HDF5 files are read with pandas, which
+needs PyTables. Both are optional dependencies, only needed to read those formats.
+"""
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow.feather as feather
+    import pyarrow.parquet as parquet
+except ImportError:
+    feather = None
+    parquet = None
+
+__author__ = "Givanna Putri, Deeksha Singh, Mark Read, and Tao Tang"
+__copyright__ = "Copyright 2017, Cytoclust Project"
+__credits__ = ["Givanna Putri", "Deeksha Singh", "Mark Read", "Tao Tang"]
+__version__ = "0.0.1"
+__maintainer__ = "Givanna Putri"
+__email__ = "ghar1821@uni.sydney.edu.au"
+__status__ = "Development"
+
+CSV = 'csv'
+PARQUET = 'parquet'
+ARROW = 'arrow'
+HDF5 = 'hdf5'
+
+# Format of the files with each extension. Files with any other extension are taken to be gzipped csv files.
+FORMAT_OF_EXTENSION = {'.parquet': PARQUET, '.pq': PARQUET,
+                       '.arrow': ARROW, '.feather': ARROW, '.ipc': ARROW,
+                       '.h5': HDF5, '.hdf5': HDF5, '.hdf': HDF5}
+
+
+def get_file_format(filename, file_format=None):
+    """
+    Get the format of a data file.
+
+    Args:
+        filename (str): Path of the data file.
+        file_format (str, optional): Format given in the input xml, if any. It takes precedence over the extension.
+
+    Returns:
+        str: The format, one of READERS.
+    """
+    if file_format is not None:
+        if file_format not in READERS:
+            raise ValueError("Unknown format {} for data file {}. Supported formats are {}."
+                             .format(file_format, filename, ', '.join(READERS)))
+        return file_format
+    for extension, extension_format in FORMAT_OF_EXTENSION.items():
+        if filename.lower().endswith(extension):
+            return extension_format
+    return CSV
+
+
+def read_data_file(filename, file_format=None):
+    """
+    Read a data file.
+
+    Args:
+        filename (str): Path of the data file.
+        file_format (str, optional): Format given in the input xml, if any. See get_file_format.
+
+    Returns:
+        tuple: The attributes (list of column names) and the values (numpy.array, a row per datapoint).
+    """
+    return READERS[get_file_format(filename, file_format)](filename)
+
+
+def read_csv(filename):
+    """Read a gzipped csv data file. See read_data_file."""
+    data = pd.read_csv(filename, compression='gzip', header=0, sep=',')
+    return [str(column) for column in data.columns], data.values
+
+
+def read_parquet(filename):
+    """Read a Parquet data file. See read_data_file."""
+    _check_pyarrow(filename)
+    return _get_table_values(parquet.read_table(filename, use_threads=True))
+
+
+def read_arrow(filename):
+    """Read an Arrow IPC (Feather) data file. See read_data_file."""
+    _check_pyarrow(filename)
+    return _get_table_values(feather.read_table(filename, use_threads=True))
+
+
+def read_hdf5(filename):
+    """Read an HDF5 data file holding a single pandas DataFrame. See read_data_file."""
+    data = pd.read_hdf(filename)
+    return [str(column) for column in data.columns], data.values
+
+
+def _check_pyarrow(filename):
+    if parquet is None:
+        raise ImportError("pyarrow is needed to read data file {}.".format(filename))
+
+
+def _get_table_values(table):
+    """
+    Get the values of an Arrow table as a 2d array, of the same type pandas would give. Columns held in a single chunk
+    without missing values are taken as views of the Arrow memory rather than converted, but the values are still
+    copied into the array, so reading is not zero-copy.
+
+    Args:
+        table (pyarrow.Table): The table.
+
+    Returns:
+        tuple: The attributes (list of column names) and the values (numpy.array, a row per datapoint).
+    """
+    columns = []
+    for column in table.columns:
+        if column.num_chunks == 1 and column.null_count == 0:
+            column = column.chunk(0)
+        # Missing values become NaN, as with pandas.
+        columns.append(column.to_numpy(zero_copy_only=False))
+    if len(columns) == 0:
+        return [], np.zeros((table.num_rows, 0))
+    return list(table.column_names), np.column_stack(columns)
+
+
+# Reader of each format.
+READERS = {CSV: read_csv, PARQUET: read_parquet, ARROW: read_arrow, HDF5: read_hdf5}
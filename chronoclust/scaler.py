@@ -4,6 +4,8 @@ The scaler uses Scikit Learn's MinMaxScaler.
 Scikit-learn: Machine Learning in Python, Pedregosa et al., JMLR 12, pp. 2825-2830, 2011.
 """
 
+import numpy as np
+
 from sklearn.preprocessing import MinMaxScaler
 
 
@@ -15,6 +17,19 @@ class Scaler(object):
     def fit_scaler(self, data):
         self.scaler.fit(data)
 
+    def fit_scaler_to_statistics(self, data_mins, data_maxs):
+        """
+        Fit the scaler from the minimum and maximum of each attribute in parts of the data, e.g. each data file, rather
+        than from the data itself. Gives the same scaling as fitting it to all the data.
+
+        Args:
+            data_mins (list): Minimum of each attribute, for each part of the data.
+            data_maxs (list): Maximum of each attribute, for each part of the data.
+        """
+        # The minimum and maximum are all the scaler keeps of the data it is fitted to.
+        self.scaler.fit(np.array([np.nanmin(np.array(data_mins, dtype=float), axis=0),
+                                  np.nanmax(np.array(data_maxs, dtype=float), axis=0)]))
+
     def scale_data(self, data):
         return self.scaler.transform(data)
 